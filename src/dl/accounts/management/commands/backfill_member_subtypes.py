@@ -0,0 +1,21 @@
+from django.core.management.base import NoArgsCommand
+
+
+class Command(NoArgsCommand):
+    help = ("Sets the subtype of the Members saved before the subtype was "
+            "stored, with one UPDATE per Member subclass.  Members which "
+            "already have a subtype are left alone, so it is safe to run "
+            "repeatedly.")
+
+    def handle_noargs(self, **options):
+        from django.db import transaction
+        from accounts.models import Member
+
+        updated = 0
+        with transaction.commit_on_success():
+            for subtype, model in Member.subclasses().items():
+                updated += Member.objects.filter(
+                    subtype='',
+                    pk__in=model._default_manager.values('pk')).update(
+                        subtype=subtype)
+        self.stdout.write("Set the subtype of %d members.\n" % updated)
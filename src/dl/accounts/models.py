@@ -1,29 +1,76 @@
 from django.db import models
-from django.db.models.fields.related import SingleRelatedObjectDescriptor
 from django.contrib.auth.models import User, Group
 from django.conf import settings
 from django.dispatch import receiver
+from django.db.models.signals import m2m_changed
 from django.template.loader import render_to_string
 
 from distance_learning.models import Video
 
 from accounts.utils import get_or_none
 from common.utils import generate_random_string
+from common.utils import invalidate_counts
 
 from common.utils import send_mail
 
 from emailconfirmation.signals import email_confirmed
 
 
-# TODO: It could be a good idea to create a custom model.Manager which
-# would always do select_related queries, forcing the database to return
-# data for the subclasses immediately => less queries hitting the DB.
+class MemberManager(models.Manager):
+    """
+    A custom Manager for the `Member` model.
+    """
+    def cast_many(self, members):
+        """
+        Casts the given Member objects to their subclass objects in bulk.
+        The subclass objects are loaded with one query per subtype and
+        cached on the members, so their `cast` method needs no queries.
+        Returns the list of subclass objects in the order of the members
+        (None for the members which have no subclass object).
+        """
+        members = list(members)
+        subclasses = Member.subclasses()
+        by_subtype = {}
+        unknown = {}
+        for member in members:
+            if member._subobject is not None:
+                continue
+            if member.subtype:
+                if isinstance(member, subclasses[member.subtype]):
+                    member._subobject = member
+                else:
+                    by_subtype.setdefault(member.subtype, []).append(member)
+            else:
+                unknown[member.pk] = member
+        for subtype, typed_members in by_subtype.items():
+            subobjects = subclasses[subtype]._default_manager.in_bulk(
+                [member.pk for member in typed_members])
+            for member in typed_members:
+                member._subobject = subobjects.get(member.pk)
+        # Members saved before the subtype was stored are looked for in
+        # each subclass until all are found
+        for model in subclasses.values():
+            if not unknown:
+                break
+            for subobject in model._default_manager.filter(
+                    pk__in=unknown.keys()):
+                unknown.pop(subobject.pk)._subobject = subobject
+        return [member._subobject for member in members]
+
+
 class Member(models.Model):
     """
     A base model class for all users who can be registered on the website.
     Subclasses define additional attributes relevant for them, whereas
     here only the basic and necessary attributes are defined.
     """
+    # The name of the subclass of the Member (see `subclasses`), so that
+    # `cast` knows which table to query.  Set when the Member is created;
+    # the backfill_member_subtypes command sets it for older Members.
+    subtype = models.CharField(max_length=30, blank=True, editable=False)
+
+    objects = MemberManager()
+
     # These fields are not stored in the database for the Member object,
     # but rather in the user profile
     _username = None
@@ -154,7 +201,24 @@ class Member(models.Model):
         profile = UserProfile(user=user, member=self)
         profile.save()
 
-    _subclass_fields = None
+    # The registry of the subclasses, shared by all Member classes
+    _subclasses = None
+
+    @classmethod
+    def subclasses(cls):
+        """
+        Returns a dict mapping the subtype of each Member subclass to the
+        subclass.  The subtype is the name of the relation from Member to
+        the subclass.  The registry is built once, on first use.
+        """
+        if Member._subclasses is None:
+            Member._subclasses = dict(
+                (related.get_accessor_name(), related.model)
+                for related in Member._meta.get_all_related_objects()
+                if (isinstance(related.field, models.OneToOneField) and
+                    related.field.rel.parent_link and
+                    issubclass(related.model, Member)))
+        return Member._subclasses
 
     @property
     def subclass_fields(self):
@@ -162,16 +226,7 @@ class Member(models.Model):
         The property returns all field names which could are fields to
         access the subclass object of the base model class Member.
         """
-        if self._subclass_fields is None:
-            # Introspection to find the fields
-            self._subclass_fields = [
-                att
-                for att in dir(self.__class__)
-                if (isinstance(getattr(self.__class__, att),
-                               SingleRelatedObjectDescriptor) and
-                    issubclass(getattr(self.__class__, att).related.model,
-                               self.__class__))]
-        return self._subclass_fields
+        return sorted(self.subclasses())
 
     def save(self, *args, **kwargs):
         """
@@ -184,6 +239,10 @@ class Member(models.Model):
         user = None
         if 'user' in kwargs:
             user = kwargs.pop('user')
+        if not self.subtype:
+            for subtype, model in self.subclasses().items():
+                if isinstance(self, model):
+                    self.subtype = subtype
         super(Member, self).save(*args, **kwargs)
         # Only register if the object is not being updated
         if create:
@@ -232,6 +291,14 @@ class Member(models.Model):
         # If the method has already been called
         if self._subobject is not None:
             return self._subobject
+        if self.subtype:
+            model = self.subclasses()[self.subtype]
+            if isinstance(self, model):
+                self._subobject = self
+            else:
+                self._subobject = get_or_none(model, pk=self.pk)
+            return self._subobject
+        # Members saved before the subtype was stored: try each subclass
         for field in self.subclass_fields:
             try:
                 self._subobject = getattr(self, field)
@@ -414,6 +481,18 @@ class UserProfile(models.Model):
         related_name="%(class)s_watch_later_set")
 
 
+@receiver(m2m_changed, sender=UserProfile.favorite_videos.through)
+@receiver(m2m_changed, sender=UserProfile.watch_later_videos.through)
+def handle_video_list_changed(sender, **kwargs):
+    """
+    A receiver callback which invalidates the cached counts of the video
+    listings when videos are added to or removed from the favorites or
+    watch later lists of a profile.
+    """
+    if kwargs['action'] in ('post_add', 'post_remove', 'post_clear'):
+        invalidate_counts()
+
+
 @receiver(email_confirmed)
 def handle_email_confirmed(sender, **kwargs):
     """
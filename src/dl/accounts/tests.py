@@ -6,6 +6,8 @@ Replace this with more appropriate tests for your application.
 """
 
 from django.test import TestCase
+from django.core.management import call_command
+from StringIO import StringIO
 from accounts.models import Student, Company, University, Member
 
 class MemberTest(TestCase):
@@ -215,3 +217,59 @@ class UniversityTest(TestCase):
         self.assertEquals(
                 u.userprofile.user.username,
                 self.university_data['username'])
+
+
+class MemberSubtypeTest(TestCase):
+    def setUp(self):
+        for i in range(3):
+            Student(name=u'Name', surname=u'Surname %d' % i,
+                    email=u'student%d@domain.com' % i,
+                    username=u'student%d' % i, password=u'password').save()
+        Company(name=u'Name', email=u'company@domain.com',
+                username=u'company', password=u'password').save()
+
+    def test_subtype_saved(self):
+        """
+        Tests that the subtype is stored when a Member is created and that
+        cast uses it to query only the subclass.
+        """
+        self.assertEqual(
+            sorted(Member.objects.values_list('subtype', flat=True)),
+            [u'company', u'student', u'student', u'student'])
+        member = Member.objects.get(subtype=u'company')
+        company = Company.objects.get()
+        with self.assertNumQueries(1):
+            self.assertEqual(member.cast(), company)
+        student = Student.objects.all()[0]
+        with self.assertNumQueries(0):
+            self.assertTrue(student.cast() is student)
+
+    def test_cast_many(self):
+        """
+        Tests that cast_many queries each subtype once.
+        """
+        members = list(Member.objects.order_by('pk'))
+        with self.assertNumQueries(2):
+            subobjects = Member.objects.cast_many(members)
+        self.assertEqual([unicode(subobject) for subobject in subobjects],
+                         [u'Name Surname 0', u'Name Surname 1',
+                          u'Name Surname 2', u'Name'])
+        with self.assertNumQueries(0):
+            self.assertEqual([member.cast() for member in members],
+                             subobjects)
+
+    def test_backfill(self):
+        """
+        Tests that Members without a subtype are still cast and get their
+        subtype from the backfill_member_subtypes command.
+        """
+        Member.objects.update(subtype='')
+        members = list(Member.objects.order_by('pk'))
+        self.assertEqual(members[0].cast(),
+                         Student.objects.get(pk=members[0].pk))
+        self.assertEqual(Member.objects.cast_many(members)[-1],
+                         Company.objects.get())
+        call_command('backfill_member_subtypes', stdout=StringIO())
+        self.assertEqual(
+            sorted(Member.objects.values_list('subtype', flat=True)),
+            [u'company', u'student', u'student', u'student'])
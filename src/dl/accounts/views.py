@@ -17,7 +17,6 @@ from django.template import RequestContext
 from django.shortcuts import render_to_response
 from django.shortcuts import redirect
 
-from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.core.urlresolvers import reverse, reverse_lazy
 
 from django.views.generic.edit import UpdateView
@@ -29,6 +28,8 @@ from django.contrib.auth.views import login
 from django.contrib.auth.decorators import login_required, permission_required
 
 from distance_learning.models import Video
+from distance_learning.serializers import prefetch_submitters
+from distance_learning.serializers import videos_to_dicts
 
 from emailconfirmation.models import EmailAddress
 
@@ -37,6 +38,9 @@ from accounts.forms import get_form_for_model
 from accounts.utils import redirect_if_logged_in, get_or_none
 
 from common.utils import render_to_json_response
+from common.utils import paginate_video_set
+from common.utils import paginate_video_request
+from common.utils import CursorPage
 
 import dl.settings as settings
 
@@ -167,31 +171,27 @@ def add_watch_later(request):
                         content_type='application/json')
 
 
-def _paginate_video_set(query_set, page_number):
-    VIDEOS_PER_PAGE = 6
-    paginator = Paginator(query_set, VIDEOS_PER_PAGE)
-    try:
-        page = paginator.page(page_number)
-    except PageNotAnInteger:
-        page = paginator.page(1)
-    except EmptyPage:
-        page = None
-    return page
-
-
 def _build_response(page):
     """
     Builds a response as a JSON encoded dictionary with a list of videos
     and additionaly information about total videos found, the current page.
+    Pages paginated by cursor carry the cursors of the next and previous
+    pages instead of page numbers.
     """
     videos = [] if page is None else page.object_list
     response = {
         'status': 'ok',
-        'videos': [video.to_dict() for video in videos],
-        'total': page.paginator.count,
-        'page': page.number,
+        'videos': videos_to_dicts(videos),
     }
-    if page is not None:
+    if isinstance(page, CursorPage):
+        response['total'] = page.total
+        if page.next_cursor is not None:
+            response['next'] = page.next_cursor
+        if page.prev_cursor is not None:
+            response['prev'] = page.prev_cursor
+    elif page is not None:
+        response['total'] = page.paginator.count
+        response['page'] = page.number
         if page.has_next():
             response['next'] = page.next_page_number()
         if page.has_previous():
@@ -208,15 +208,17 @@ def get_favorites(request, page_number):
     if request.method != "GET":
         return HttpResponseBadRequest()
     profile = request.user.userprofile
-    page = _paginate_video_set(profile.favorite_videos.all(),
-                               page_number)
+    videos = profile.favorite_videos.all()
     if request.is_ajax():
+        page = paginate_video_request(request, videos, page_number)
         return HttpResponse(
             _build_response(page),
             content_type='application/json')
     else:
+        page = paginate_video_set(videos, page_number)
         if page is None:
             raise Http404
+        page.object_list = prefetch_submitters(page.object_list)
         return render_to_response(
             'distance_learning/profile.html',
             {'videos': page,
@@ -271,15 +273,17 @@ def get_watch_later(request, page_number):
     if request.method != "GET":
         return HttpResponseBadRequest()
     profile = request.user.userprofile
-    page = _paginate_video_set(profile.watch_later_videos.all(),
-                               page_number)
+    videos = profile.watch_later_videos.all()
     if request.is_ajax():
+        page = paginate_video_request(request, videos, page_number)
         return HttpResponse(
             _build_response(page),
             content_type='application/json')
     else:
+        page = paginate_video_set(videos, page_number)
         if page is None:
             raise Http404
+        page.object_list = prefetch_submitters(page.object_list)
         return render_to_response(
             'distance_learning/profile.html',
             {'videos': page,
@@ -292,16 +296,17 @@ def get_watch_later(request, page_number):
 def get_uploaded(request, page_number):
     if request.method != "GET":
         return HttpResponseBadRequest()
-    page = _paginate_video_set(
-        request.user.video_set.all().filter(approved=True),
-        page_number)
+    videos = request.user.video_set.all().filter(approved=True)
     if request.is_ajax():
+        page = paginate_video_request(request, videos, page_number)
         return HttpResponse(
             _build_response(page),
             content_type='application/json')
     else:
+        page = paginate_video_set(videos, page_number)
         if page is None:
             raise Http404
+        page.object_list = prefetch_submitters(page.object_list)
         return render_to_response(
             'distance_learning/profile.html',
             {'videos': page,
@@ -1,5 +1,9 @@
 import string
 import random
+import base64
+import datetime
+import hashlib
+import time
 
 from django.conf import settings
 from common.tasks import send_email
@@ -7,7 +11,21 @@ from common.tasks import send_email
 from django.http import HttpResponse
 from django.utils import simplejson
 
+from django.core.cache import cache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
+from django.db.models import Q
+from django.db.models.query import QuerySet
+from django.db.models.sql.datastructures import EmptyResultSet
+
+VIDEOS_PER_PAGE = 6
+
+COUNT_GENERATION_KEY = 'dl:count:generation'
+COUNT_GENERATION_TIMEOUT = 60 * 60 * 24 * 30
+# The longest time a count is cached by a cache which is not shared by the
+# processes, as the others don't see it being invalidated
+UNSHARED_COUNT_TIMEOUT = 60
 
 
 def get_send_mail():
@@ -46,9 +64,74 @@ def render_to_json_response(data, *args, **kwargs):
                         content_type='application/json')
 
 
+def _get_count_generation():
+    generation = cache.get(COUNT_GENERATION_KEY)
+    if generation is None:
+        # Start from a value which no process could have seen before in
+        # case the key was evicted.
+        cache.add(COUNT_GENERATION_KEY, int(time.time() * 1000),
+                  COUNT_GENERATION_TIMEOUT)
+        generation = cache.get(COUNT_GENERATION_KEY)
+    return generation
+
+
+def invalidate_counts():
+    """
+    Invalidates all counts cached by `cached_count` by moving on to a new
+    generation of cache keys.  Called when videos or the lists of the
+    profiles change.
+    """
+    try:
+        cache.incr(COUNT_GENERATION_KEY)
+    except ValueError:
+        # The key was evicted; the next count starts a new generation
+        pass
+
+
+def cached_count(query_set):
+    """
+    Returns the number of objects in the query set, cached until the
+    videos or the lists of the profiles change (see `invalidate_counts`),
+    at most DL_PAGINATION_COUNT_TIMEOUT seconds (an hour by default).
+
+    Invalidating only reaches the processes sharing the cache (memcached,
+    database, ...; see CACHES in local_settings.py).  With a per-process
+    cache (LocMemCache, the default) counts are cached for at most
+    UNSHARED_COUNT_TIMEOUT seconds.
+    The cache key is a signature of the SQL of the query without its
+    ordering, so query sets built differently but selecting the same rows
+    share it.
+    """
+    query = query_set.order_by().query
+    try:
+        sql, params = query.get_compiler(query_set.db).as_sql()
+    except EmptyResultSet:
+        return 0
+    key = 'dl:count:%s:%s' % (_get_count_generation(), hashlib.md5(
+        repr((query_set.db, sql, params))).hexdigest())
+    count = cache.get(key)
+    if count is None:
+        count = query_set.count()
+        timeout = getattr(settings, 'DL_PAGINATION_COUNT_TIMEOUT', 60 * 60)
+        if isinstance(cache, (LocMemCache, DummyCache)):
+            timeout = min(timeout, UNSHARED_COUNT_TIMEOUT)
+        cache.set(key, count, timeout)
+    return count
+
+
+class CachedCountPaginator(Paginator):
+    """
+    A Paginator which takes the count of a query set from `cached_count`.
+    """
+    def _get_count(self):
+        if self._count is None and isinstance(self.object_list, QuerySet):
+            self._count = cached_count(self.object_list)
+        return super(CachedCountPaginator, self)._get_count()
+    count = property(_get_count)
+
+
 def paginate_video_set(query_set, page_number=1):
-    VIDEOS_PER_PAGE = 6
-    paginator = Paginator(query_set, VIDEOS_PER_PAGE)
+    paginator = CachedCountPaginator(query_set, VIDEOS_PER_PAGE)
     try:
         page = paginator.page(page_number)
     except PageNotAnInteger:
@@ -57,6 +140,150 @@ def paginate_video_set(query_set, page_number=1):
         page = None
     return page
 
+
+class CursorPage(object):
+    """
+    A page of objects returned by `paginate_by_cursor`.  `next_cursor` and
+    `prev_cursor` are the cursors of the following and preceding pages, or
+    None when there is no such page.  `total` is the number of objects in
+    all pages as returned by `cached_count`, or None if it was not asked
+    for.
+    """
+    def __init__(self, object_list, next_cursor, prev_cursor, total=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.total = total
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+
+def _get_ordering(query_set):
+    """
+    Returns the ordering of the query set as a list of (field, descending)
+    pairs, ending with the primary key so that the ordering is total.
+    """
+    opts = query_set.model._meta
+    ordering = []
+    for name in (query_set.query.order_by or opts.ordering or ['-pk']):
+        descending = name.startswith('-')
+        name = name.lstrip('-')
+        if name == 'pk':
+            name = opts.pk.name
+        if '__' in name or name == '?':
+            raise ValueError("Can't paginate by cursor on %s" % name)
+        ordering.append((opts.get_field(name), descending))
+    if opts.pk not in [field for field, _ in ordering]:
+        ordering.append((opts.pk, ordering[-1][1]))
+    return ordering
+
+
+def _encode_cursor(obj, ordering, backwards):
+    values = []
+    for field, _ in ordering:
+        value = getattr(obj, field.attname)
+        if isinstance(value, (datetime.date, datetime.datetime)):
+            value = value.isoformat()
+        values.append(value)
+    return base64.urlsafe_b64encode(
+        simplejson.dumps([int(backwards), values]))
+
+
+def _decode_cursor(cursor, ordering):
+    """
+    Returns the direction and the key values of the cursor.  Raises a
+    ValueError if it is malformed.
+    """
+    try:
+        backwards, values = simplejson.loads(
+            base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list) or len(values) != len(ordering):
+        raise ValueError("Invalid cursor")
+    try:
+        values = [field.to_python(value)
+                  for (field, _), value in zip(ordering, values)]
+    except Exception:
+        raise ValueError("Invalid cursor")
+    # the ordering fields are not null
+    if None in values:
+        raise ValueError("Invalid cursor")
+    return bool(backwards), values
+
+
+def _after(ordering, values, backwards):
+    """
+    Builds the condition selecting the objects after the key `values` in
+    the ordering, or before them when going `backwards`:
+    (a > x) OR (a = x AND b > y) OR ...
+    """
+    condition = None
+    equal = Q()
+    for (field, descending), value in zip(ordering, values):
+        lookup = 'lt' if descending != backwards else 'gt'
+        after = equal & Q(**{'%s__%s' % (field.name, lookup): value})
+        condition = after if condition is None else condition | after
+        equal &= Q(**{field.name: value})
+    return condition
+
+
+def paginate_by_cursor(query_set, cursor=None, per_page=VIDEOS_PER_PAGE,
+                       with_total=True):
+    """
+    Paginates the query set on its ordering and the primary key (keyset
+    pagination): the page following an opaque `cursor` is fetched with a
+    condition on the ordering columns instead of an OFFSET, so that deep
+    pages cost as much as the first one and pages don't shift when objects
+    are added.  Returns a `CursorPage`, the first page if `cursor` is
+    empty, or None if the cursor is invalid.
+    The query set must not be sliced and must be ordered on non-null fields
+    of the model only.
+    """
+    ordering = _get_ordering(query_set)
+    total = cached_count(query_set) if with_total else None
+    backwards = False
+    if cursor:
+        try:
+            backwards, values = _decode_cursor(cursor, ordering)
+        except ValueError:
+            return None
+        query_set = query_set.filter(_after(ordering, values, backwards))
+    query_set = query_set.order_by(*[
+        ('-' if descending != backwards else '') + field.name
+        for field, descending in ordering])
+    objects = list(query_set[:per_page + 1])
+    more = len(objects) > per_page
+    objects = objects[:per_page]
+    if backwards:
+        objects.reverse()
+    next_cursor = prev_cursor = None
+    if objects:
+        if more or backwards:
+            next_cursor = _encode_cursor(objects[-1], ordering, False)
+        if (more and backwards) or (cursor and not backwards):
+            prev_cursor = _encode_cursor(objects[0], ordering, True)
+    return CursorPage(objects, next_cursor, prev_cursor, total)
+
+
+def paginate_video_request(request, query_set, page_number=None):
+    """
+    Paginates the query set for a JSON API request: by cursor if the
+    request has a `cursor` parameter (empty for the first page), by page
+    number otherwise, `page_number` or the `page` parameter.  Sliced query
+    sets (when a `limit` was asked for) are always paginated by page number.
+    """
+    if 'cursor' in request.GET and query_set.query.can_filter():
+        return paginate_by_cursor(query_set, request.GET['cursor'])
+    if page_number is None:
+        page_number = request.GET.get('page', 1)
+    return paginate_video_set(query_set, page_number)
+
+
 def add_static_domain_to_context(request):
     """
     Context processor which adds the domains name where static files are
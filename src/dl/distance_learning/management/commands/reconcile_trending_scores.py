@@ -0,0 +1,65 @@
+import datetime
+from collections import defaultdict
+
+from django.core.management.base import NoArgsCommand
+
+
+class Command(NoArgsCommand):
+    help = ("Recomputes the Video.trending_score column from the hourly and "
+            "daily hit rollups, measured from the current time.  Run it after "
+            "changing DL_TRENDING_HALF_LIFE and after deleting hits.")
+
+    def handle_noargs(self, **options):
+        from django.db import transaction
+        from django.contrib.contenttypes.models import ContentType
+        from hitcount.models import Hit, HitCount
+        from hitcount.models import HourlyHitCount, DailyHitCount
+        from hitcount.models import RollupWatermark
+        from hitcount.utils import naive_utc
+        from distance_learning.models import Video, TrendingEpoch
+        from distance_learning.models import trending_weight
+
+        hitcounts = HitCount.objects.filter(
+            content_type=ContentType.objects.get_for_model(Video))
+        videos = {}
+        for hitcount_pk, object_pk in hitcounts.values_list(
+                'pk', 'object_pk').iterator():
+            try:
+                videos[hitcount_pk] = int(object_pk)
+            except ValueError:
+                pass
+
+        # Complete days from the daily rollups (weighted at noon), today
+        # from the hourly ones (weighted at half past) and the hits which
+        # are not rolled up yet one by one.
+        now = datetime.datetime.utcnow()
+        today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        scores = defaultdict(float)
+        for queryset, offset in (
+                (DailyHitCount.objects.filter(bucket__lt=today),
+                    datetime.timedelta(hours=12)),
+                (HourlyHitCount.objects.filter(bucket__gte=today),
+                    datetime.timedelta(minutes=30))):
+            for hitcount_pk, bucket, hits in queryset.values_list(
+                    'hitcount', 'bucket', 'hits').iterator():
+                if hitcount_pk in videos:
+                    scores[videos[hitcount_pk]] += hits * trending_weight(
+                        naive_utc(bucket) + offset, now)
+        watermark = RollupWatermark.objects.get_last_hit_id()
+        for hitcount_pk, created in Hit.objects.filter(
+                pk__gt=watermark).values_list('hitcount',
+                                              'created').iterator():
+            if hitcount_pk in videos:
+                scores[videos[hitcount_pk]] += trending_weight(
+                    naive_utc(created), now)
+
+        updated = 0
+        with transaction.commit_on_success():
+            TrendingEpoch.objects.set_epoch(now)
+            Video.objects.exclude(pk__in=scores.keys()).update(
+                trending_score=0)
+            for video_pk, score in scores.items():
+                updated += Video.objects.filter(pk=video_pk).update(
+                    trending_score=score)
+        self.stdout.write("Recomputed the trending score of %d videos.\n" %
+                          updated)
@@ -0,0 +1,39 @@
+from collections import defaultdict
+
+from django.core.management.base import NoArgsCommand
+
+
+class Command(NoArgsCommand):
+    help = ("Reconciles the denormalized Video.view_count column with the "
+            "totals stored in the hitcount_hit_count table.")
+
+    def handle_noargs(self, **options):
+        from django.db import transaction
+        from django.contrib.contenttypes.models import ContentType
+        from hitcount.models import HitCount
+        from distance_learning.models import Video
+
+        hitcounts = HitCount.objects.filter(
+            content_type=ContentType.objects.get_for_model(Video))
+        totals = {}
+        for object_pk, hits in hitcounts.values_list('object_pk',
+                                                     'hits').iterator():
+            try:
+                totals[int(object_pk)] = hits
+            except ValueError:
+                pass
+
+        # Videos which need the same new value share an UPDATE.
+        videos_by_count = defaultdict(list)
+        videos = Video.objects.values_list('pk', 'view_count')
+        for video_pk, view_count in videos.iterator():
+            hits = totals.get(video_pk, 0)
+            if hits != view_count:
+                videos_by_count[hits].append(video_pk)
+
+        fixed = 0
+        with transaction.commit_on_success():
+            for hits, video_pks in videos_by_count.items():
+                fixed += Video.objects.filter(pk__in=video_pks).update(
+                    view_count=hits)
+        self.stdout.write("Reconciled the view count of %d videos.\n" % fixed)
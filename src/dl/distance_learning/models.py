@@ -1,21 +1,29 @@
 import urlparse
+import datetime
 from collections import namedtuple
+from collections import defaultdict
 
+from django.conf import settings
 from django.db import models
+from django.db.models import F, Count
 from django.dispatch import receiver
 from django.core import urlresolvers
 from django.core.exceptions import ValidationError
 from django.contrib.auth.models import User
 from django.utils import timezone
 from django.utils.safestring import mark_safe
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete, m2m_changed
 
 from distance_learning.utils import LimitedFileField
 from distance_learning.utils import CommaDelimitedTextField
 from distance_learning.utils import send_admin_notification
 
+from common.utils import invalidate_counts
+
 from hitcount.models import HitCount
 from hitcount.models import ContentType
+from hitcount.models import hit_count_changed
+from hitcount.utils import naive_utc
 
 
 class VideoSubject(models.Model):
@@ -38,6 +46,41 @@ class VideoType(models.Model):
         return u'%s' % self.type_name
 
 
+# The trending epoch is moved forward once hits are weighted by more than
+# this many half-lives, well before the weights overflow a float.
+TRENDING_MAX_HALF_LIVES = 64
+
+
+def _trending_half_lives(when, epoch):
+    """
+    Returns the number of DL_TRENDING_HALF_LIFE (a timedelta dict, 7 days
+    by default) from the datetime `epoch` to `when`.
+    """
+    half_life = datetime.timedelta(**getattr(settings,
+                                             'DL_TRENDING_HALF_LIFE',
+                                             {'days': 7}))
+    age = when - epoch
+    return ((age.days * 86400 + age.seconds) /
+            float(half_life.days * 86400 + half_life.seconds))
+
+
+def trending_weight(when, epoch):
+    """
+    Returns the weight of a hit made at the (naive, UTC) datetime `when` in
+    the trending scores measured from the (naive, UTC) datetime `epoch`.
+
+    A hit's contribution to the score halves every DL_TRENDING_HALF_LIFE.
+    Rather than decaying every score as time passes, newer hits get
+    exponentially larger weights; scaling all scores by the same factor
+    doesn't change their order.  To keep the weights within the range of a
+    float the epoch is moved forward and the scores are scaled down every
+    TRENDING_MAX_HALF_LIVES half-lives (see `TrendingEpoch`).  Change the
+    half-life only together with running the reconcile_trending_scores
+    command.
+    """
+    return 2 ** _trending_half_lives(when, epoch)
+
+
 class VideoManager(models.Manager):
     """
     A custom Manager for the `Video` model. Exposes convenience methods for
@@ -57,6 +100,16 @@ class VideoManager(models.Manager):
         qs = self.get_query_set()
         return qs.filter(approved=True).exclude(upcoming=False)
 
+    def approved_types(self):
+        """
+        Returns a QuerySet of the VideoTypes which have approved videos,
+        ordered by name, each annotated with the number of its approved
+        videos as `video_count`.  Types and counts come from a single
+        aggregate query.
+        """
+        return VideoType.objects.filter(video__approved=True).annotate(
+            video_count=Count('video')).order_by('type_name')
+
     def all_active_broadcast(self):
         """
         Returns a QuerySet of Videos which are flaged as an active broadcast.
@@ -65,19 +118,38 @@ class VideoManager(models.Manager):
 
     def get_most_viewed(self, limit=None):
         """
-        Returns videos sorted by the number of its hits.
+        Returns a QuerySet of videos sorted by the number of its hits.
         It should return `limit` results.
         If a `limit` is not provided, all videos are returned.
         """
-        videos = self.all_approved()
+        videos = self.all_approved().order_by('-view_count', '-date_uploaded')
         try:
             limit = int(limit)
-        except:
+        except (TypeError, ValueError):
             limit = None
         if limit is not None:
-            return sorted(videos, key=lambda v: v.views, reverse=True)[:limit]
+            return videos[:limit]
         else:
-            return sorted(videos, key=lambda v: v.views, reverse=True)
+            return videos
+
+    def get_trending(self, limit=None):
+        """
+        Returns a QuerySet of videos sorted by their trending score, the
+        number of recent hits where older hits count less and less (see
+        `trending_weight`).
+        It should return `limit` results.
+        If a `limit` is not provided, all videos are returned.
+        """
+        videos = self.all_approved().order_by('-trending_score',
+                                              '-date_uploaded')
+        try:
+            limit = int(limit)
+        except (TypeError, ValueError):
+            limit = None
+        if limit is not None:
+            return videos[:limit]
+        else:
+            return videos
 
     def get_recent(self, limit=5):
         """
@@ -162,26 +234,23 @@ class Video(models.Model):
     upcoming = models.BooleanField(default=False)
     active_broadcast = models.BooleanField(default=False)
     approved = models.BooleanField(default=False)
-
-
-    _views = None
+    # Denormalized copy of the video's HitCount total so that videos can be
+    # sorted by views in the database.  Kept in sync by the
+    # `update_view_count` receiver and the reconcile_view_counts command.
+    view_count = models.PositiveIntegerField(default=0, db_index=True,
+                                             editable=False)
+    # Sum of the `trending_weight` of the video's hits.  Maintained by the
+    # `update_view_count` receiver and the reconcile_trending_scores
+    # command.
+    trending_score = models.FloatField(default=0, db_index=True,
+                                       editable=False)
 
     @property
     def views(self):
         """
         The property returns the number of hits (views) a video object has had.
         """
-        if self._views is not None:
-            return self._views
-        try:
-            hc = HitCount.objects.get(
-                content_type=ContentType.objects.get_for_model(Video),
-                object_pk=self.pk)
-        except HitCount.DoesNotExist:
-            self._views = 0
-        else:
-            self._views = hc.hits
-        return self._views
+        return self.view_count
 
     def __unicode__(self):
         return u'%s, %s' % (self.name, self.city)
@@ -260,6 +329,67 @@ class Video(models.Model):
         )
 
 
+class TrendingEpochManager(models.Manager):
+    def get_epoch(self, now):
+        """
+        Returns the (naive, UTC) epoch the trending weights of hits made at
+        `now` are measured from.  Once that is more than
+        TRENDING_MAX_HALF_LIVES half-lives ago the epoch is moved to `now`
+        and the trending scores of all videos are scaled down to match.
+        """
+        epochs = self.get_query_set().values_list('epoch', flat=True)
+        if epochs:
+            epoch = naive_utc(epochs[0])
+            if _trending_half_lives(now, epoch) <= TRENDING_MAX_HALF_LIVES:
+                return epoch
+        return self.set_epoch(now, rescale=True)
+
+    def set_epoch(self, epoch, rescale=False):
+        """
+        Moves the trending epoch to the (naive, UTC) datetime `epoch` and
+        returns it.  With `rescale` the trending scores are scaled by the
+        same factor, otherwise the caller has to recompute them.
+
+        The epoch row stays locked until the end of the transaction, so
+        concurrent moves are applied one after the other.
+        """
+        epochs = self.select_for_update().values_list('epoch', flat=True)
+        if not epochs:
+            # The single row has a fixed pk, so the INSERT of a concurrent
+            # creator fails and get_or_create fetches the winner's row.
+            created = self.get_or_create(pk=TrendingEpoch.PK,
+                                         defaults={'epoch': epoch})[1]
+            if created:
+                return epoch
+            epochs = self.select_for_update().values_list('epoch', flat=True)
+        current = naive_utc(epochs[0])
+        if rescale:
+            # Another process might have moved the epoch in the meantime
+            if _trending_half_lives(epoch, current) <= \
+                    TRENDING_MAX_HALF_LIVES:
+                return current
+            Video.objects.update(trending_score=F('trending_score') *
+                                 trending_weight(current, epoch))
+        self.update(epoch=epoch)
+        return epoch
+
+
+class TrendingEpoch(models.Model):
+    """
+    The time the trending weights are currently measured from (see
+    `trending_weight`).  A single row, moved forward by the
+    `update_view_count` receiver and the reconcile_trending_scores command.
+    """
+    PK = 1
+
+    epoch = models.DateTimeField()
+
+    objects = TrendingEpochManager()
+
+    def __unicode__(self):
+        return u'%s' % self.epoch
+
+
 class Comment(models.Model):
     """
     A model class for comments posted on videos.
@@ -307,3 +437,65 @@ def user_saved(sender, **kwargs):
                                 handle_url=urlresolvers.reverse(
                                     NAMED_URL_PATTERN,
                                     args=(video.id,)))
+
+
+@receiver(post_save, sender=Video)
+@receiver(post_delete, sender=Video)
+def invalidate_video_counts(sender, **kwargs):
+    """
+    A callback function invalidating the cached counts of the video
+    listings when a Video is saved or deleted.
+    """
+    invalidate_counts()
+
+
+@receiver(m2m_changed, sender=Video.subject.through)
+def invalidate_subject_counts(sender, **kwargs):
+    """
+    A callback function invalidating the cached counts of the video
+    listings when subjects are added to or removed from a video.  The admin
+    saves the subjects after the video itself.
+    """
+    if kwargs['action'] in ('post_add', 'post_remove', 'post_clear'):
+        invalidate_counts()
+
+
+@receiver(hit_count_changed, sender=HitCount)
+def update_view_count(sender, **kwargs):
+    """
+    A callback function for handling the hit_count_changed signal.
+    It applies the change of HitCount totals to the `view_count` of the
+    videos the HitCounts belong to and adds new hits to their
+    `trending_score`, each weighted by the time it was made (see `times` of
+    the signal) so that hits which are saved late don't count as new.
+    Deleted hits are left in the trending score; they are dropped by the
+    reconcile_trending_scores command.
+    """
+    deltas = kwargs.get('deltas')
+    times = kwargs.get('times') or {}
+    hitcounts = list(HitCount.objects.filter(
+        pk__in=deltas.keys(),
+        content_type=ContentType.objects.get_for_model(Video)).values_list(
+            'pk', 'object_pk'))
+    if any(deltas[hitcount_pk] > 0 for hitcount_pk, _ in hitcounts):
+        now = datetime.datetime.utcnow()
+        epoch = TrendingEpoch.objects.get_epoch(now)
+    # Videos whose view count and trending score change by the same amounts
+    # share an UPDATE.
+    videos_by_delta = defaultdict(list)
+    for hitcount_pk, object_pk in hitcounts:
+        delta = deltas[hitcount_pk]
+        score = 0
+        if delta > 0:
+            # Hits made later than now (clock skew) count as made now
+            score = sum(trending_weight(min(naive_utc(created), now), epoch)
+                        for created in times.get(hitcount_pk, [now] * delta))
+        videos_by_delta[(delta, score)].append(object_pk)
+    for (delta, score), video_pks in videos_by_delta.items():
+        if delta > 0:
+            Video.objects.filter(pk__in=video_pks).update(
+                view_count=F('view_count') + delta,
+                trending_score=F('trending_score') + score)
+        else:
+            Video.objects.filter(pk__in=video_pks).update(
+                view_count=F('view_count') + delta)
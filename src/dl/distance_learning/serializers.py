@@ -0,0 +1,51 @@
+"""
+Serializing lists of videos for the video cards, both the JSON responses and
+the video-thumbnail.html template.
+
+A video card shows the submitter of the video, which is reached through
+video.user.userprofile.member.cast(): done video by video, that is a query
+for the user, the profile and the member, and another for the subclass
+object returned by cast().  `prefetch_submitters` resolves them for a whole
+list of videos in a fixed number of queries instead.  The view counts are
+denormalized on the videos (Video.view_count) and the preview image URLs
+need no query.
+"""
+from accounts.models import Member, UserProfile
+from distance_learning.models import Video
+
+
+def prefetch_submitters(videos):
+    """
+    Loads the submitters of the videos in one query for the users and their
+    profiles and members and one query for each type of member, and caches
+    them on the videos so that video.user.userprofile.member.cast() runs no
+    more queries.
+    Returns the videos as a list.
+    """
+    videos = list(videos)
+    user_ids = set(video.user_id for video in videos)
+    if not user_ids:
+        return videos
+    profiles = dict(
+        (profile.user_id, profile)
+        for profile in UserProfile.objects.filter(
+            user__in=user_ids).select_related('user', 'member'))
+    Member.objects.cast_many(profile.member for profile in profiles.values())
+
+    user_cache = Video._meta.get_field('user').get_cache_name()
+    profile_cache = UserProfile._meta.get_field(
+        'user').related.get_cache_name()
+    for video in videos:
+        profile = profiles.get(video.user_id)
+        if profile is not None:
+            setattr(profile.user, profile_cache, profile)
+            setattr(video, user_cache, profile.user)
+    return videos
+
+
+def videos_to_dicts(videos):
+    """
+    Returns the `to_dict` representations of the videos, with the
+    submitters prefetched.
+    """
+    return [video.to_dict() for video in prefetch_submitters(videos)]
@@ -3,11 +3,24 @@ Unit tests for the distance_learning application.
 """
 
 from django.test import TestCase
+from django.utils import simplejson
+from django.core.management import call_command
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from StringIO import StringIO
+import base64
+import datetime
 import unittest
 import doctest
 
 from distance_learning import utils
 from distance_learning.models import Video, VideoType, VideoSubject
+from distance_learning.models import TrendingEpoch, trending_weight
+from distance_learning.serializers import videos_to_dicts
+from common import utils as common_utils
+from common.utils import paginate_by_cursor, paginate_video_set
+from accounts.models import Student, Company
+from hitcount.models import Hit, HitCount
 from distance_learning.utils import CommaDelimitedTextField
 from distance_learning.utils import PrettyPrintList
 
@@ -20,6 +33,18 @@ def suite():
     suite.addTest(doctest.DocTestSuite(utils))
     suite.addTest(unittest.TestLoader().loadTestsFromTestCase(
         CommaDelimitedTextFieldTest))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(
+        ViewCountTest))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(
+        TrendingTest))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(
+        VideoSerializerTest))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(
+        CursorPaginationTest))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(
+        CachedCountTest))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(
+        VideoTypeTest))
     return suite
 
 class CommaDelimitedTextFieldTest(TestCase):
@@ -69,3 +94,334 @@ class VideoTest(TestCase):
     def test_admin_notification(self):
         pass
 
+
+class ViewCountTest(TestCase):
+    def setUp(self):
+        user = User.objects.create(username='uploader')
+        ctype = ContentType.objects.get_for_model(Video)
+        self.videos = []
+        self.hitcounts = []
+        for name in ('first', 'second'):
+            video = Video.objects.create(
+                name=name, city='City', country='Country', event='Event',
+                description='Description', lecturer='Lecturer',
+                video_type=VideoType.objects.get(pk=1), keywords='key',
+                user=user, approved=True)
+            self.videos.append(video)
+            self.hitcounts.append(HitCount.objects.create(
+                content_type=ctype, object_pk=str(video.pk)))
+
+    def _view_counts(self):
+        return [Video.objects.get(pk=video.pk).view_count
+                for video in self.videos]
+
+    def test_hits_update_view_count(self):
+        """
+        Tests that saving and deleting hits keeps the view counts in step
+        and that the most viewed videos are ordered by them.
+        """
+        for session_hash in range(3):
+            Hit(hitcount=self.hitcounts[1], ip='10.0.0.1',
+                session_hash=session_hash, user_agent='ua').save()
+        Hit(hitcount=self.hitcounts[0], ip='10.0.0.1', session_hash=0,
+            user_agent='ua').save()
+        self.assertEqual(self._view_counts(), [1, 3])
+        self.assertEqual(list(Video.objects.get_most_viewed()),
+                         self.videos[::-1])
+        Hit.objects.filter(hitcount=self.hitcounts[1])[0].delete()
+        self.assertEqual(self._view_counts(), [1, 2])
+
+    def test_reconcile(self):
+        """
+        Tests that the reconcile_view_counts command repairs view counts
+        which drifted from the HitCount totals.
+        """
+        HitCount.objects.filter(pk=self.hitcounts[0].pk).update(hits=4)
+        Video.objects.filter(pk=self.videos[1].pk).update(view_count=7)
+        call_command('reconcile_view_counts', stdout=StringIO())
+        self.assertEqual(self._view_counts(), [4, 0])
+
+
+class TrendingTest(TestCase):
+    def setUp(self):
+        user = User.objects.create(username='uploader')
+        ctype = ContentType.objects.get_for_model(Video)
+        self.videos = []
+        self.hitcounts = []
+        for name in ('old', 'new'):
+            video = Video.objects.create(
+                name=name, city='City', country='Country', event='Event',
+                description='Description', lecturer='Lecturer',
+                video_type=VideoType.objects.get(pk=1), keywords='key',
+                user=user, approved=True)
+            self.videos.append(video)
+            self.hitcounts.append(HitCount.objects.create(
+                content_type=ctype, object_pk=str(video.pk)))
+
+    def _hit(self, hitcount, session_hash, **ago):
+        hit = Hit(hitcount=hitcount, ip='10.0.0.1',
+                  session_hash=session_hash, user_agent='ua')
+        hit.save()
+        hit.created = datetime.datetime.utcnow() - datetime.timedelta(**ago)
+        hit.save()
+
+    def test_weight_halves(self):
+        """
+        Tests that a hit counts half as much one half-life later.
+        """
+        epoch = datetime.datetime(2013, 1, 1)
+        now = datetime.datetime(2013, 5, 1)
+        with self.settings(DL_TRENDING_HALF_LIFE={'days': 7}):
+            self.assertAlmostEqual(
+                trending_weight(now + datetime.timedelta(days=7), epoch) /
+                trending_weight(now, epoch), 2)
+
+    def test_epoch_moves(self):
+        """
+        Tests that hits decades after the trending epoch move the epoch
+        forward instead of overflowing the weights.
+        """
+        epoch = datetime.datetime(2012, 1, 1)
+        TrendingEpoch.objects.create(epoch=epoch)
+        Video.objects.filter(pk=self.videos[0].pk).update(trending_score=8)
+        with self.settings(DL_TRENDING_HALF_LIFE={'days': 1}):
+            self.assertEqual(TrendingEpoch.objects.get_epoch(
+                epoch + datetime.timedelta(days=60)), epoch)
+            later = epoch + datetime.timedelta(days=67)
+            self.assertEqual(TrendingEpoch.objects.get_epoch(later), later)
+            self.assertAlmostEqual(Video.objects.get(
+                pk=self.videos[0].pk).trending_score, 8 * 2 ** -67)
+
+            # A hit made now is scored against an epoch near the present
+            self._hit(self.hitcounts[1], 0)
+            self.assertAlmostEqual(Video.objects.get(
+                pk=self.videos[1].pk).trending_score, 1, places=2)
+
+            when = datetime.datetime(2060, 1, 1)
+            self.assertEqual(TrendingEpoch.objects.get_epoch(when), when)
+            self.assertEqual(trending_weight(when, when), 1)
+        self.assertEqual(TrendingEpoch.objects.count(), 1)
+
+    def test_trending(self):
+        """
+        Tests that new hits are scored incrementally and that older hits
+        count less after reconciling.
+        """
+        for session_hash in range(3):
+            self._hit(self.hitcounts[0], session_hash, days=30)
+        self._hit(self.hitcounts[1], 0, minutes=5)
+        # Scored as the hits were made, so the old video leads for now
+        self.assertEqual(list(Video.objects.get_trending()),
+                         self.videos)
+        call_command('reconcile_trending_scores', stdout=StringIO())
+        self.assertEqual(list(Video.objects.get_trending(limit=1)),
+                         self.videos[1:])
+
+    def test_late_hits(self):
+        """
+        Tests that hits saved late, eg from a buffer or a log, are scored by
+        the time they were made rather than the time they were saved.
+        """
+        now = datetime.datetime.utcnow()
+        with self.settings(DL_TRENDING_HALF_LIFE={'days': 7}):
+            Hit.objects.record_hits([
+                Hit(hitcount=self.hitcounts[0], ip='10.0.0.1',
+                    session_hash=session_hash, user_agent='ua',
+                    created=now - datetime.timedelta(days=14))
+                for session_hash in range(2)])
+            Hit.objects.record_hits([
+                Hit(hitcount=self.hitcounts[1], ip='10.0.0.1',
+                    session_hash=0, user_agent='ua', created=now)])
+        old, new = [Video.objects.get(pk=video.pk).trending_score
+                    for video in self.videos]
+        self.assertAlmostEqual(old / new, 2 * 0.25, places=3)
+
+
+class VideoSerializerTest(TestCase):
+    def setUp(self):
+        members = [
+            Student(name=u'Name', surname=u'Surname', email=u'a@domain.com',
+                    username=u'student1', password=u'password'),
+            Student(name=u'Other', surname=u'Student', email=u'b@domain.com',
+                    username=u'student2', password=u'password'),
+            Company(name=u'Company', email=u'c@domain.com',
+                    address=u'Address', username=u'company',
+                    password=u'password'),
+        ]
+        for i, member in enumerate(members):
+            member.save()
+            for name in ('first', 'second'):
+                Video.objects.create(
+                    name=u'%s %d' % (name, i), city='City',
+                    country='Country', event='Event',
+                    description='Description', lecturer='Lecturer',
+                    video_type=VideoType.objects.get(pk=1), keywords='key',
+                    video_url='http://www.youtube.com/watch?v=%s%d' % (
+                        name, i),
+                    user=member.userprofile.user, approved=True)
+
+    def test_constant_queries(self):
+        """
+        Tests that the submitters are resolved in a fixed number of queries
+        and that the dictionaries are the same as those of `to_dict`.
+        """
+        expected = [video.to_dict()
+                    for video in Video.objects.order_by('pk')]
+        videos = list(Video.objects.order_by('pk'))
+        # The profiles, then the students and the company
+        with self.assertNumQueries(3):
+            dicts = videos_to_dicts(videos)
+        self.assertEqual(dicts, expected)
+        self.assertEqual([d['user'] for d in dicts[::2]],
+                         [u'Name Surname', u'Other Student', u'Company'])
+
+
+class CursorPaginationTest(TestCase):
+    def setUp(self):
+        user = User.objects.create(username='uploader')
+        # Ties on the view count are broken by the upload date and the pk
+        for i in range(14):
+            Video.objects.create(
+                name=u'video %d' % i, city='City', country='Country',
+                event='Event', description='Description',
+                lecturer='Lecturer', video_type=VideoType.objects.get(pk=1),
+                keywords='key', user=user, approved=True)
+        Video.objects.filter(pk__lte=5).update(view_count=10)
+        Video.objects.filter(pk__in=[2, 9]).update(view_count=3)
+
+    def test_pages(self):
+        """
+        Tests that following the next cursors walks through all videos in
+        order, that the previous cursors walk back and that a deep page
+        costs a single query once the total is cached.
+        """
+        videos = Video.objects.get_most_viewed()
+        expected = list(videos)
+        pages = []
+        page = paginate_by_cursor(videos)
+        self.assertEqual(page.prev_cursor, None)
+        self.assertEqual(page.total, 14)
+        while True:
+            pages.append(page)
+            if page.next_cursor is None:
+                break
+            with self.assertNumQueries(1):
+                page = paginate_by_cursor(videos, page.next_cursor)
+        self.assertEqual([len(page) for page in pages], [6, 6, 2])
+        self.assertEqual(sum([page.object_list for page in pages], []),
+                         expected)
+        page = paginate_by_cursor(videos, pages[-1].prev_cursor)
+        self.assertEqual(page.object_list, pages[1].object_list)
+        page = paginate_by_cursor(videos, page.prev_cursor)
+        self.assertEqual(page.object_list, pages[0].object_list)
+        self.assertEqual(page.prev_cursor, None)
+        page = paginate_by_cursor(videos, page.next_cursor)
+        self.assertEqual(page.object_list, pages[1].object_list)
+
+    def test_invalid_cursor(self):
+        videos = Video.objects.get_most_viewed()
+        self.assertEqual(paginate_by_cursor(videos, 'garbage'), None)
+        for value in ([0, 5], [0, [None, None, None]], [0, [1, 2]], 5):
+            cursor = base64.urlsafe_b64encode(simplejson.dumps(value))
+            self.assertEqual(paginate_by_cursor(videos, cursor), None)
+
+
+class CachedCountTest(TestCase):
+    def setUp(self):
+        student = Student(name=u'Name', surname=u'Surname',
+                          email=u'a@domain.com', username=u'student',
+                          password=u'password')
+        student.save()
+        self.profile = student.userprofile
+        self.video = self._create_video()
+
+    def _create_video(self):
+        return Video.objects.create(
+            name=u'video', city='City', country='Country', event='Event',
+            description='Description', lecturer='Lecturer',
+            video_type=VideoType.objects.get(pk=1), keywords='key',
+            user=self.profile.user, approved=True)
+
+    def _count(self):
+        return paginate_video_set(
+            Video.objects.get_most_viewed()).paginator.count
+
+    def test_video_changes(self):
+        """
+        Tests that the count is cached and invalidated when a video is
+        saved or deleted.
+        """
+        self.assertEqual(self._count(), 1)
+        # Only the page itself is queried
+        with self.assertNumQueries(1):
+            page = paginate_video_set(Video.objects.get_most_viewed())
+            list(page.object_list)
+        self.assertEqual(page.paginator.count, 1)
+        video = self._create_video()
+        self.assertEqual(self._count(), 2)
+        video.delete()
+        self.assertEqual(self._count(), 1)
+
+    def test_unshared_cache_timeout(self):
+        """
+        Tests that a count cached in a per-process cache expires after
+        UNSHARED_COUNT_TIMEOUT, without waiting for an invalidation which
+        the other processes would not see.
+        """
+        timeout = common_utils.UNSHARED_COUNT_TIMEOUT
+        common_utils.UNSHARED_COUNT_TIMEOUT = 0
+        try:
+            self.assertEqual(self._count(), 1)
+            # Changed without invalidating the counts
+            Video.objects.filter(pk=self.video.pk).update(approved=False)
+            self.assertEqual(self._count(), 0)
+        finally:
+            common_utils.UNSHARED_COUNT_TIMEOUT = timeout
+
+    def test_profile_lists(self):
+        """
+        Tests that the count of a profile list is invalidated when videos
+        are added to or removed from it.
+        """
+        favorites = lambda: paginate_video_set(
+            self.profile.favorite_videos.all()).paginator.count
+        self.assertEqual(favorites(), 0)
+        self.profile.favorite_videos.add(self.video)
+        self.assertEqual(favorites(), 1)
+        self.profile.favorite_videos.remove(self.video)
+        self.assertEqual(favorites(), 0)
+
+    def test_subjects(self):
+        """
+        Tests that the count of a subject's videos is invalidated when
+        subjects are added to or removed from a video.
+        """
+        subject = VideoSubject.objects.create(subject_name=u'Subject')
+        subject_videos = lambda: paginate_video_set(
+            Video.objects.filter(subject=subject)).paginator.count
+        self.assertEqual(subject_videos(), 0)
+        self.video.subject.add(subject)
+        self.assertEqual(subject_videos(), 1)
+        self.video.subject.clear()
+        self.assertEqual(subject_videos(), 0)
+
+
+class VideoTypeTest(TestCase):
+    def test_approved_types(self):
+        """
+        Tests that the types with approved videos and their numbers of
+        approved videos come from one query.
+        """
+        user = User.objects.create(username='uploader')
+        other_type = VideoType.objects.create(type_name=u'Other')
+        for video_type, approved in ((1, True), (1, True), (1, False),
+                                     (other_type.pk, False)):
+            Video.objects.create(
+                name=u'video', city='City', country='Country',
+                event='Event', description='Description',
+                lecturer='Lecturer', video_type_id=video_type,
+                keywords='key', user=user, approved=approved)
+        with self.assertNumQueries(1):
+            types = [(video_type.pk, video_type.video_count)
+                     for video_type in Video.objects.approved_types()]
+        self.assertEqual(types, [(1, 2)])
@@ -16,20 +16,23 @@ from django.shortcuts import redirect
 from django.shortcuts import get_object_or_404
 
 from django.core.urlresolvers import reverse
-from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 
-from distance_learning.models import Video, VideoSubject
+from distance_learning.models import Video, VideoSubject, VideoType
 from distance_learning.forms import VideoUploadForm
 from distance_learning.forms import UpcomingVideoUploadForm
 from distance_learning.forms import VideoSearchForm
 from distance_learning.forms import CommentPostForm
 from distance_learning.utils import get_or_none
 from distance_learning.uploadhandlers import QuotaUploadHandler
+from distance_learning.serializers import prefetch_submitters
+from distance_learning.serializers import videos_to_dicts
 
 from accounts.models import LocalCommittee
 
 from common.utils import render_to_json_response
 from common.utils import paginate_video_set
+from common.utils import paginate_video_request
+from common.utils import CursorPage
 
 from haystack.query import SearchQuerySet, AutoQuery, SQ
 
@@ -41,11 +44,12 @@ def index(request):
     A view for the index page.  It needs to fetch most popular
     content which is to be rendered in the template.
     """
-    videos = Video.objects.get_most_viewed(limit=5)
-    # Show the latest 5 upcoming videos sorted by their view numbers
-    upcoming_videos = sorted(
-        Video.objects.all_upcoming().order_by('-date_uploaded')[:5],
-        key=lambda v: -v.views)
+    videos = prefetch_submitters(Video.objects.get_most_viewed(limit=5))
+    # Show the 5 most viewed upcoming videos, the latest ones first when
+    # the view numbers are the same
+    upcoming_videos = prefetch_submitters(
+        Video.objects.all_upcoming().order_by(
+            '-view_count', '-date_uploaded')[:5])
     return render_to_response('distance_learning/index.html',
                               {'videos': videos,
                                'upcoming_videos': upcoming_videos},
@@ -269,18 +273,6 @@ def video_autocomplete_search(request):
                         content_type='application/json')
 
 
-def _paginate_video_set(query_set, page_number=1):
-    VIDEOS_PER_PAGE = 6
-    paginator = Paginator(query_set, VIDEOS_PER_PAGE)
-    try:
-        page = paginator.page(page_number)
-    except PageNotAnInteger:
-        page = paginator.page(1)
-    except EmptyPage:
-        page = None
-    return page
-
-
 def video_search(request):
     """
     A view which shows videos matching a search query.
@@ -290,8 +282,10 @@ def video_search(request):
     videos = tuple(sorted((video.object for video in videos),
                           key=lambda v: -v.views))
     page_number = request.GET.get('page', 1)
-    page = _paginate_video_set(videos,
-                               page_number=page_number)
+    page = paginate_video_set(videos,
+                              page_number=page_number)
+    if page is not None:
+        page.object_list = prefetch_submitters(page.object_list)
     return render_to_response(
         'distance_learning/video_list.html', {
             'videos': page,
@@ -309,19 +303,41 @@ def browse(request):
 
 def all_videos(request):
     """
-    A view which renders all videos on a page.
-    """
-    # TODO: Pagination.
-    # Categorize them
-    categorized_videos = {}
-    for video in Video.objects.all_approved():
-        if video.video_type not in categorized_videos:
-            categorized_videos[video.video_type] = []
-        categorized_videos[video.video_type].append(video)
+    A view which renders all videos grouped by their type, one type at a
+    time.  The types and their numbers of videos are listed; only a page of
+    the videos of the selected type (the `type` parameter, the first type
+    by default) is loaded.  AJAX requests get the page as JSON so that the
+    sections can be loaded lazily.
+    """
+    video_types = list(Video.objects.approved_types())
+    if 'type' in request.GET:
+        try:
+            type_pk = int(request.GET['type'])
+        except ValueError:
+            raise Http404
+        selected_type = get_object_or_404(VideoType, pk=type_pk)
+    elif video_types:
+        selected_type = video_types[0]
+    else:
+        selected_type = None
+
+    videos = Video.objects.all_approved().filter(
+        video_type=selected_type).select_related(
+            'video_type').order_by('-date_uploaded')
+    if request.is_ajax():
+        page = paginate_video_request(request, videos)
+        return render_to_json_response(_build_response(page))
+
+    page = None
+    if selected_type is not None:
+        page = paginate_video_set(videos, request.GET.get('page', 1))
+        if page is None:
+            raise Http404
     return render_to_response(
         'distance_learning/all_videos.html',
-        {'videos': Video.objects.filter(approved=True),
-         'categorized_videos': categorized_videos},
+        {'video_types': video_types,
+         'selected_type': selected_type,
+         'videos': page},
         context_instance=RequestContext(request))
 
 
@@ -329,14 +345,23 @@ def _build_response(page):
     """
     Builds a response as a JSON encoded dictionary with a list of videos
     and additionaly information about total videos found, the current page.
+    Pages paginated by cursor carry the cursors of the next and previous
+    pages instead of the page number.
     """
     videos = [] if page is None else page.object_list
     response = {
         'status': 'ok',
-        'videos': [video.to_dict() for video in videos],
-        'total': page.paginator.count,
-        'page': page.number,
+        'videos': videos_to_dicts(videos),
     }
+    if isinstance(page, CursorPage):
+        response['total'] = page.total
+        if page.next_cursor is not None:
+            response['next'] = page.next_cursor
+        if page.prev_cursor is not None:
+            response['prev'] = page.prev_cursor
+    elif page is not None:
+        response['total'] = page.paginator.count
+        response['page'] = page.number
     return response
 
 
@@ -380,8 +405,8 @@ def subcategory_search_json(request, category_name, subcategory_id):
         })
 
     category = category_manager.get(pk=subcategory_id)
-    page_number = request.GET.get('page', 1)
-    page = paginate_video_set(category.video_set.all_approved(), page_number)
+    page = paginate_video_request(request,
+                                  category.video_set.all_approved())
 
     return render_to_json_response(_build_response(page))
 
@@ -391,9 +416,18 @@ def most_viewed_videos_json(request):
     A view returning a JSON encoded list of the most viewed videos.
     """
     limit = request.GET.get('limit', None)
-    page_number = request.GET.get('page', 1)
-    page = paginate_video_set(Video.objects.get_most_viewed(limit=limit),
-                              page_number)
+    page = paginate_video_request(request,
+                                  Video.objects.get_most_viewed(limit=limit))
+    return render_to_json_response(_build_response(page))
+
+
+def trending_videos_json(request):
+    """
+    A view returning a JSON encoded list of the trending videos.
+    """
+    limit = request.GET.get('limit', None)
+    page = paginate_video_request(request,
+                                  Video.objects.get_trending(limit=limit))
     return render_to_json_response(_build_response(page))
 
 
@@ -402,9 +436,8 @@ def recent_videos_json(request):
     A view returning a JSON encoded list of the most recent videos.
     """
     limit = request.GET.get('limit', None)
-    page_number = request.GET.get('page', 1)
-    page = paginate_video_set(Video.objects.get_recent(limit=limit),
-                              page_number)
+    page = paginate_video_request(request,
+                                  Video.objects.get_recent(limit=limit))
 
     return render_to_json_response(_build_response(page))
 
@@ -440,6 +473,7 @@ def subcategory_search(request, category_name, subcategory_id):
     page = paginate_video_set(category.video_set.all_approved(), page_number)
     if page is None:
         raise Http404
+    page.object_list = prefetch_submitters(page.object_list)
 
     return render(request, 'distance_learning/browse.html', {
         'categories': [
@@ -468,6 +502,7 @@ def most_viewed_videos(request):
                               page_number)
     if page is None:
         raise Http404
+    page.object_list = prefetch_submitters(page.object_list)
 
     return render(request, 'distance_learning/browse.html', {
         'videos': page,
@@ -476,6 +511,27 @@ def most_viewed_videos(request):
     })
 
 
+def trending_videos(request):
+    """
+    """
+    if request.is_ajax():
+        return trending_videos_json(request)
+
+    limit = request.GET.get('limit', None)
+    page_number = request.GET.get('page', 1)
+    page = paginate_video_set(Video.objects.get_trending(limit=limit),
+                              page_number)
+    if page is None:
+        raise Http404
+    page.object_list = prefetch_submitters(page.object_list)
+
+    return render(request, 'distance_learning/browse.html', {
+        'videos': page,
+        'pages': range(page.paginator.num_pages),
+        'trending': True,
+    })
+
+
 def recent_videos(request):
     """
     """
@@ -488,6 +544,7 @@ def recent_videos(request):
                               page_number)
     if page is None:
         raise Http404
+    page.object_list = prefetch_submitters(page.object_list)
 
     return render(request, 'distance_learning/browse.html', {
         'videos': page,
@@ -2,7 +2,7 @@ from django.conf.urls import patterns, include, url
 from django.core.urlresolvers import reverse
 from django.views.generic import TemplateView
 
-from hitcount.views import update_hit_count_ajax
+from hitcount.views import update_hit_count_ajax, update_hit_counts_beacon
 
 # Uncomment the next two lines to enable the admin:
 from django.contrib import admin
@@ -112,6 +112,9 @@ urlpatterns += patterns('',
     url(r'^browse/video/most-viewed/$',
         'distance_learning.views.most_viewed_videos',
         name='dl-video-most-viewed'),
+    url(r'^browse/video/trending/$',
+        'distance_learning.views.trending_videos',
+        name='dl-video-trending'),
     url(r'^browse/video/category/(?P<category_name>[a-zA-Z]+)/$',
         'distance_learning.views.category_search',
         name='dl-video-category-search'),
@@ -143,6 +146,9 @@ urlpatterns += patterns('',
     url(r'^api/video/most-viewed/$',
         'distance_learning.views.most_viewed_videos_json',
         name='dl-video-most-viewed-json'),
+    url(r'^api/video/trending/$',
+        'distance_learning.views.trending_videos_json',
+        name='dl-video-trending-json'),
     url(r'^api/video/category/(?P<category_name>[a-zA-Z]+)/$',
         'distance_learning.views.category_search_json',
         name='dl-video-category-search-json'),
@@ -190,6 +196,9 @@ urlpatterns += patterns('',
     url(r'^ajax/hit/$',
         update_hit_count_ajax,
         name='hitcount_update_ajax'),
+    url(r'^ajax/hits/$',
+        update_hit_counts_beacon,
+        name='hitcount_update_beacon'),
 )
 
 # Email confirmation patterns
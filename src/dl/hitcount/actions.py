@@ -1,26 +1,69 @@
+from django.conf import settings
 from django.core.exceptions import PermissionDenied
-from hitcount.models import BlacklistIP, BlacklistUserAgent
+from hitcount.models import Hit, BlacklistIP, BlacklistUserAgent
+from hitcount.utils import IP_BITS, parse_ip, format_network
+from hitcount import blacklist
+
+def _selected_ips(queryset):
+    '''
+    Returns the distinct IP addresses of the hits.
+    '''
+    # values_list() returns the packed addresses
+    ip_field = Hit._meta.get_field('ip')
+    ips = set(ip_field.to_python(ip)
+              for ip in queryset.values_list('ip', flat=True).distinct())
+    ips.discard(None)
+    return ips
 
 def blacklist_ips(modeladmin, request, queryset):
-    for obj in queryset:
-       ip, created = BlacklistIP.objects.get_or_create(ip=obj.ip)
-       if created:
-           ip.save()
+    for ip in _selected_ips(queryset):
+        # no need for an entry if a blacklisted network already covers it
+        if blacklist.blacklist.match_ip(ip) is None:
+            BlacklistIP.objects.get_or_create(ip=ip)
+    blacklist.invalidate()
     msg = "Successfully blacklisedt %d IPs." % queryset.count() 
     modeladmin.message_user(request, msg)
 blacklist_ips.short_description = "BLACKLIST the selected IP ADDRESSES"
 
+def blacklist_ip_ranges(modeladmin, request, queryset):
+    """
+    Blacklists the networks the selected IP addresses belong to.  The size
+    of the networks is set by HITCOUNT_BLACKLIST_PREFIXLEN, a dict mapping
+    the IP version to the prefix length, by default /24 for IPv4 and /64
+    for IPv6 addresses.
+    """
+    prefixlens = getattr(settings, 'HITCOUNT_BLACKLIST_PREFIXLEN',
+                         {4: 24, 6: 64})
+    networks = set()
+    for ip in _selected_ips(queryset):
+        parsed = parse_ip(ip)
+        if parsed is None:
+            continue
+        version, address = parsed
+        prefixlen = prefixlens[version]
+        host_mask = (1 << (IP_BITS[version] - prefixlen)) - 1
+        networks.add(format_network(version, address & ~host_mask, prefixlen))
+    for network in networks:
+        BlacklistIP.objects.get_or_create(ip=network)
+    blacklist.invalidate()
+    msg = "Successfully blacklisted %d IP ranges." % len(networks)
+    modeladmin.message_user(request, msg)
+blacklist_ip_ranges.short_description = "BLACKLIST the IP RANGES of the " + \
+                                        "selected hits"
+
 def blacklist_user_agents(modeladmin, request, queryset):
-    for obj in queryset:
+    for user_agent in set(queryset.values_list('agent__user_agent',
+                                               flat=True)):
        ua, created = BlacklistUserAgent.objects.get_or_create(
-                        user_agent=obj.user_agent)
+                        user_agent=user_agent)
        if created:
            ua.save()
+    blacklist.invalidate()
     msg = "Successfully blacklisted %d User Agents." % queryset.count() 
     modeladmin.message_user(request, msg)
 blacklist_user_agents.short_description = "BLACKLIST the selected USER AGENTS"
 
-def delete_queryset(modeladmin, request, queryset):
+def delete_queryset(modeladmin, request, queryset, save_hitcount=False):
     # TODO 
     #
     # Right now, when you delete a hit there is no warning or "turing back".
@@ -30,17 +73,21 @@ def delete_queryset(modeladmin, request, queryset):
     if not modeladmin.has_delete_permission(request):
         raise PermissionDenied
     else:
-        if queryset.count() == 1:
+        count = Hit.objects.delete_hits(queryset,
+                                        save_hitcount=save_hitcount)
+        if count == 1:
             msg = "1 hit was"
         else:
-            msg = "%s hits were" % queryset.count()
-
-        for obj in queryset.iterator():
-            obj.delete() # calling it this way to get custom delete() method
+            msg = "%s hits were" % count
 
         modeladmin.message_user(request, "%s successfully deleted." % msg)
 delete_queryset.short_description = "DELETE selected hits"
 
+def delete_queryset_save_hitcount(modeladmin, request, queryset):
+    delete_queryset(modeladmin, request, queryset, save_hitcount=True)
+delete_queryset_save_hitcount.short_description = "DELETE selected hits " + \
+                                                  "but KEEP the hit counts"
+
 def blacklist_delete_ips(modeladmin, request, queryset):
     blacklist_ips(modeladmin, request, queryset)
     delete_queryset(modeladmin, request, queryset)
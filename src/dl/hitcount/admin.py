@@ -1,7 +1,16 @@
 from django.contrib import admin
+from django.contrib.admin.views.main import SEARCH_VAR
+from django.conf.urls import patterns, url
+from django.core.exceptions import PermissionDenied
+from django.http import HttpResponseRedirect
+from django.shortcuts import render_to_response
+from django.template import RequestContext
 
 from hitcount.models import Hit, HitCount, BlacklistIP, BlacklistUserAgent
+from hitcount.utils import parse_ip
+from hitcount.heavyhitters import get_heavy_hitters
 from hitcount import actions
+from hitcount import blacklist
 
 def created_format(obj):
     '''
@@ -15,19 +24,74 @@ created_format.admin_order_field = 'created'
 
 class HitAdmin(admin.ModelAdmin):
     list_display = (created_format,'user','ip','user_agent','hitcount')
-    search_fields = ('ip','user_agent')
+    list_select_related = True
+    # IP addresses are stored packed, so searching for an address is turned
+    # into an exact lookup by `changelist_view`
+    search_fields = ('agent__user_agent',)
     date_hierarchy = 'created'
     actions = [ actions.blacklist_ips,
+                actions.blacklist_ip_ranges,
                 actions.blacklist_user_agents,
                 actions.blacklist_delete_ips,
                 actions.blacklist_delete_user_agents,
                 actions.delete_queryset,
+                actions.delete_queryset_save_hitcount,
                 ]
 
     def __init__(self, *args, **kwargs):
         super(HitAdmin, self).__init__(*args, **kwargs)
         self.list_display_links = (None,)
 
+    def changelist_view(self, request, extra_context=None):
+        query = request.GET.get(SEARCH_VAR, '').strip()
+        if parse_ip(query) is not None:
+            request.GET = request.GET.copy()
+            del request.GET[SEARCH_VAR]
+            request.GET['ip'] = query
+        return super(HitAdmin, self).changelist_view(request, extra_context)
+
+    def get_urls(self):
+        urls = super(HitAdmin, self).get_urls()
+        return patterns('',
+            url(r'^heavy-hitters/$',
+                self.admin_site.admin_view(self.heavy_hitters_view),
+                name='hitcount_hit_heavy_hitters'),
+        ) + urls
+
+    def heavy_hitters_view(self, request):
+        '''
+        Lists the IP addresses and User Agents which currently make the
+        most requests to the hit endpoint (see `hitcount.heavyhitters`)
+        and blacklists the one POSTed as `ip` or `user_agent`.
+        '''
+        if request.method == 'POST':
+            for field, model in (('ip', BlacklistIP),
+                                 ('user_agent', BlacklistUserAgent)):
+                value = request.POST.get(field)
+                if value is None:
+                    continue
+                if not request.user.has_perm('hitcount.add_%s' %
+                                             model._meta.module_name):
+                    raise PermissionDenied
+                model.objects.get_or_create(**{field: value})
+                self.message_user(request, "Successfully blacklisted %s." %
+                                  value)
+            return HttpResponseRedirect(request.path)
+
+        heavy_hitters = get_heavy_hitters()
+        ips = [row + (blacklist.blacklist.match_ip(row[0]) is not None,)
+               for row in heavy_hitters.top('ip')]
+        user_agents = [row + (row[0] in blacklist.blacklist.user_agents,)
+                       for row in heavy_hitters.top('user_agent')]
+        return render_to_response('admin/hitcount/heavy_hitters.html', {
+                'title': "Heavy hitters",
+                'opts': self.model._meta,
+                'app_label': self.model._meta.app_label,
+                'window': heavy_hitters.window,
+                'ips': ips,
+                'user_agents': user_agents,
+            }, context_instance=RequestContext(request))
+
     def get_actions(self, request):
         # Override the default `get_actions` to ensure that our model's
         # `delete()` method is called.
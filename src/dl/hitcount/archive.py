@@ -0,0 +1,291 @@
+'''
+A columnar archive of hits for offline analysis.
+
+`hitcount_cleanup` deletes hits older than HITCOUNT_KEEP_HIT_IN_DATABASE and
+with them all per-hit detail.  The `hitcount_archive` command (run it before
+`hitcount_cleanup`) copies those hits into NumPy files first; with
+HITCOUNT_ARCHIVE_DIR set, `hitcount_cleanup` only deletes archived hits:
+
+    <archive>/<YYYY-MM>/<first pk>-<last pk>/
+        created.npy      hit time, seconds since the epoch (UTC)
+        hitcount.npy     HitCount pk
+        user.npy         User pk, -1 for anonymous hits
+        session.npy      Hit.session_hash
+        ip.npy           index into ips.npy, -1 for unknown addresses
+        agent.npy        index into user_agents.npy
+        ips.npy          the distinct IP addresses, packed (16 bytes)
+        user_agents.npy  the distinct User Agents, UTF-8 encoded
+        hitcounts.npy    pk, content type ('app_label.model') and object pk
+                         of the segment's HitCounts
+
+Each run adds segments, partitioned by the month the hits were made in, and
+picks up after the highest pk archived so far.  `HitArchive` answers
+aggregate queries from the memory-mapped files with vectorized NumPy
+operations, without touching the database.
+
+NumPy is only needed for archiving and reading archives.
+'''
+import calendar
+import datetime
+import glob
+import os
+import re
+import shutil
+from collections import defaultdict
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from hitcount.utils import unpack_ip
+
+SEGMENT_RE = re.compile(r'^(\d+)-(\d+)$')
+
+
+def _timestamp(when):
+    return calendar.timegm(when.timetuple())
+
+
+def last_archived_pk(path):
+    '''
+    Returns the highest hit pk stored in the archive at `path` (0 if
+    there is none).
+    '''
+    last = 0
+    for segment in glob.glob(os.path.join(path, '*', '*')):
+        match = SEGMENT_RE.match(os.path.basename(segment))
+        if match:
+            last = max(last, int(match.group(2)))
+    return last
+
+
+def _string_dtype(values):
+    return 'S%d' % max([1] + [len(value) for value in values])
+
+
+def _intern(values):
+    '''
+    Returns the distinct values and, for every value, the index of its
+    distinct value.  None is mapped to -1.
+    '''
+    table = {}
+    indexes = []
+    for value in values:
+        if value is None:
+            indexes.append(-1)
+        else:
+            indexes.append(table.setdefault(value, len(table)))
+    distinct = [None] * len(table)
+    for value, index in table.items():
+        distinct[index] = value
+    return distinct, indexes
+
+
+def write_segment(path, rows, hitcounts):
+    '''
+    Writes a segment of hits to the month directory of the archive at
+    `path`.  `rows` are (pk, created, hitcount pk, user pk, session hash,
+    packed ip, User Agent) tuples of one month ordered by pk; `hitcounts`
+    maps HitCount pks to (content type, object pk) pairs.
+
+    The segment is written to a temporary directory first and renamed when
+    complete, so readers never see partial segments.
+    '''
+    month = rows[0][1].strftime('%Y-%m')
+    name = '%012d-%012d' % (rows[0][0], rows[-1][0])
+    month_dir = os.path.join(path, month)
+    if not os.path.isdir(month_dir):
+        os.makedirs(month_dir)
+    tmp_dir = os.path.join(month_dir, '.tmp-' + name)
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    ips, ip_indexes = _intern(row[5] for row in rows)
+    user_agents, agent_indexes = _intern(row[6].encode('utf-8')
+                                         for row in rows)
+    columns = {
+        'created': numpy.array([_timestamp(row[1]) for row in rows],
+                               dtype=numpy.int64),
+        'hitcount': numpy.array([row[2] for row in rows], dtype=numpy.int32),
+        'user': numpy.array([-1 if row[3] is None else row[3]
+                             for row in rows], dtype=numpy.int32),
+        'session': numpy.array([row[4] for row in rows], dtype=numpy.int64),
+        'ip': numpy.array(ip_indexes, dtype=numpy.int32),
+        'agent': numpy.array(agent_indexes, dtype=numpy.int32),
+        'ips': numpy.array(ips, dtype='S16'),
+        'user_agents': numpy.array(user_agents,
+                                   dtype=_string_dtype(user_agents)),
+    }
+    pks = sorted(set(row[2] for row in rows))
+    content_types = []
+    object_pks = []
+    for pk in pks:
+        content_type, object_pk = hitcounts.get(pk, ('', ''))
+        content_types.append(content_type)
+        object_pks.append(object_pk.encode('utf-8'))
+    columns['hitcounts'] = numpy.array(
+        zip(pks, content_types, object_pks),
+        dtype=[('pk', numpy.int32),
+               ('content_type', _string_dtype(content_types)),
+               ('object_pk', _string_dtype(object_pks))])
+    for column, values in columns.items():
+        numpy.save(os.path.join(tmp_dir, column + '.npy'), values)
+    final_dir = os.path.join(month_dir, name)
+    if os.path.isdir(final_dir):
+        shutil.rmtree(final_dir)
+    os.rename(tmp_dir, final_dir)
+    return final_dir
+
+
+class HitArchive(object):
+    '''
+    Aggregate queries over an archive written by `hitcount_archive`.
+
+    All queries take an optional `start` and `end` (naive UTC datetimes,
+    `end` excluded) and only open the months they overlap.
+    '''
+
+    def __init__(self, path):
+        if numpy is None:
+            raise ImportError("Reading hit archives requires NumPy.")
+        self.path = path
+
+    def months(self):
+        return sorted(os.path.basename(month) for month in
+                      glob.glob(os.path.join(self.path, '[0-9]*-[0-9]*')))
+
+    def _segments(self, start=None, end=None):
+        first = start and start.strftime('%Y-%m')
+        last = end and end.strftime('%Y-%m')
+        for month in self.months():
+            if (first and month < first) or (last and month > last):
+                continue
+            for segment in sorted(glob.glob(os.path.join(self.path, month,
+                                                         '[0-9]*'))):
+                yield _Segment(segment)
+
+    def _mask(self, segment, start, end, hitcount_pks=None):
+        '''
+        Returns a boolean array selecting the segment's hits within the
+        period (and on one of the given HitCounts).
+        '''
+        created = segment['created']
+        mask = numpy.ones(len(created), dtype=bool)
+        if start is not None:
+            mask &= created >= _timestamp(start)
+        if end is not None:
+            mask &= created < _timestamp(end)
+        if hitcount_pks is not None:
+            mask &= numpy.in1d(segment['hitcount'], list(hitcount_pks))
+        return mask
+
+    def _selected(self, start, end, hitcount_pks=None):
+        for segment in self._segments(start, end):
+            yield segment, self._mask(segment, start, end, hitcount_pks)
+
+    def hits_per_hitcount(self, start=None, end=None):
+        '''
+        Returns a dict mapping HitCount pks to their number of hits.
+        '''
+        counts = defaultdict(int)
+        for segment, mask in self._selected(start, end):
+            pks, hits = numpy.unique(segment['hitcount'][mask],
+                                     return_counts=True)
+            for pk, n in zip(pks.tolist(), hits.tolist()):
+                counts[pk] += n
+        return dict(counts)
+
+    def hits_per_object(self, content_type, start=None, end=None):
+        '''
+        Returns a dict mapping the object pks of a model, given as
+        'app_label.model' (eg, 'distance_learning.video'), to their number
+        of hits.
+        '''
+        counts = defaultdict(int)
+        for segment in self._segments(start, end):
+            objects = segment['hitcounts']
+            objects = objects[objects['content_type'] == content_type]
+            object_pks = dict(zip(objects['pk'].tolist(),
+                                  objects['object_pk'].tolist()))
+            mask = self._mask(segment, start, end, object_pks.keys())
+            pks, hits = numpy.unique(segment['hitcount'][mask],
+                                     return_counts=True)
+            for pk, n in zip(pks.tolist(), hits.tolist()):
+                counts[object_pks[pk].decode('utf-8')] += n
+        return dict(counts)
+
+    def hits_per_day(self, hitcount_pks=None, start=None, end=None):
+        '''
+        Returns a dict mapping dates (UTC) to the number of hits made on
+        them, on all HitCounts or only on the given ones.
+        '''
+        counts = defaultdict(int)
+        for segment, mask in self._selected(start, end, hitcount_pks):
+            days, hits = numpy.unique(segment['created'][mask] // 86400,
+                                      return_counts=True)
+            for day, n in zip(days.tolist(), hits.tolist()):
+                counts[datetime.date(1970, 1, 1) +
+                       datetime.timedelta(days=day)] += n
+        return dict(counts)
+
+    def unique_visitors(self, hitcount_pks=None, start=None, end=None):
+        '''
+        Returns the number of distinct sessions (or users, for
+        authenticated hits) which made hits.
+        '''
+        sessions = []
+        users = []
+        for segment, mask in self._selected(start, end, hitcount_pks):
+            user = segment['user'][mask]
+            users.append(numpy.unique(user[user >= 0]))
+            sessions.append(numpy.unique(segment['session'][mask][user < 0]))
+        if not sessions:
+            return 0
+        return (len(numpy.unique(numpy.concatenate(users))) +
+                len(numpy.unique(numpy.concatenate(sessions))))
+
+    def top_user_agents(self, limit=10, start=None, end=None):
+        '''
+        Returns a list of the `limit` User Agents with the most hits as
+        (User Agent, hits) pairs.
+        '''
+        counts = defaultdict(int)
+        for segment, mask in self._selected(start, end):
+            agents, hits = numpy.unique(segment['agent'][mask],
+                                        return_counts=True)
+            names = segment['user_agents']
+            for agent, n in zip(agents.tolist(), hits.tolist()):
+                counts[names[agent].decode('utf-8')] += n
+        return sorted(counts.items(), key=lambda item: -item[1])[:limit]
+
+    def top_ips(self, limit=10, start=None, end=None):
+        '''
+        Returns a list of the `limit` IP addresses with the most hits as
+        (IP address, hits) pairs.
+        '''
+        counts = defaultdict(int)
+        for segment, mask in self._selected(start, end):
+            ips = segment['ip'][mask]
+            ips, hits = numpy.unique(ips[ips >= 0], return_counts=True)
+            table = segment['ips']
+            for ip, n in zip(ips.tolist(), hits.tolist()):
+                counts[unpack_ip(table[ip].ljust(16, '\0'))] += n
+        return sorted(counts.items(), key=lambda item: -item[1])[:limit]
+
+
+class _Segment(object):
+    '''
+    Lazily memory-maps the columns of an archive segment.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._columns = {}
+
+    def __getitem__(self, column):
+        if column not in self._columns:
+            self._columns[column] = numpy.load(
+                os.path.join(self.path, column + '.npy'), mmap_mode='r')
+        return self._columns[column]
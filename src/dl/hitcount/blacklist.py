@@ -0,0 +1,136 @@
+'''
+A process-local copy of the IP and User Agent blacklists.
+
+Checking every hit against the BlacklistIP and BlacklistUserAgent tables
+costs two queries per hit.  Instead, both blacklists are loaded into sets
+once and reused for as long as the blacklist generation stored in the cache
+does not change.  Saving or deleting a blacklist entry bumps the generation
+(see the signal receivers in hitcount.models) which makes every process
+reload the sets the next time they are used.
+
+IP blacklist entries may be single addresses or IPv4/IPv6 networks in CIDR
+notation (10.1.2.0/24).  They are compiled into one prefix tree per IP
+version so an address is checked in constant time regardless of how many
+entries there are.
+
+Note that the generation is only shared between processes if the cache
+backend is (memcached, database, ...; see CACHES in local_settings.py).
+With a per-process cache (LocMemCache, the default) or one which doesn't
+keep anything (DummyCache) other processes don't see the generation change,
+so every process also reloads its copy at least every RELOAD_INTERVAL
+seconds.
+'''
+import threading
+import time
+
+from django.core.cache import cache
+
+from hitcount.prefixtree import PrefixTree
+from hitcount.utils import IP_BITS, parse_ip, parse_network
+
+GENERATION_KEY = 'hitcount:blacklist:generation'
+GENERATION_TIMEOUT = 60 * 60 * 24 * 30
+# The longest time a process uses its copy without reloading it
+RELOAD_INTERVAL = 60
+
+
+def _get_generation():
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        # Start from a value which no process could have seen before in
+        # case the key was evicted.
+        cache.add(GENERATION_KEY, int(time.time() * 1000),
+                  GENERATION_TIMEOUT)
+        generation = cache.get(GENERATION_KEY)
+    return generation
+
+
+def invalidate():
+    '''
+    Bumps the blacklist generation forcing all processes to reload the
+    blacklists.
+    '''
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        _get_generation()
+    # In case the cache doesn't keep the generation
+    blacklist.loaded_at = None
+
+
+class Blacklist(object):
+    '''
+    Holds the blacklisted IPs and User Agents of a single generation.
+    '''
+
+    def __init__(self):
+        self.generation = None
+        self.loaded_at = None
+        self.networks = {}
+        self.ips = frozenset()
+        self.user_agents = frozenset()
+        self._lock = threading.Lock()
+
+    def load(self):
+        from hitcount.models import BlacklistIP, BlacklistUserAgent
+        networks = dict((version, PrefixTree(bits))
+                        for version, bits in IP_BITS.items())
+        # Entries which can't be parsed are still matched exactly
+        ips = set()
+        for entry in BlacklistIP.objects.values_list('ip', flat=True):
+            try:
+                version, network, prefixlen = parse_network(entry)
+            except ValueError:
+                ips.add(entry)
+            else:
+                networks[version].insert(network, prefixlen, entry)
+        self.networks = networks
+        self.ips = frozenset(ips)
+        self.user_agents = frozenset(
+            BlacklistUserAgent.objects.values_list('user_agent', flat=True))
+
+    def refresh(self):
+        '''
+        Reloads the blacklists if the generation changed since they were
+        last loaded or they were loaded RELOAD_INTERVAL seconds ago.
+        '''
+        generation = _get_generation()
+        stale = (self.loaded_at is None or
+                 time.time() - self.loaded_at >= RELOAD_INTERVAL or
+                 # the cache might not keep the generation
+                 (generation is not None and generation != self.generation))
+        if stale:
+            with self._lock:
+                self.load()
+                self.generation = generation
+                self.loaded_at = time.time()
+
+    def match_ip(self, ip, refresh=True):
+        '''
+        Returns the most specific blacklist entry matching the IP address or
+        None if the address is not blacklisted.  With `refresh` False, the
+        blacklists loaded last are used without checking the generation.
+        '''
+        if refresh:
+            self.refresh()
+        if ip in self.ips:
+            return ip
+        parsed = parse_ip(ip)
+        if parsed is None:
+            return None
+        version, address = parsed
+        return self.networks[version].longest_match(address)
+
+    def is_blacklisted(self, ip, user_agent, refresh=True):
+        return (self.match_ip(ip, refresh) is not None or
+                user_agent in self.user_agents)
+
+
+blacklist = Blacklist()
+
+
+def is_blacklisted(ip, user_agent):
+    '''
+    Returns True if either the IP address or the User Agent is blacklisted.
+    '''
+    return blacklist.is_blacklisted(ip, user_agent)
@@ -0,0 +1,304 @@
+'''
+Write-behind buffering of hits.
+
+By default every accepted hit is written to the database right away which
+means an UPDATE of the (frequently shared) HitCount row followed by an INSERT
+into the Hit table.  When buffering is enabled, accepted hits are queued
+instead and written in batches by `HitManager.record_hits`.
+
+Enable it in settings.py:
+
+    HITCOUNT_BUFFER = 'local'   # a bounded, per-process buffer
+    HITCOUNT_BUFFER = 'cache'   # a buffer shared through the django cache
+
+Optional settings:
+
+    HITCOUNT_BUFFER_MAX_SIZE = 10000     # hits beyond this are dropped
+    HITCOUNT_BUFFER_FLUSH_SIZE = 500     # flush once this many are queued
+    HITCOUNT_BUFFER_FLUSH_INTERVAL = 10  # ... or this many seconds passed
+
+A buffer is flushed by whichever request pushes it over the flush size or
+interval and at interpreter shutdown.  The `hitcount_flush` management
+command can be run from a cronjob to flush a shared buffer on idle sites.
+'''
+import atexit
+import datetime
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DatabaseError
+
+from hitcount.models import Hit
+
+
+def hit_to_facts(hit):
+    '''
+    Returns the facts of an unsaved hit as a tuple which can be pickled
+    cheaply (for the cache or the task queue).
+    '''
+    return (hit.hitcount_id, hit.created, hit.ip, hit.session_hash,
+            hit.user_agent, hit.user_id)
+
+
+def hit_from_facts(facts):
+    '''
+    Returns an unsaved hit made from the tuple returned by `hit_to_facts`.
+    '''
+    hitcount_pk, created, ip, session_hash, user_agent, user_pk = facts
+    return Hit(hitcount_id=hitcount_pk, created=created, ip=ip,
+               session_hash=session_hash, user_agent=user_agent,
+               user_id=user_pk)
+
+
+def _dedupe_key(hit):
+    '''
+    Returns the key identifying a visitor's hit on a HitCount -- the same
+    criteria `_update_hit_count` uses when looking for earlier hits.
+    '''
+    if hit.user_id is not None:
+        return (hit.hitcount_id, 'u', hit.user_id)
+    return (hit.hitcount_id, 's', hit.session_hash)
+
+
+class LocalHitBuffer(object):
+    '''
+    A bounded buffer of hits local to the current process.
+    '''
+
+    def __init__(self, max_size, flush_size, flush_interval):
+        self.max_size = max_size
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.flushed = 0
+        self.dropped = 0
+        self._hits = []
+        self._pending = set()
+        self._last_flush = time.time()
+        self._lock = threading.Lock()
+
+    def add(self, hit):
+        '''
+        Queues the hit.  Returns False if the hit was not accepted, either
+        because the same visitor already has a hit pending on the HitCount
+        or because the buffer is full.
+        '''
+        if not hit.created:
+            hit.created = datetime.datetime.utcnow()
+        key = _dedupe_key(hit)
+        with self._lock:
+            if key in self._pending:
+                return False
+            if len(self._hits) >= self.max_size:
+                self.dropped += 1
+                return False
+            self._hits.append(hit)
+            self._pending.add(key)
+            flush = (len(self._hits) >= self.flush_size or
+                     time.time() - self._last_flush >= self.flush_interval)
+        if flush:
+            self.flush()
+        return True
+
+    def flush(self):
+        '''
+        Writes all queued hits to the database.  Returns the number of hits
+        written.
+        '''
+        with self._lock:
+            hits, self._hits = self._hits, []
+            self._pending = set()
+            self._last_flush = time.time()
+        if not hits:
+            return 0
+        try:
+            Hit.objects.record_hits(hits)
+        except DatabaseError:
+            self.dropped += len(hits)
+            return 0
+        self.flushed += len(hits)
+        return len(hits)
+
+    def stats(self):
+        return {
+            'queued': len(self._hits),
+            'flushed': self.flushed,
+            'dropped': self.dropped,
+        }
+
+
+class CacheHitBuffer(object):
+    '''
+    A bounded buffer of hits shared by all processes using the same cache.
+
+    Hits are stored in numbered cache slots.  The `head` counter is the
+    number of the last slot claimed and `tail` the last slot flushed.
+    A slot is claimed before it is written, so a flush stops at the first
+    empty slot: its hit is probably being written.  Only a slot which
+    stays empty for GAP_TIMEOUT seconds (it expired, or the process
+    writing it died) is skipped and counted as dropped.
+    '''
+    KEY_PREFIX = 'hitcount:buffer:'
+    COUNTER_TIMEOUT = 60 * 60 * 24 * 30
+    GAP_TIMEOUT = 5
+
+    def __init__(self, max_size, flush_size, flush_interval):
+        self.max_size = max_size
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        # Slots need to outlive a couple of missed flushes
+        self.timeout = max(flush_interval * 10, 300)
+
+    def _key(self, *parts):
+        return self.KEY_PREFIX + ':'.join(str(part) for part in parts)
+
+    def _incr(self, name, delta=1):
+        key = self._key(name)
+        try:
+            return cache.incr(key, delta)
+        except ValueError:
+            cache.add(key, 0, self.COUNTER_TIMEOUT)
+            return cache.incr(key, delta)
+
+    def _get_counters(self, *names):
+        values = cache.get_many([self._key(name) for name in names])
+        return [values.get(self._key(name)) or 0 for name in names]
+
+    def _gap_expired(self, slot):
+        '''
+        Returns True if the empty slot was already found empty at least
+        GAP_TIMEOUT seconds ago.
+        '''
+        key = self._key('gap', slot)
+        cache.add(key, time.time(), self.timeout)
+        first_seen = cache.get(key)
+        return (first_seen is not None and
+                time.time() - first_seen >= self.GAP_TIMEOUT)
+
+    def add(self, hit):
+        '''
+        Queues the hit.  Returns False if the hit was not accepted, either
+        because the same visitor already has a hit pending on the HitCount
+        or because the buffer is full.
+        '''
+        if not hit.created:
+            hit.created = datetime.datetime.utcnow()
+        head, tail = self._get_counters('head', 'tail')
+        if head - tail >= self.max_size:
+            self._incr('dropped')
+            return False
+        if not cache.add(self._key('pending', *_dedupe_key(hit)), 1,
+                         self.timeout):
+            return False
+        slot = self._incr('head')
+        cache.set(self._key('hit', slot), hit_to_facts(hit), self.timeout)
+        last_flush, = self._get_counters('last_flush')
+        if (slot - tail >= self.flush_size or
+                time.time() - last_flush >= self.flush_interval):
+            self.flush()
+        return True
+
+    def flush(self):
+        '''
+        Writes all queued hits to the database.  Only one process flushes
+        at a time; others return right away.  Returns the number of hits
+        written.
+        '''
+        lock = self._key('lock')
+        if not cache.add(lock, 1, self.timeout):
+            return 0
+        try:
+            head, tail = self._get_counters('head', 'tail')
+            cache.set(self._key('last_flush'), int(time.time()),
+                      self.COUNTER_TIMEOUT)
+            if head < tail:
+                # The head counter was evicted from the cache and started
+                # over.
+                cache.set(self._key('tail'), 0, self.COUNTER_TIMEOUT)
+                return 0
+            if head == tail:
+                return 0
+            slots = range(tail + 1, head + 1)
+            values = cache.get_many([self._key('hit', slot)
+                                     for slot in slots])
+            hits = []
+            keys = []
+            pending = []
+            gaps = []
+            for slot in slots:
+                key = self._key('hit', slot)
+                if key not in values:
+                    if not self._gap_expired(slot):
+                        # Claimed but not written yet: flush up to it
+                        break
+                    gaps.append(self._key('gap', slot))
+                else:
+                    hit = hit_from_facts(values[key])
+                    hits.append(hit)
+                    pending.append(self._key('pending', *_dedupe_key(hit)))
+                keys.append(key)
+            if not keys:
+                return 0
+            try:
+                Hit.objects.record_hits(hits)
+            except DatabaseError:
+                self._incr('dropped', len(keys))
+                return 0
+            finally:
+                cache.set(self._key('tail'), tail + len(keys),
+                          self.COUNTER_TIMEOUT)
+                cache.delete_many(keys + pending + gaps)
+            if gaps:
+                self._incr('dropped', len(gaps))
+            if hits:
+                self._incr('flushed', len(hits))
+            return len(hits)
+        finally:
+            cache.delete(lock)
+
+    def stats(self):
+        head, tail, flushed, dropped = self._get_counters(
+            'head', 'tail', 'flushed', 'dropped')
+        return {
+            'queued': head - tail,
+            'flushed': flushed,
+            'dropped': dropped,
+        }
+
+
+BUFFER_CLASSES = {
+    'local': LocalHitBuffer,
+    'cache': CacheHitBuffer,
+}
+
+_hit_buffer = None
+
+
+def create_hit_buffer(kind):
+    '''
+    Returns a new hit buffer of the given kind ('local' or 'cache') sized
+    by the HITCOUNT_BUFFER_* settings.  The buffer is flushed when the
+    process exits.
+    '''
+    hit_buffer = BUFFER_CLASSES[kind](
+        max_size=getattr(settings, 'HITCOUNT_BUFFER_MAX_SIZE', 10000),
+        flush_size=getattr(settings, 'HITCOUNT_BUFFER_FLUSH_SIZE', 500),
+        flush_interval=getattr(settings, 'HITCOUNT_BUFFER_FLUSH_INTERVAL', 10))
+    # Don't lose the queued hits when the process exits
+    atexit.register(hit_buffer.flush)
+    return hit_buffer
+
+
+def get_hit_buffer():
+    '''
+    Returns the hit buffer configured by the HITCOUNT_BUFFER setting or None
+    if hits are not supposed to be buffered.
+    '''
+    global _hit_buffer
+    if _hit_buffer is None:
+        kind = getattr(settings, 'HITCOUNT_BUFFER', None)
+        if not kind:
+            return None
+        _hit_buffer = create_hit_buffer(kind)
+    return _hit_buffer
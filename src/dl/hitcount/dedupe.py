@@ -0,0 +1,117 @@
+'''
+Session-free deduplication of anonymous hits.
+
+By default an anonymous visitor is told apart by their session, which means
+a django_session row per visitor and a query over the active hits on every
+hit.  With
+
+    HITCOUNT_DEDUPE = 'cookie'
+
+the HitCounts an anonymous visitor was counted on are remembered in a
+signed cookie instead, together with a random visitor id which is stored
+(hashed) in Hit.session_hash.  The cookie holds at most
+HITCOUNT_COOKIE_MAX_ENTRIES (50 by default) HitCounts; the oldest ones are
+forgotten first and entries expire after HITCOUNT_KEEP_HIT_ACTIVE.
+
+Clients which don't keep cookies would be counted on every hit, so with
+
+    HITCOUNT_DEDUPE_CACHE = True
+
+a hash of the IP address, User Agent and HitCount is additionally kept in
+the cache for the same period.  Different visitors sharing an address and a
+browser (or a hash collision) are then counted once; an evicted entry lets
+a repeat hit through.
+'''
+import datetime
+import hashlib
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.encoding import smart_str
+from django.utils.http import base36_to_int, int_to_base36
+
+from hitcount.utils import timedelta_seconds
+
+COOKIE_SALT = 'hitcount.dedupe'
+
+
+def use_cookie():
+    return getattr(settings, 'HITCOUNT_DEDUPE', 'session') == 'cookie'
+
+
+def _window():
+    grace = getattr(settings, 'HITCOUNT_KEEP_HIT_ACTIVE', {'days': 7})
+    return timedelta_seconds(datetime.timedelta(**grace))
+
+
+class ViewedCookie(object):
+    '''
+    The visitor id and the recently counted HitCounts of an anonymous
+    visitor, stored as "<visitor>|<pk>.<timestamp>-<pk>.<timestamp>..."
+    (pks and timestamps in base 36).
+    '''
+
+    def __init__(self, visitor=None, viewed=None):
+        self.modified = visitor is None
+        self.visitor = visitor or uuid.uuid4().hex
+        # HitCount pk -> time it was counted
+        self.viewed = viewed or {}
+
+    @classmethod
+    def from_request(cls, request):
+        name = getattr(settings, 'HITCOUNT_COOKIE_NAME', 'hitcount')
+        value = request.get_signed_cookie(name, None, salt=COOKIE_SALT,
+                                          max_age=_window())
+        if not value:
+            return cls()
+        try:
+            visitor, entries = value.split('|', 1)
+            viewed = {}
+            for entry in filter(None, entries.split('-')):
+                pk, timestamp = entry.split('.')
+                viewed[base36_to_int(pk)] = base36_to_int(timestamp)
+        except ValueError:
+            return cls()
+        return cls(visitor, viewed)
+
+    def seen(self, hitcount_pk):
+        '''
+        Returns True if the visitor was counted on the HitCount within the
+        active window.
+        '''
+        timestamp = self.viewed.get(hitcount_pk)
+        return timestamp is not None and timestamp > time.time() - _window()
+
+    def add(self, hitcount_pk):
+        self.viewed[hitcount_pk] = int(time.time())
+        self.modified = True
+
+    def __str__(self):
+        max_entries = getattr(settings, 'HITCOUNT_COOKIE_MAX_ENTRIES', 50)
+        cutoff = time.time() - _window()
+        entries = sorted(((timestamp, pk)
+                          for pk, timestamp in self.viewed.items()
+                          if timestamp > cutoff), reverse=True)[:max_entries]
+        return '%s|%s' % (self.visitor, '-'.join(
+            '%s.%s' % (int_to_base36(pk), int_to_base36(timestamp))
+            for timestamp, pk in entries))
+
+    def set_on(self, response):
+        response.set_signed_cookie(
+            getattr(settings, 'HITCOUNT_COOKIE_NAME', 'hitcount'), str(self),
+            salt=COOKIE_SALT, max_age=_window(), httponly=True)
+
+
+def seen_recently(ip, user_agent, hitcount_pk):
+    '''
+    Marks the IP address and User Agent as seen on the HitCount in the
+    cache (HITCOUNT_DEDUPE_CACHE).  Returns True if they were seen there
+    within the active window already.
+    '''
+    if not getattr(settings, 'HITCOUNT_DEDUPE_CACHE', False):
+        return False
+    digest = hashlib.md5('%s|%s|%s' % (ip, smart_str(user_agent),
+                                       hitcount_pk)).hexdigest()[:16]
+    return not cache.add('hitcount:seen:' + digest, 1, _window())
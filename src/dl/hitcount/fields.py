@@ -0,0 +1,60 @@
+import sys
+
+from django.db import connection, models
+
+from hitcount.utils import parse_ip, pack_ip, unpack_ip
+
+
+class PackedIPAddressField(models.Field):
+    """
+    An IPv4 or IPv6 address stored in 16 bytes of binary data instead of up
+    to 39 characters.  Values are address strings in Python; strings which
+    are not valid IP addresses are stored as NULL.
+
+    Only exact lookups (exact, in, isnull) make sense on packed addresses.
+    """
+    __metaclass__ = models.SubfieldBase
+    description = "An IPv4 or IPv6 address stored as 16 bytes"
+
+    def db_type(self, connection):
+        return {
+            'mysql': 'varbinary(16)',
+            'postgresql': 'bytea',
+            'oracle': 'RAW(16)',
+        }.get(connection.vendor, 'blob')
+
+    # Backends whose DB-API module returns binary data as byte strings (and
+    # text as unicode) rather than as buffers
+    BYTES_VENDORS = ('mysql', 'oracle')
+
+    def to_python(self, value):
+        if value is None:
+            return None
+        # sqlite3 and psycopg2 return binary data as buffers
+        if isinstance(value, (buffer, bytearray)):
+            return unpack_ip(str(value))
+        # MySQLdb and cx_Oracle return it as byte strings: 16 bytes which,
+        # unlike an address of 16 characters, are not valid address text
+        if (isinstance(value, str) and len(value) == 16 and
+                connection.vendor in self.BYTES_VENDORS and
+                parse_ip(value) is None):
+            return unpack_ip(value)
+        return value
+
+    def get_prep_value(self, value):
+        if value is None:
+            return None
+        return pack_ip(self.to_python(value))
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if not prepared:
+            value = self.get_prep_value(value)
+        if value is None:
+            return None
+        # the DB-API module of the backend, imported as `Database` by all
+        # of django's backends
+        database = sys.modules[type(connection).__module__].Database
+        return database.Binary(value)
+
+    def value_to_string(self, obj):
+        return self._get_val_from_obj(obj)
@@ -0,0 +1,203 @@
+'''
+Streaming detection of the clients which make the most hits.
+
+Every request to the hit endpoint is fed to a process-local tracker of the
+IP addresses and User Agents which make the most requests.  The tracker
+uses the Space-Saving algorithm, so it keeps at most
+HITCOUNT_HEAVY_HITTERS_CAPACITY (1000 by default) addresses and as many User
+Agents no matter how many clients there are.  Any client making more than
+1 / capacity of the requests is guaranteed to be tracked.
+
+The counts cover a sliding window of HITCOUNT_THROTTLE_WINDOW (a timedelta
+dict, one minute by default).  With
+
+    HITCOUNT_THROTTLE_IP_LIMIT = 120
+    HITCOUNT_THROTTLE_USER_AGENT_LIMIT = 1000
+
+requests from an address or User Agent which made more requests than that
+within the window are rejected (both limits are off by default).  Throttling
+uses the guaranteed part of a count only, so a client is never throttled for
+requests another client made.  Keep the User Agent limit well above the
+traffic of popular browsers.
+
+The admin lists the current heavy hitters and blacklists them in one click
+(see HitAdmin.heavy_hitters_view).  Each process only sees its own
+requests.
+'''
+import datetime
+import threading
+import time
+
+from django.conf import settings
+
+from hitcount.utils import timedelta_seconds
+
+
+class SpaceSaving(object):
+    '''
+    Approximate counts of the `capacity` most frequent keys of a stream.
+
+    Every tracked key has a count and the error of that count: when a new
+    key evicts the key with the lowest count, it takes over that count as
+    its error.  `count - error` is a lower bound of the key's true count
+    and `count` an upper bound.
+    '''
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        # key -> (count, error)
+        self.counts = {}
+        # count -> keys with that count
+        self.buckets = {}
+        self.min_count = 0
+
+    def _move(self, key, count, error):
+        self.counts[key] = (count, error)
+        self.buckets.setdefault(count, set()).add(key)
+
+    def _remove(self, key):
+        count = self.counts.pop(key)[0]
+        bucket = self.buckets[count]
+        bucket.discard(key)
+        if not bucket:
+            del self.buckets[count]
+        return count
+
+    def add(self, key):
+        '''
+        Counts an occurrence of the key in constant time.
+        '''
+        if key in self.counts:
+            error = self.counts[key][1]
+            count = self._remove(key) + 1
+        elif len(self.counts) < self.capacity:
+            count, error = 1, 0
+        else:
+            victim = next(iter(self.buckets[self.min_count]))
+            error = self._remove(victim)
+            count = error + 1
+        self._move(key, count, error)
+        if len(self.counts) == 1 or count == 1:
+            self.min_count = count
+        elif self.min_count not in self.buckets:
+            self.min_count = count
+
+    def get(self, key):
+        '''
+        Returns the (count, error) of the key, (0, 0) if it is not tracked.
+        '''
+        return self.counts.get(key, (0, 0))
+
+    def __len__(self):
+        return len(self.counts)
+
+
+class HeavyHitters(object):
+    '''
+    Tracks the request counts of IP addresses and User Agents over a
+    sliding window of `window` seconds.
+
+    Like `hitcount.ratelimit.SlidingWindowCounter`, the window is made of
+    the current and the previous period; the previous one is weighted by
+    the part of it which is still inside the window.
+    '''
+    KINDS = ('ip', 'user_agent')
+
+    def __init__(self, window, capacity=1000):
+        self.window = window
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._period = None
+        self._current = self._previous = None
+        self._rotate(0)
+
+    def _rotate(self, period):
+        if period == self._period:
+            return
+        if self._period is not None and period == self._period + 1:
+            self._previous = self._current
+        else:
+            self._previous = dict((kind, SpaceSaving(self.capacity))
+                                  for kind in self.KINDS)
+        self._current = dict((kind, SpaceSaving(self.capacity))
+                             for kind in self.KINDS)
+        self._period = period
+
+    def _weight(self, now):
+        # the part of the previous period which is still inside the window
+        return 1 - float(now % self.window) / self.window
+
+    def add(self, ip, user_agent, now=None):
+        '''
+        Counts a request.  Returns the guaranteed number of requests of the
+        IP address and of the User Agent within the window.
+        '''
+        now = now or time.time()
+        with self._lock:
+            self._rotate(int(now) // self.window)
+            weight = self._weight(now)
+            rates = []
+            for kind, key in zip(self.KINDS, (ip, user_agent)):
+                self._current[kind].add(key)
+                count, error = self._current[kind].get(key)
+                old_count, old_error = self._previous[kind].get(key)
+                rates.append(count - error +
+                             int((old_count - old_error) * weight))
+            return tuple(rates)
+
+    def top(self, kind, limit=20, now=None):
+        '''
+        Returns the `limit` IP addresses or User Agents (`kind` is 'ip' or
+        'user_agent') with the most requests within the window as (key,
+        estimated requests, guaranteed requests) tuples.
+        '''
+        now = now or time.time()
+        with self._lock:
+            self._rotate(int(now) // self.window)
+            weight = self._weight(now)
+            current = self._current[kind].counts
+            previous = self._previous[kind].counts
+            rows = []
+            for key in set(current) | set(previous):
+                count, error = current.get(key, (0, 0))
+                old_count, old_error = previous.get(key, (0, 0))
+                rows.append((key, count + int(old_count * weight),
+                             count - error +
+                             int((old_count - old_error) * weight)))
+        rows.sort(key=lambda row: (-row[1], -row[2]))
+        return rows[:limit]
+
+    def clear(self):
+        with self._lock:
+            self._period = None
+            self._rotate(0)
+
+
+_heavy_hitters = None
+
+
+def get_heavy_hitters():
+    '''
+    Returns the process-local tracker of the hit endpoint's clients.
+    '''
+    global _heavy_hitters
+    if _heavy_hitters is None:
+        window = getattr(settings, 'HITCOUNT_THROTTLE_WINDOW', {'minutes': 1})
+        _heavy_hitters = HeavyHitters(
+            max(timedelta_seconds(datetime.timedelta(**window)), 1),
+            getattr(settings, 'HITCOUNT_HEAVY_HITTERS_CAPACITY', 1000))
+    return _heavy_hitters
+
+
+def is_throttled(ip, user_agent):
+    '''
+    Counts a request to the hit endpoint and returns True if its IP address
+    or User Agent exceeded HITCOUNT_THROTTLE_IP_LIMIT or
+    HITCOUNT_THROTTLE_USER_AGENT_LIMIT.
+    '''
+    ip_rate, user_agent_rate = get_heavy_hitters().add(ip, user_agent)
+    ip_limit = getattr(settings, 'HITCOUNT_THROTTLE_IP_LIMIT', 0)
+    user_agent_limit = getattr(settings,
+                               'HITCOUNT_THROTTLE_USER_AGENT_LIMIT', 0)
+    return bool((ip_limit and ip_rate > ip_limit) or
+                (user_agent_limit and user_agent_rate > user_agent_limit))
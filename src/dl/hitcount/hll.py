@@ -0,0 +1,104 @@
+'''
+HyperLogLog sketches for approximate distinct counts.
+
+A sketch estimates how many distinct values were added to it in a fixed
+amount of memory: 2 ** precision one-byte registers, 2048 by default.  Two
+sketches of the same precision merge into the sketch of the union of their
+values, so per-day sketches answer "how many distinct visitors" for any
+range of days.
+
+The relative standard error of the estimate is 1.04 / sqrt(2 ** precision),
+about 2.3% at the default precision: roughly two thirds of the estimates are
+within 2.3% of the exact count and 95% within 4.6%.  Small counts (below
+2.5 * 2 ** precision) are estimated by linear counting, which is nearly
+exact for a few hundred values.
+
+Stored sketches are zlib-compressed, so sparsely filled ones (most of a
+HitCount's days) take a few dozen bytes.
+'''
+import base64
+import hashlib
+import math
+import struct
+import zlib
+
+DEFAULT_PRECISION = 11
+
+
+def hash_value(value):
+    '''
+    Hashes a string to an unsigned 64 bit integer.
+    '''
+    return struct.unpack('>Q', hashlib.md5(value).digest()[:8])[0]
+
+
+class HyperLogLog(object):
+
+    def __init__(self, precision=DEFAULT_PRECISION, registers=None):
+        if not 4 <= precision <= 16:
+            raise ValueError("precision must be between 4 and 16")
+        self.precision = precision
+        self.size = 1 << precision
+        if registers is None:
+            registers = bytearray(self.size)
+        self.registers = registers
+
+    def add_hash(self, value):
+        '''
+        Adds a value given as its unsigned 64 bit hash.  Returns True if
+        the sketch changed.
+        '''
+        bits = 64 - self.precision
+        index = value >> bits
+        rest = value & ((1 << bits) - 1)
+        # the position of the leftmost 1 bit in the remaining bits
+        rank = bits - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+            return True
+        return False
+
+    def add(self, value):
+        '''
+        Adds a string.  Returns True if the sketch changed.
+        '''
+        return self.add_hash(hash_value(value))
+
+    def update(self, other):
+        '''
+        Merges another sketch of the same precision into this one.
+        '''
+        if other.precision != self.precision:
+            raise ValueError("Can't merge sketches of different precisions")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def cardinality(self):
+        '''
+        Returns the estimated number of distinct values added.
+        '''
+        m = float(self.size)
+        if self.size >= 128:
+            alpha = 0.7213 / (1 + 1.079 / m)
+        else:
+            alpha = {16: 0.673, 32: 0.697, 64: 0.709}[self.size]
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(chr(0))
+        if estimate <= 2.5 * m and zeros:
+            # linear counting
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+    def __len__(self):
+        return self.cardinality()
+
+    def dumps(self):
+        '''
+        Returns the sketch as compressed, base64 encoded text.
+        '''
+        data = zlib.compress(chr(self.precision) + str(self.registers), 9)
+        return base64.b64encode(data)
+
+    @classmethod
+    def loads(cls, text):
+        data = bytearray(zlib.decompress(base64.b64decode(text)))
+        return cls(data[0], data[1:])
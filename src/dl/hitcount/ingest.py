@@ -0,0 +1,223 @@
+'''
+Backfilling hits from web server access logs.
+
+When the hit endpoint was down, the views it missed are still in the access
+logs.  The `hitcount_ingest_logs` command reads logs in the combined format
+(the default of nginx and Apache; gunicorn's default access log format is
+the same), plain or gzip-compressed, line by line:
+
+    1.2.3.4 - - [10/Oct/2012:13:55:36 +0200] "GET /video/42/ HTTP/1.1" 200
+        5120 "http://example.com/" "Mozilla/5.0 ..."
+
+Successful GET requests of the URLs matching a pattern (/video/<pk>/ by
+default) within the given period become hits on the HitCounts of the
+matching objects.  Blacklisted clients are skipped.  Logs don't know the
+visitor's session, so the IP address and User Agent stand in for it (hashed
+into Hit.session_hash); a visitor is counted once per
+HITCOUNT_KEEP_HIT_ACTIVE, around any hit of the same visitor which is
+already in the database, so ingesting a log twice doesn't count it twice.
+
+Memory use only depends on the batch size and the number of visitors
+within HITCOUNT_KEEP_HIT_ACTIVE, not on the size of the log.
+
+To ingest in parallel, every worker reads all the logs but only handles
+the lines of its shard of the client IP addresses: all the requests of a
+visitor are handled by the same worker, which can tell their repeat hits
+apart.
+'''
+import datetime
+import gzip
+import re
+import zlib
+
+from django.conf import settings
+from django.db.models import get_model
+from django.contrib.contenttypes.models import ContentType
+
+from hitcount.blacklist import blacklist
+from hitcount.models import Hit, HitCount
+from hitcount.utils import hash_session, naive_utc
+
+LINE_RE = re.compile(r'^(?P<ip>\S+) \S+ \S+ \[(?P<time>[^\]]+)\] '
+                     r'"(?P<method>[A-Z]+) (?P<path>\S+)[^"]*" '
+                     r'(?P<status>\d{3}) \S+ "[^"]*" "(?P<user_agent>[^"]*)"')
+
+MONTHS = dict((month, i + 1) for i, month in enumerate(
+    ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+     'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']))
+
+
+def parse_time(value):
+    '''
+    Parses a log time such as "10/Oct/2012:13:55:36 +0200" into a naive
+    UTC datetime.
+    '''
+    stamp, offset = value.split(' ')
+    day, month, rest = stamp.split('/')
+    year, hour, minute, second = rest.split(':')
+    when = datetime.datetime(int(year), MONTHS[month], int(day), int(hour),
+                             int(minute), int(second))
+    sign = -1 if offset[0] == '-' else 1
+    return when - sign * datetime.timedelta(hours=int(offset[1:3]),
+                                            minutes=int(offset[3:5]))
+
+
+def parse_line(line):
+    '''
+    Returns the (ip, created, path, user agent) of a successful GET
+    request or None.
+    '''
+    match = LINE_RE.match(line)
+    if match is None or match.group('method') != 'GET':
+        return None
+    status = match.group('status')
+    if not (status.startswith('2') or status == '304'):
+        return None
+    try:
+        created = parse_time(match.group('time'))
+    except (ValueError, KeyError, IndexError):
+        return None
+    return (match.group('ip'), created, match.group('path'),
+            match.group('user_agent').decode('utf-8', 'replace')[:255])
+
+
+def open_log(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+class LogIngester(object):
+    '''
+    Turns the requests of access logs into hits, `batch_size` at a time.
+
+    `model` is the model of the objects ('app_label.model'), `url_pattern`
+    a regular expression matching their URLs with a `pk` group.  Requests
+    from `since` up to `until` (naive UTC datetimes) are considered.  Only
+    the lines of client IP addresses in shard number `shard` of `shards`
+    are read.  Give the logs in chronological order.
+    '''
+
+    def __init__(self, model, url_pattern, since, until, batch_size=5000,
+                 dry_run=False, shard=0, shards=1):
+        self.model = get_model(*model.split('.'))
+        if self.model is None:
+            raise ValueError("Unknown model %s" % model)
+        self.content_type = ContentType.objects.get_for_model(self.model)
+        self.url_re = re.compile(url_pattern)
+        self.since = since
+        self.until = until
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.shard = shard
+        self.shards = shards
+        grace = getattr(settings, 'HITCOUNT_KEEP_HIT_ACTIVE', {'days': 7})
+        self.window = datetime.timedelta(**grace)
+        # object pk -> HitCount pk (None for objects which don't exist)
+        self._hitcount_pks = {}
+        # (HitCount pk, session hash) -> time of the last hit counted
+        self._counted = {}
+        self.stats = dict.fromkeys(['lines', 'requests', 'blacklisted',
+                                    'repeated', 'recorded'], 0)
+
+    def ingest(self, path):
+        '''
+        Ingests a log file.  Returns the statistics of the ingester.
+        '''
+        batch = []
+        blacklist.refresh()
+        log = open_log(path)
+        try:
+            for line in log:
+                if (self.shards > 1 and zlib.crc32(line.split(' ', 1)[0]) %
+                        self.shards != self.shard):
+                    continue
+                self.stats['lines'] += 1
+                request = parse_line(line)
+                if request is None:
+                    continue
+                ip, created, path, user_agent = request
+                if not self.since <= created < self.until:
+                    continue
+                match = self.url_re.match(path)
+                if match is None:
+                    continue
+                self.stats['requests'] += 1
+                if blacklist.is_blacklisted(ip, user_agent, refresh=False):
+                    self.stats['blacklisted'] += 1
+                    continue
+                batch.append((match.group('pk'), created, ip, user_agent))
+                if len(batch) >= self.batch_size:
+                    self._record(batch)
+                    batch = []
+                    blacklist.refresh()
+        finally:
+            log.close()
+        self._record(batch)
+        return self.stats
+
+    def _map_objects(self, object_pks):
+        '''
+        Looks up the HitCounts of the objects which were not seen before,
+        creating them for existing objects only.
+        '''
+        missing = set(object_pks) - set(self._hitcount_pks)
+        if not missing:
+            return
+        existing = set(unicode(pk) for pk in self.model._default_manager.filter(
+            pk__in=missing).values_list('pk', flat=True))
+        for object_pk in missing:
+            self._hitcount_pks[object_pk] = None
+            if object_pk in existing:
+                self._hitcount_pks[object_pk] = \
+                    HitCount.objects.get_pk_for_object(self.content_type,
+                                                       object_pk)
+
+    def _record(self, batch):
+        if not batch:
+            return
+        self._map_objects(set(object_pk for object_pk, _, _, _ in batch))
+        hits = []
+        for object_pk, created, ip, user_agent in batch:
+            hitcount_pk = self._hitcount_pks[object_pk]
+            if hitcount_pk is not None:
+                hits.append(Hit(hitcount_id=hitcount_pk, created=created,
+                                ip=ip, user_agent=user_agent,
+                                session_hash=hash_session(
+                                    u'%s|%s' % (ip, user_agent))))
+        if not hits:
+            return
+
+        # hits already in the database within the window around the batch
+        first = min(hit.created for hit in hits) - self.window
+        last = max(hit.created for hit in hits) + self.window
+        existing = Hit.objects.filter(
+            created__gte=first, created__lte=last,
+            hitcount__in=set(hit.hitcount_id for hit in hits)).order_by()
+        session_hashes = list(set(hit.session_hash for hit in hits))
+        # keeps the number of query parameters within the limits of SQLite
+        for i in xrange(0, len(session_hashes), 400):
+            for hitcount_pk, session_hash, created in existing.filter(
+                    session_hash__in=session_hashes[i:i + 400]).values_list(
+                        'hitcount', 'session_hash', 'created'):
+                self._counted.setdefault((hitcount_pk, session_hash),
+                                         naive_utc(created))
+
+        new_hits = []
+        for hit in hits:
+            key = (hit.hitcount_id, hit.session_hash)
+            counted = self._counted.get(key)
+            if counted is not None and abs(hit.created - counted) < self.window:
+                self.stats['repeated'] += 1
+                continue
+            self._counted[key] = hit.created
+            new_hits.append(hit)
+        if new_hits and not self.dry_run:
+            Hit.objects.record_hits(new_hits)
+        self.stats['recorded'] += len(new_hits)
+
+        # forget the visitors which can't repeat anymore (logs are ordered)
+        cutoff = last - 2 * self.window
+        for key, created in self._counted.items():
+            if created < cutoff:
+                del self._counted[key]
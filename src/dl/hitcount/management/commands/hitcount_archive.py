@@ -0,0 +1,79 @@
+import datetime
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+class Command(NoArgsCommand):
+    help = "Copies the hits which hitcount_cleanup would delete into a columnar archive " + \
+           "of NumPy files (see hitcount/archive.py).  Run it before hitcount_cleanup, " + \
+           "which keeps unarchived hits while HITCOUNT_ARCHIVE_DIR is set. " + \
+           "Each run continues after the highest hit archived so far."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--path',
+            help='The archive directory (default: HITCOUNT_ARCHIVE_DIR).'),
+        make_option('--batch-size', type='int', default=100000,
+            help='The number of hits read per query (and at most per segment).'),
+    )
+
+    def handle_noargs(self, **options):
+        from django.conf import settings
+        from hitcount import archive
+        from hitcount.models import Hit, HitCount
+        from hitcount.utils import naive_utc
+
+        if archive.numpy is None:
+            raise CommandError("Archiving hits requires NumPy.")
+        path = options['path'] or getattr(settings, 'HITCOUNT_ARCHIVE_DIR',
+                                          None)
+        if not path:
+            raise CommandError("Set HITCOUNT_ARCHIVE_DIR or pass --path.")
+        grace = getattr(settings, 'HITCOUNT_KEEP_HIT_IN_DATABASE', {'days':30})
+        # Hit.created is stored in UTC
+        period = datetime.datetime.utcnow() - datetime.timedelta(**grace)
+        batch_size = options['batch_size']
+        verbosity = int(options.get('verbosity', 1))
+
+        last_pk = archive.last_archived_pk(path)
+        hits = Hit.objects.order_by('pk').values_list(
+            'pk', 'created', 'hitcount', 'user', 'session_hash', 'ip',
+            'agent__user_agent')
+        total = 0
+        while True:
+            rows = list(hits.filter(pk__gt=last_pk)[:batch_size])
+            # Stop at the first hit which is not expired yet so the next run
+            # can continue from the last archived pk.
+            for i, row in enumerate(rows):
+                if naive_utc(row[1]) >= period:
+                    del rows[i:]
+                    break
+            if not rows:
+                break
+            # ip comes back as the raw packed value
+            rows = [row[:5] + (row[5] and str(row[5]),) + row[6:]
+                    for row in rows]
+            hitcounts = dict(
+                (pk, ('%s.%s' % (app_label, model), object_pk))
+                for pk, app_label, model, object_pk in
+                HitCount.objects.filter(
+                    pk__in=set(row[2] for row in rows)).values_list(
+                        'pk', 'content_type__app_label',
+                        'content_type__model', 'object_pk'))
+            by_month = {}
+            for row in rows:
+                by_month.setdefault(row[1].strftime('%Y-%m'), []).append(row)
+            for month in sorted(by_month):
+                segment = archive.write_segment(path, by_month[month],
+                                                hitcounts)
+                if verbosity > 1:
+                    self.stdout.write("Wrote %s.\n" % segment)
+            total += len(rows)
+            last_pk = rows[-1][0]
+            if verbosity > 0:
+                self.stdout.write("Archived %d hits (up to pk %d).\n" % (
+                    total, last_pk))
+            if len(rows) < batch_size:
+                break
+
+        self.stdout.write("Archived %d hits older than %s to %s.\n" % (
+            total, period, path))
@@ -0,0 +1,49 @@
+import random
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+class Command(NoArgsCommand):
+    help = "Micro-benchmark of IP blacklist lookups against growing numbers " + \
+           "of blacklisted networks.  Doesn't touch the database."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--ranges', type='int', default=10000,
+            help='The largest number of blacklisted networks to test with.'),
+        make_option('--lookups', type='int', default=100000,
+            help='The number of addresses looked up per run.'),
+    )
+
+    def handle_noargs(self, **options):
+        from hitcount.prefixtree import PrefixTree
+
+        random.seed(0)
+        max_ranges = options['ranges']
+        lookups = options['lookups']
+        sizes = sorted(set([10, 100, 1000, max_ranges]))
+        for version, bits in ((4, 32), (6, 128)):
+            for size in sizes:
+                tree = PrefixTree(bits)
+                networks = []
+                for _ in xrange(size):
+                    prefixlen = random.randint(bits // 2, bits)
+                    host_mask = (1 << (bits - prefixlen)) - 1
+                    network = random.getrandbits(bits) & ~host_mask
+                    tree.insert(network, prefixlen, True)
+                    networks.append((network, host_mask))
+                # half of the addresses fall into a blacklisted network
+                addresses = []
+                for i in xrange(lookups):
+                    if i % 2:
+                        network, host_mask = random.choice(networks)
+                        addresses.append(
+                            network | (random.getrandbits(bits) & host_mask))
+                    else:
+                        addresses.append(random.getrandbits(bits))
+                start = time.time()
+                for address in addresses:
+                    tree.longest_match(address)
+                elapsed = time.time() - start
+                self.stdout.write("IPv%d, %6d networks: %.2f us/lookup\n" % (
+                    version, size, elapsed * 1e6 / lookups))
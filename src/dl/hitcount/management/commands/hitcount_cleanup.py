@@ -1,14 +1,103 @@
 import datetime
+import time
+from optparse import make_option
+
 from django.core.management.base import NoArgsCommand
 
 class Command(NoArgsCommand):
-    help = "Can be run as a cronjob or directly to clean out old Hits objects from the database."
+    help = "Can be run as a cronjob or directly to clean out old Hits objects from the database. " + \
+           "Hits are deleted in batches ordered by primary key, each batch in its own " + \
+           "transaction, so an interrupted run simply continues where it stopped the " + \
+           "next time it is run.  Only hits which hitcount_rollup rolled up already " + \
+           "are deleted, to keep windowed counts.  " + \
+           "If the table is partitioned (see hitcount_partition), months which " + \
+           "expired completely are dropped as a whole first.  With HITCOUNT_ARCHIVE_DIR " + \
+           "set, only hits which hitcount_archive copied already are deleted."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int', default=1000,
+            help='The number of hits deleted per DELETE statement.'),
+        make_option('--sleep', type='float', default=0.1,
+            help='The number of seconds to pause between batches.'),
+        make_option('--max-seconds', type='float', default=0,
+            help='Stop after this many seconds (0 means no limit).'),
+        make_option('--dry-run', action='store_true', default=False,
+            help='Only report how many hits would be deleted.'),
+    )
 
     def handle_noargs(self, **options):
-        from django.db import transaction
-        from hitcount.models import Hit
+        from hitcount.models import Hit, RollupWatermark
+        from hitcount import archive
+        from hitcount import partitions
         from django.conf import settings
+        from django.db import connection, transaction
         grace = getattr(settings, 'HITCOUNT_KEEP_HIT_IN_DATABASE', {'days':30})
-        period = datetime.datetime.now() - datetime.timedelta(**grace)
-        Hit.objects.filter(created__lt=period).delete()
-        transaction.commit_unless_managed()
+        # Hit.created is stored in UTC
+        period = datetime.datetime.utcnow() - datetime.timedelta(**grace)
+        batch_size = options['batch_size']
+        dry_run = options['dry_run']
+        verbosity = int(options.get('verbosity', 1))
+        started = time.time()
+
+        expired = Hit.objects.filter(created__lt=period)
+        # Only delete the hits which are rolled up (or the windowed counts
+        # would lose them) and, with HITCOUNT_ARCHIVE_DIR, archived.  Both
+        # go by pk, so expired hits with higher pks may still be missing.
+        last_pks = [('rolled up', 'hitcount_rollup',
+                     RollupWatermark.objects.get_last_hit_id())]
+        archive_dir = getattr(settings, 'HITCOUNT_ARCHIVE_DIR', None)
+        if archive_dir:
+            last_pks.append(('archived', 'hitcount_archive',
+                             archive.last_archived_pk(archive_dir)))
+        kept = []
+        for done, command, last_pk in last_pks:
+            if expired.filter(pk__gt=last_pk).exists():
+                kept.append((done, command))
+            expired = expired.filter(pk__lte=last_pk)
+
+        expired_partitions = []
+        if not kept:
+            expired_partitions = partitions.expired_partitions(connection,
+                                                               period)
+        if expired_partitions:
+            if dry_run:
+                # Don't count the hits of the partitions again below
+                expired = expired.filter(created__gte=partitions.partition_end(
+                    expired_partitions[-1]))
+            else:
+                partitions.drop_partitions(connection, expired_partitions)
+                transaction.commit_unless_managed()
+            self.stdout.write("%s partitions %s.\n" % (
+                "Would drop" if dry_run else "Dropped",
+                ', '.join(expired_partitions)))
+
+        expired = expired.order_by('pk')
+        total = 0
+        last_pk = 0
+        while True:
+            pks = list(expired.filter(pk__gt=last_pk).values_list(
+                'pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            last_pk = pks[-1]
+            if not dry_run:
+                Hit.objects.delete_pks(pks)
+            total += len(pks)
+            if verbosity > 0:
+                self.stdout.write("%s %d hits (up to pk %d).\n" % (
+                    "Found" if dry_run else "Deleted", total, last_pk))
+            if len(pks) < batch_size:
+                break
+            if (options['max_seconds'] and
+                    time.time() - started >= options['max_seconds']):
+                self.stdout.write("Stopped after %d seconds; run again to "
+                                  "continue.\n" % options['max_seconds'])
+                break
+            if options['sleep'] and not dry_run:
+                time.sleep(options['sleep'])
+
+        self.stdout.write("%s %d hits older than %s.\n" % (
+            "Would delete" if dry_run else "Deleted", total, period))
+        for done, command in kept:
+            self.stdout.write("Kept the expired hits which are not %s yet; "
+                              "run %s first.\n" % (done, command))
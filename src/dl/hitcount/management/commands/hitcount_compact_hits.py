@@ -0,0 +1,115 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+class Command(NoArgsCommand):
+    help = "Copies the hits of the old hitcount_hit table, renamed to the legacy table, " + \
+           "into the compact table: IP addresses packed, session keys hashed and User " + \
+           "Agents moved to hitcount_user_agent.  Primary keys are kept so the rollup " + \
+           "watermark stays valid.  Hits are copied in batches ordered by primary key, " + \
+           "each batch in its own transaction, so an interrupted run simply continues " + \
+           "where it stopped the next time it is run.  Reports the estimated size " + \
+           "reduction of the converted columns."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--legacy-table', default='hitcount_hit_legacy',
+            help='The name of the old hit table.'),
+        make_option('--batch-size', type='int', default=1000,
+            help='The number of hits copied per batch.'),
+        make_option('--sleep', type='float', default=0,
+            help='The number of seconds to pause between batches.'),
+    )
+
+    def _reserve_pks(self, connection, legacy_max):
+        '''
+        Makes sure new hits don't take the primary keys of the legacy hits
+        which are not copied yet.
+        '''
+        from hitcount.models import Hit
+        table = Hit._meta.db_table
+        cursor = connection.cursor()
+        if connection.vendor == 'mysql':
+            cursor.execute("ALTER TABLE %s AUTO_INCREMENT = %d" % (
+                connection.ops.quote_name(table), legacy_max + 1))
+        elif connection.vendor == 'postgresql':
+            cursor.execute("SELECT setval(pg_get_serial_sequence(%s, %s), "
+                           "GREATEST(%s, (SELECT COALESCE(MAX(id), 0) "
+                           "FROM " + connection.ops.quote_name(table) + ")))",
+                           [table, Hit._meta.pk.column, legacy_max])
+        else:
+            self.stdout.write("Make sure hits recorded while copying get "
+                              "primary keys above %d.\n" % legacy_max)
+
+    def handle_noargs(self, **options):
+        from django.db import connection, transaction
+        from django.db.models import Max
+        from hitcount.models import Hit, UserAgent
+        from hitcount.utils import hash_session
+
+        legacy_table = connection.ops.quote_name(options['legacy_table'])
+        batch_size = options['batch_size']
+        verbosity = int(options.get('verbosity', 1))
+
+        cursor = connection.cursor()
+        try:
+            cursor.execute("SELECT MAX(id) FROM %s" % legacy_table)
+        except Exception, e:
+            raise CommandError("Can't read the legacy table %s: %s" % (
+                options['legacy_table'], e))
+        legacy_max = cursor.fetchone()[0] or 0
+        self._reserve_pks(connection, legacy_max)
+        transaction.commit_unless_managed()
+
+        last_pk = Hit.objects.filter(pk__lte=legacy_max).aggregate(
+            last=Max('pk'))['last'] or 0
+        if last_pk and verbosity > 0:
+            self.stdout.write("Continuing after pk %d.\n" % last_pk)
+
+        total = 0
+        # Bytes taken by the converted columns (including the length
+        # prefixes of variable length columns) before and after
+        old_bytes = new_bytes = 0
+        user_agents = set()
+        while True:
+            cursor.execute("SELECT id, created, ip, session, user_agent, "
+                           "user_id, hitcount_id FROM %s WHERE id > %%s "
+                           "ORDER BY id LIMIT %d" % (legacy_table,
+                                                     batch_size),
+                           [last_pk])
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            hits = []
+            for (pk, created, ip, session, user_agent,
+                    user_pk, hitcount_pk) in rows:
+                hits.append(Hit(pk=pk, created=created, ip=ip,
+                                session_hash=hash_session(session),
+                                user_agent=user_agent, user_id=user_pk,
+                                hitcount_id=hitcount_pk))
+                old_bytes += len(ip) + len(session) + len(user_agent) + 4
+                new_bytes += 17 + 8 + 4
+                if user_agent not in user_agents:
+                    user_agents.add(user_agent)
+                    new_bytes += len(user_agent) + 2 + 4
+            with transaction.commit_on_success():
+                UserAgent.objects.intern_hits(hits)
+                # bypasses record_hits; the totals already count these hits
+                Hit.objects.bulk_create(hits)
+            total += len(hits)
+            last_pk = rows[-1][0]
+            if verbosity > 0:
+                self.stdout.write("Copied %d hits (up to pk %d).\n" % (
+                    total, last_pk))
+            if len(rows) < batch_size:
+                break
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+        self.stdout.write("Copied %d hits.\n" % total)
+        if old_bytes:
+            self.stdout.write(
+                "IP, session and User Agent data of the copied hits: "
+                "%.1f MB before, about %.1f MB now (%d%% smaller).\n" % (
+                    old_bytes / 1048576.0, new_bytes / 1048576.0,
+                    100 - 100 * new_bytes // old_bytes))
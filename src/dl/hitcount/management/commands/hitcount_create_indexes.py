@@ -0,0 +1,31 @@
+from django.core.management.base import NoArgsCommand
+
+class Command(NoArgsCommand):
+    help = "Creates the composite indexes of hitcount/sql/hit.sql on an existing " + \
+           "hitcount_hit table (syncdb only creates them with the table).  Indexes " + \
+           "which already exist are skipped, so it is safe to run repeatedly.  " + \
+           "Creating an index locks the table on some databases; run it off-peak."
+
+    def handle_noargs(self, **options):
+        from django.core.management.color import no_style
+        from django.core.management.sql import custom_sql_for_model
+        from django.db import connection, transaction, DatabaseError
+        from hitcount.models import Hit
+
+        verbosity = int(options.get('verbosity', 1))
+        created = 0
+        for statement in custom_sql_for_model(Hit, no_style(), connection):
+            if not statement.strip().upper().startswith('CREATE INDEX'):
+                continue
+            try:
+                with transaction.commit_on_success():
+                    connection.cursor().execute(statement.rstrip(';'))
+            except DatabaseError, e:
+                if verbosity > 0:
+                    self.stdout.write("Skipped (%s): %s\n" % (
+                        str(e).strip(), statement.strip()))
+            else:
+                created += 1
+                if verbosity > 0:
+                    self.stdout.write("Created: %s\n" % statement.strip())
+        self.stdout.write("Created %d indexes.\n" % created)
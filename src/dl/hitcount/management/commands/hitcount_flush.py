@@ -0,0 +1,18 @@
+from django.core.management.base import NoArgsCommand
+
+class Command(NoArgsCommand):
+    help = "Flushes the hits queued in the HITCOUNT_BUFFER to the database. " + \
+           "Can be run as a cronjob to flush a shared buffer on idle sites."
+
+    def handle_noargs(self, **options):
+        from hitcount.buffer import get_hit_buffer
+        hit_buffer = get_hit_buffer()
+        if hit_buffer is None:
+            self.stdout.write("Hit buffering is disabled (HITCOUNT_BUFFER).\n")
+            return
+        flushed = hit_buffer.flush()
+        stats = hit_buffer.stats()
+        self.stdout.write("Flushed %d hits (total flushed: %d, dropped: %d, "
+                          "still queued: %d).\n" % (flushed, stats['flushed'],
+                                                    stats['dropped'],
+                                                    stats['queued']))
@@ -0,0 +1,121 @@
+import datetime
+import multiprocessing
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+TIME_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d')
+
+
+def _parse_datetime(value):
+    for time_format in TIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, time_format)
+        except ValueError:
+            pass
+    raise CommandError("Can't parse the time %r (use YYYY-MM-DD HH:MM)." %
+                       value)
+
+
+def _ingest(args):
+    '''
+    Ingests a shard of the log files, in a worker process when there are
+    several.  Returns the statistics of each file.
+    '''
+    from hitcount.ingest import LogIngester
+    paths, options = args
+    ingester = LogIngester(**options)
+    results = []
+    for path in paths:
+        before = dict(ingester.stats)
+        stats = ingester.ingest(path)
+        results.append((path, dict((key, value - before[key])
+                                   for key, value in stats.items())))
+    return results
+
+
+class Command(BaseCommand):
+    args = '<log file> [<log file> ...]'
+    help = "Backfills hits from access logs in the combined format, plain or gzipped " + \
+           "(see hitcount/ingest.py).  Only requests from --since up to --until " + \
+           "(UTC) are considered: limit them to the period during which the hit " + \
+           "endpoint was down, as the hits it did record can't be matched to log " + \
+           "lines.  Give the logs of each period once, in chronological order.  " + \
+           "Every worker process reads all the files, handling the lines of its " + \
+           "share of the client IP addresses."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--since',
+            help='The start of the period (UTC, YYYY-MM-DD HH:MM).'),
+        make_option('--until',
+            help='The end of the period (UTC, YYYY-MM-DD HH:MM, excluded).'),
+        make_option('--model', default='distance_learning.video',
+            help='The model of the objects (app_label.model).'),
+        make_option('--url-pattern', default=r'^/video/(?P<pk>\d+)/(\?|$)',
+            help='A regular expression matching the URLs of the objects, '
+                 'with a "pk" group.'),
+        make_option('--processes', type='int', default=0,
+            help='The number of worker processes (default: the number of '
+                 'CPUs).'),
+        make_option('--batch-size', type='int', default=5000,
+            help='The number of requests written per batch.'),
+        make_option('--dry-run', action='store_true', default=False,
+            help='Only report how many hits would be recorded.'),
+    )
+
+    def handle(self, *paths, **options):
+        from django.db import connection
+        from django.db.models import get_model
+        if not paths:
+            raise CommandError("Give the access log files to ingest.")
+        if not options['since'] or not options['until']:
+            raise CommandError("--since and --until are required.")
+        if get_model(*options['model'].split('.')) is None:
+            raise CommandError("Unknown model %s." % options['model'])
+        ingester_options = {
+            'model': options['model'],
+            'url_pattern': options['url_pattern'],
+            'since': _parse_datetime(options['since']),
+            'until': _parse_datetime(options['until']),
+            'batch_size': options['batch_size'],
+            'dry_run': options['dry_run'],
+        }
+        processes = options['processes'] or multiprocessing.cpu_count()
+        verbosity = int(options.get('verbosity', 1))
+
+        jobs = [(paths, dict(ingester_options, shard=shard, shards=processes))
+                for shard in xrange(processes)]
+        if processes > 1:
+            # the workers must not inherit the connection; each opens its own
+            connection.close()
+            pool = multiprocessing.Pool(processes)
+            results = pool.imap_unordered(_ingest, jobs)
+        else:
+            pool = None
+            results = (_ingest(job) for job in jobs)
+
+        per_path = dict((path, {}) for path in paths)
+        totals = {}
+        try:
+            for shard_results in results:
+                for path, stats in shard_results:
+                    for key, value in stats.items():
+                        per_path[path][key] = per_path[path].get(key, 0) + value
+                        totals[key] = totals.get(key, 0) + value
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        if verbosity > 0:
+            for path in paths:
+                stats = per_path[path]
+                self.stdout.write("%s: %d lines, %d requests, %d "
+                                  "blacklisted, %d repeated, %d hits.\n" % (
+                    path, stats['lines'], stats['requests'],
+                    stats['blacklisted'], stats['repeated'],
+                    stats['recorded']))
+
+        self.stdout.write("%s %d hits from %d requests in %d files.\n" % (
+            "Would record" if options['dry_run'] else "Recorded",
+            totals.get('recorded', 0), totals.get('requests', 0), len(paths)))
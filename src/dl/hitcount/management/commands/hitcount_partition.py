@@ -0,0 +1,38 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+class Command(NoArgsCommand):
+    help = "Keeps the hitcount_hit table partitioned by month (MySQL only, see " + \
+           "hitcount/partitions.py).  --setup partitions an existing table; without " + \
+           "it, partitions are added for the months up to " + \
+           "HITCOUNT_PARTITION_MONTHS_AHEAD months from now.  Should be run monthly."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--setup', action='store_true', default=False,
+            help='Partition the table.  Rebuilds the table and drops its '
+                 'foreign key constraints; the hit endpoint is blocked '
+                 'meanwhile.'),
+    )
+
+    def handle_noargs(self, **options):
+        from django.db import connection, transaction
+        from hitcount import partitions
+
+        if not partitions.is_supported(connection):
+            raise CommandError("Partitioning is only supported on MySQL.")
+        existing = partitions.get_partitions(connection)
+        if options['setup']:
+            if existing:
+                raise CommandError("The table is partitioned already.")
+            partitions.partition_table(connection)
+            transaction.commit_unless_managed()
+            self.stdout.write("Partitioned the table into %d months.\n" %
+                              len(partitions.get_partitions(connection)))
+        elif not existing:
+            raise CommandError("The table is not partitioned; run with "
+                               "--setup first.")
+        else:
+            added = partitions.add_partitions(connection)
+            transaction.commit_unless_managed()
+            self.stdout.write("Added %d partitions.\n" % added)
@@ -0,0 +1,18 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+class Command(NoArgsCommand):
+    help = "Rolls up the hits saved since the last run into the hourly " + \
+           "and daily hit counts and the daily visitor sketches.  Should be " + \
+           "run as a cronjob."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int', default=5000,
+            help='The number of hits rolled up per transaction.'),
+    )
+
+    def handle_noargs(self, **options):
+        from hitcount.rollups import rollup_hits
+        rolled_up = rollup_hits(batch_size=options['batch_size'])
+        self.stdout.write("Rolled up %d hits.\n" % rolled_up)
@@ -1,20 +1,37 @@
 import datetime
 
+from collections import defaultdict
+
 from django.db import models
+from django.db import connections
+from django.db import transaction
+from django.db import IntegrityError
 from django.conf import settings
-from django.db.models import F
+from django.db.models import F, Count, Sum
 
+from django.core.exceptions import ValidationError
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.auth.models import User
 from django.contrib.contenttypes import generic
 
 from django.dispatch import Signal
+from django.db.models.signals import post_save, post_delete
+
+from hitcount.utils import parse_network, format_network, LRUCache
+from hitcount.fields import PackedIPAddressField
+from hitcount.hll import HyperLogLog
 
 
 # SIGNALS #
 
 delete_hit_count = Signal(providing_args=['save_hitcount',])
 
+# Sent by HitCount whenever hits are added to or removed from HitCount
+# totals.  `deltas` maps HitCount primary keys to the change of their totals;
+# when hits are added, `times` maps the same keys to the `created` times of
+# their new hits.
+hit_count_changed = Signal(providing_args=['deltas', 'times'])
+
 def delete_hit_count_callback(sender, instance, 
         save_hitcount=False, **kwargs):
     '''
@@ -25,16 +42,36 @@ def delete_hit_count_callback(sender, instance,
         HitCount object.
     '''
     if not save_hitcount:
+        from hitcount.rollups import unroll_hits
+        unroll_hits(Hit.objects.filter(pk=instance.pk))
         instance.hitcount.hits = F('hits') - 1
         instance.hitcount.save()
+        hit_count_changed.send(sender=HitCount,
+                deltas={instance.hitcount_id: -1})
 
 delete_hit_count.connect(delete_hit_count_callback)
 
 
+def visitor_key(user_pk, session_hash):
+    '''
+    Returns the key of a hit's visitor in the VisitorSketches (see
+    Hit.visitor_key).
+    '''
+    if user_pk is not None:
+        return 'user:%d' % user_pk
+    return 'session:%d' % session_hash
+
+
 # EXCEPTIONS #
 
 class DuplicateContentObject(Exception):
-    'If content_object already exists for this model'
+    '''
+    If content_object already exists for this model.
+
+    No longer raised: uniqueness is guaranteed by the unique
+    (content_type, object_pk) index instead.  Kept for backwards
+    compatibility.
+    '''
     pass
 
 # MANAGERS #
@@ -67,6 +104,387 @@ class HitManager(models.Manager):
         queryset = queryset.filter(created__gte=period)
         return queryset.filter(*args, **kwargs)
 
+    def record_hits(self, hits):
+        '''
+        Saves a list of new (unsaved) Hit objects in bulk.
+
+        The hits are written with a single `bulk_create` and the associated
+        HitCount totals are incremented with one aggregated
+        `hits = hits + n` UPDATE per distinct `n`, all inside of a single
+        transaction.  Unlike Hit.save(), this issues a constant number of
+        queries no matter how many hits are recorded.
+
+        Returns the number of hits saved.
+        '''
+        if not hits:
+            return 0
+        now = datetime.datetime.utcnow()
+        increments = defaultdict(int)
+        times = defaultdict(list)
+        for hit in hits:
+            if not hit.created:
+                hit.created = now
+            increments[hit.hitcount_id] += 1
+            times[hit.hitcount_id].append(hit.created)
+        UserAgent.objects.intern_hits(hits)
+
+        # HitCounts which received the same number of hits can share an
+        # UPDATE statement.
+        hitcounts_by_increment = defaultdict(list)
+        for hitcount_pk, increment in increments.items():
+            hitcounts_by_increment[increment].append(hitcount_pk)
+
+        with transaction.commit_on_success():
+            self.bulk_create(hits)
+            for increment, pks in hitcounts_by_increment.items():
+                HitCount.objects.filter(pk__in=pks).update(
+                        hits=F('hits') + increment, modified=now)
+            hit_count_changed.send(sender=HitCount, deltas=dict(increments),
+                                   times=dict(times))
+        return len(hits)
+
+    def delete_hits(self, queryset=None, save_hitcount=False,
+            batch_size=1000):
+        '''
+        Deletes all hits of `queryset` (all hits by default) in bulk.
+
+        Like Hit.delete(), the hits are subtracted from the HitCount totals
+        and, if they were already rolled up, from the hourly and daily
+        rollups unless `save_hitcount` is True.  The decrements are computed
+        with a single GROUP BY query and applied with one UPDATE per distinct
+        decrement; the rows are then deleted in batches of `batch_size`.
+        Everything happens in a single transaction.
+
+        The distinct visitor estimates (VisitorSketch) can't forget a
+        visitor and still count the deleted hits which were rolled up.
+
+        Returns the number of hits deleted.
+        '''
+        if queryset is None:
+            queryset = self.get_query_set()
+        queryset = queryset.order_by('pk')
+        with transaction.commit_on_success(using=self.db):
+            decrements = {}
+            if not save_hitcount:
+                from hitcount.rollups import unroll_hits
+                unroll_hits(queryset)
+                rows = queryset.order_by().values('hitcount').annotate(
+                        n=Count('pk'))
+                decrements = dict((row['hitcount'], row['n']) for row in rows)
+                # HitCounts which lose the same number of hits can share an
+                # UPDATE statement.
+                hitcounts_by_decrement = defaultdict(list)
+                for hitcount_pk, decrement in decrements.items():
+                    hitcounts_by_decrement[decrement].append(hitcount_pk)
+                now = datetime.datetime.utcnow()
+                for decrement, pks in hitcounts_by_decrement.items():
+                    HitCount.objects.filter(pk__in=pks).update(
+                            hits=F('hits') - decrement, modified=now)
+
+            deleted = 0
+            last_pk = 0
+            while True:
+                pks = list(queryset.filter(pk__gt=last_pk).values_list(
+                        'pk', flat=True)[:batch_size])
+                if not pks:
+                    break
+                deleted += self.delete_pks(pks)
+                last_pk = pks[-1]
+
+            if decrements:
+                hit_count_changed.send(sender=HitCount, deltas=dict(
+                        (pk, -n) for pk, n in decrements.items()))
+        return deleted
+
+    def delete_pks(self, pks):
+        '''
+        Deletes the hits with the given primary keys with a single DELETE
+        statement, without loading them first.  Does NOT touch the HitCount
+        totals.
+
+        Returns the number of hits deleted.
+        '''
+        if not pks:
+            return 0
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        cursor.execute("DELETE FROM %s WHERE %s IN (%s)" % (
+                qn(self.model._meta.db_table),
+                qn(self.model._meta.pk.column),
+                ', '.join(['%s'] * len(pks))), list(pks))
+        transaction.commit_unless_managed(using=self.db)
+        return cursor.rowcount
+
+# Maps User Agent strings to the pks of their UserAgents
+_user_agent_pks = LRUCache(getattr(settings, 'HITCOUNT_USER_AGENT_CACHE_SIZE',
+                                   10000))
+
+class UserAgentManager(models.Manager):
+
+    def intern(self, user_agents):
+        '''
+        Returns a dict mapping each of the given User Agent strings to the
+        pk of its UserAgent, creating the missing ones.  The pks are kept
+        in a process-local LRU cache (HITCOUNT_USER_AGENT_CACHE_SIZE
+        entries), so known User Agents usually cost no query at all.
+        '''
+        pks = {}
+        missing = set()
+        for user_agent in user_agents:
+            pk = _user_agent_pks.get(user_agent)
+            if pk is None:
+                missing.add(user_agent)
+            else:
+                pks[user_agent] = pk
+        if missing:
+            for pk, user_agent in self.filter(
+                    user_agent__in=missing).values_list('pk', 'user_agent'):
+                if user_agent in missing:
+                    missing.remove(user_agent)
+                    pks[user_agent] = pk
+            for user_agent in missing:
+                # relies on the unique index when racing another process
+                pks[user_agent] = self.get_or_create(
+                    user_agent=user_agent)[0].pk
+            for user_agent in missing:
+                _user_agent_pks[user_agent] = pks[user_agent]
+        return pks
+
+    def intern_hits(self, hits):
+        '''
+        Points the unsaved hits at the UserAgents of their `user_agent`.
+        '''
+        hits = [hit for hit in hits if hit.agent_id is None]
+        if hits:
+            pks = self.intern(set(hit.user_agent or '' for hit in hits))
+            for hit in hits:
+                hit.agent_id = pks[hit.user_agent or '']
+
+# Maps (content type pk, object pk) pairs to the pks of their HitCounts.
+# Deleting a HitCount only evicts it in this process, so the other processes
+# look their pks up again after HITCOUNT_PK_CACHE_TIMEOUT seconds.
+_hitcount_pks = LRUCache(getattr(settings, 'HITCOUNT_PK_CACHE_SIZE', 10000),
+                         getattr(settings, 'HITCOUNT_PK_CACHE_TIMEOUT', 300))
+
+class HitCountManager(models.Manager):
+
+    def get_for_object(self, content_type, object_pk):
+        '''
+        Returns the HitCount of the object, creating it if it does not exist.
+
+        Relies on the unique (content_type, object_pk) index: when two
+        requests race to create the same HitCount, the loser's INSERT fails
+        and it fetches the winner's row instead.
+        '''
+        hitcount, created = self.get_or_create(content_type=content_type,
+                object_pk=unicode(object_pk))
+        _hitcount_pks[(content_type.pk, unicode(object_pk))] = hitcount.pk
+        return hitcount
+
+    def get_pk_for_object(self, content_type, object_pk):
+        '''
+        Returns the pk of the object's HitCount, creating the HitCount if it
+        does not exist.  The pks are kept in a process-local LRU cache
+        (HITCOUNT_PK_CACHE_SIZE entries, for HITCOUNT_PK_CACHE_TIMEOUT
+        seconds) so that most calls don't need any query at all.
+        '''
+        pk = _hitcount_pks.get((content_type.pk, unicode(object_pk)))
+        if pk is None:
+            pk = self.get_for_object(content_type, object_pk).pk
+        return pk
+
+    def get_pks_for_objects(self, content_type, object_pks):
+        '''
+        Returns a dict mapping each of the given object pks (as text) to the
+        pk of its HitCount, creating the missing HitCounts.  Like
+        `get_pk_for_object`, but the objects which are not cached cost one
+        query to look them up and, if some HitCounts are missing, one to
+        create them all and one to fetch their pks.
+        '''
+        object_pks = set(unicode(pk) for pk in object_pks)
+        pks = {}
+        for object_pk in object_pks:
+            pk = _hitcount_pks.get((content_type.pk, object_pk))
+            if pk is not None:
+                pks[object_pk] = pk
+        missing = object_pks - set(pks)
+        if missing:
+            pks.update(self.filter(content_type=content_type,
+                                   object_pk__in=missing).values_list(
+                                       'object_pk', 'pk'))
+        created = missing - set(pks)
+        if created:
+            sid = transaction.savepoint(using=self.db)
+            try:
+                self.bulk_create([HitCount(content_type=content_type,
+                                           object_pk=object_pk)
+                                  for object_pk in created])
+                transaction.savepoint_commit(sid, using=self.db)
+            except IntegrityError:
+                # Another process created some of them in the meantime
+                transaction.savepoint_rollback(sid, using=self.db)
+            pks.update(self.filter(content_type=content_type,
+                                   object_pk__in=created).values_list(
+                                       'object_pk', 'pk'))
+            for object_pk in created - set(pks):
+                pks[object_pk] = self.get_for_object(content_type,
+                                                     object_pk).pk
+        for object_pk in missing:
+            _hitcount_pks[(content_type.pk, object_pk)] = pks[object_pk]
+        return pks
+
+    def hits_for_objects(self, content_type, object_pks, **kwargs):
+        '''
+        Returns a dict mapping each of the given object pks (as text) to its
+        total number of hits, or to the number of hits it got during the
+        time period given as timedelta kwargs (see `hits_in_last`).
+
+        Objects without a HitCount count as 0; no HitCount is created.  The
+        number of queries does not depend on the number of objects.
+        '''
+        object_pks = set(unicode(pk) for pk in object_pks)
+        counts = dict((pk, 0) for pk in object_pks)
+        if not object_pks:
+            return counts
+        rows = self.filter(content_type=content_type,
+                           object_pk__in=object_pks).values_list(
+                               'pk', 'object_pk', 'hits')
+        hitcount_pks = {}
+        for pk, object_pk, hits in rows:
+            _hitcount_pks[(content_type.pk, object_pk)] = pk
+            hitcount_pks[pk] = object_pk
+            counts[object_pk] = hits
+        if kwargs and hitcount_pks:
+            for pk, hits in self.hits_in_last(hitcount_pks.keys(),
+                                              **kwargs).items():
+                counts[hitcount_pks[pk]] = hits
+        return counts
+
+    def hits_in_last(self, hitcount_pks, **kwargs):
+        '''
+        Returns a dict mapping each of the given HitCount primary keys to the
+        number of hits it got during the given time period.
+
+        The counts are taken from the hourly and daily rollups (see
+        `hitcount.rollups`) so they keep working after the raw Hit rows were
+        purged by `hitcount_cleanup`, plus the raw hits which were not rolled
+        up yet.  The start of the period is matched exactly only for as long
+        as the raw hits of the first (partial) hour are still in the database.
+
+        The number of queries does not depend on the number of HitCounts or
+        the length of the period.
+
+        Accepts days, seconds, microseconds, milliseconds, minutes,
+        hours, and weeks.  It's creating a datetime.timedelta object.
+        '''
+        assert kwargs, "Must provide at least one timedelta arg (eg, days=1)"
+        start = datetime.datetime.utcnow() - datetime.timedelta(**kwargs)
+        # The rollup buckets which lie entirely within the period
+        first_hour = start.replace(minute=0, second=0, microsecond=0)
+        if first_hour < start:
+            first_hour += datetime.timedelta(hours=1)
+        first_day = first_hour.replace(hour=0)
+        if first_day < first_hour:
+            first_day += datetime.timedelta(days=1)
+
+        watermark = RollupWatermark.objects.get_last_hit_id()
+        hits = Hit.objects.filter(hitcount__in=hitcount_pks)
+        counts = dict((pk, 0) for pk in hitcount_pks)
+        for queryset, total in (
+                # the partial hour at the start of the period
+                (hits.filter(pk__lte=watermark, created__gte=start,
+                             created__lt=first_hour), Count('pk')),
+                (HourlyHitCount.objects.filter(hitcount__in=hitcount_pks,
+                                               bucket__gte=first_hour,
+                                               bucket__lt=first_day),
+                    Sum('hits')),
+                (DailyHitCount.objects.filter(hitcount__in=hitcount_pks,
+                                              bucket__gte=first_day),
+                    Sum('hits')),
+                # the hits which are not rolled up yet
+                (hits.filter(pk__gt=watermark, created__gte=start),
+                    Count('pk'))):
+            rows = queryset.order_by().values('hitcount').annotate(n=total)
+            for row in rows:
+                counts[row['hitcount']] += row['n']
+        return counts
+
+
+class VisitorSketchManager(models.Manager):
+
+    def add_visits(self, visits):
+        '''
+        Adds `visits`, (HitCount pk, day, visitor key) tuples, to the sketches
+        of their HitCounts and days, with one query per sketch which changed
+        (two for new ones).  Call it inside of a transaction.
+        '''
+        sketches = {}
+        for hitcount_pk, day, key in visits:
+            if (hitcount_pk, day) not in sketches:
+                sketches[(hitcount_pk, day)] = HyperLogLog()
+            sketches[(hitcount_pk, day)].add(key)
+
+        existing = self.select_for_update().filter(
+            hitcount__in=set(hitcount_pk for hitcount_pk, _ in sketches),
+            day__in=set(day for _, day in sketches))
+        for pk, hitcount_pk, day, text in existing.values_list(
+                'pk', 'hitcount', 'day', 'sketch'):
+            if (hitcount_pk, day) not in sketches:
+                continue
+            sketch = HyperLogLog.loads(text)
+            added = sketches.pop((hitcount_pk, day))
+            if any(new > old for new, old in zip(added.registers,
+                                                 sketch.registers)):
+                sketch.update(added)
+                self.filter(pk=pk).update(sketch=sketch.dumps())
+        self.bulk_create([
+            VisitorSketch(hitcount_id=hitcount_pk, day=day,
+                          sketch=sketch.dumps())
+            for (hitcount_pk, day), sketch in sketches.items()])
+
+    def unique_visitors(self, hitcount_pks, start=None, end=None):
+        '''
+        Returns a dict mapping each of the given HitCount primary keys to
+        the estimated number of distinct visitors it had from the `start`
+        date to the `end` date (both included, UTC; all days by default),
+        from the sketches and the hits which are not rolled up yet.  See
+        `hitcount.hll` for the error bounds.
+        '''
+        queryset = self.filter(hitcount__in=hitcount_pks)
+        # the hits which are not rolled up (and so sketched) yet
+        hits = Hit.objects.filter(hitcount__in=hitcount_pks,
+                pk__gt=RollupWatermark.objects.get_last_hit_id())
+        if start is not None:
+            queryset = queryset.filter(day__gte=start)
+            hits = hits.filter(created__gte=datetime.datetime.combine(
+                    start, datetime.time()))
+        if end is not None:
+            queryset = queryset.filter(day__lte=end)
+            hits = hits.filter(created__lt=datetime.datetime.combine(
+                    end + datetime.timedelta(days=1), datetime.time()))
+        merged = defaultdict(HyperLogLog)
+        for hitcount_pk, text in queryset.values_list('hitcount', 'sketch'):
+            merged[hitcount_pk].update(HyperLogLog.loads(text))
+        for hitcount_pk, user_pk, session_hash in hits.order_by(
+                ).values_list('hitcount', 'user', 'session_hash').iterator():
+            merged[hitcount_pk].add(visitor_key(user_pk, session_hash))
+        counts = dict((pk, 0) for pk in hitcount_pks)
+        for hitcount_pk, sketch in merged.items():
+            counts[hitcount_pk] = sketch.cardinality()
+        return counts
+
+
+class RollupWatermarkManager(models.Manager):
+
+    def get_last_hit_id(self):
+        '''
+        Returns the primary key of the last Hit included in the rollups.
+        '''
+        last_hit_ids = self.get_query_set().filter(
+                name=RollupWatermark.HITS).values_list('last_hit_id', flat=True)
+        return last_hit_ids[0] if last_hit_ids else 0
+
 
 # MODELS #
 
@@ -80,12 +498,14 @@ class HitCount(models.Model):
     content_type    = models.ForeignKey(ContentType,
                         verbose_name="content type",
                         related_name="content_type_set_for_%(class)s",)
-    object_pk       = models.TextField('object ID')
+    object_pk       = models.CharField('object ID', max_length=255)
     content_object  = generic.GenericForeignKey('content_type', 'object_pk')
 
+    objects = HitCountManager()
+
     class Meta:
         ordering = ( '-hits', )
-        #unique_together = (("content_type", "object_pk"),)
+        unique_together = (("content_type", "object_pk"),)
         get_latest_by = "modified"
         db_table = "hitcount_hit_count"
         verbose_name = "Hit Count"
@@ -96,43 +516,38 @@ class HitCount(models.Model):
 
     def save(self, *args, **kwargs):
         self.modified = datetime.datetime.utcnow()
-
-        if not self.pk and self.object_pk and self.content_type:
-            # Because we are using a models.TextField() for `object_pk` to
-            # allow *any* primary key type (integer or text), we
-            # can't use `unique_together` or `unique=True` to gaurantee
-            # that only one HitCount object exists for a given object.
-            #
-            # This is just a simple hack - if there is no `self.pk`
-            # set, it checks the database once to see if the `content_type`
-            # and `object_pk` exist together (uniqueness).  Obviously, this
-            # is not fool proof - if someone sets their own `id` or `pk` 
-            # when initializing the HitCount object, we could get a duplicate.
-            if HitCount.objects.filter(
-                    object_pk=self.object_pk).filter(
-                            content_type=self.content_type):
-                raise DuplicateContentObject, "A HitCount object already " + \
-                        "exists for this content_object."
-
         super(HitCount, self).save(*args, **kwargs)
 
     def hits_in_last(self, **kwargs):
         '''
         Returns hit count for an object during a given time period.
 
-        This will only work for as long as hits are saved in the Hit database.
-        If you are purging your database after 45 days, for example, that means
-        that asking for hits in the last 60 days will return an incorrect
-        number as that the longest period it can search will be 45 days.
-        
+        The count is answered from the hourly and daily hit rollups, so it
+        stays correct after old hits are purged from the Hit database as long
+        as `hitcount_rollup` is run before `hitcount_cleanup`.  See
+        `HitCountManager.hits_in_last`.
+
         For example: hits_in_last(days=7).
 
         Accepts days, seconds, microseconds, milliseconds, minutes, 
         hours, and weeks.  It's creating a datetime.timedelta object.
         '''
-        assert kwargs, "Must provide at least one timedelta arg (eg, days=1)"
-        period = datetime.datetime.utcnow() - datetime.timedelta(**kwargs)
-        return self.hit_set.filter(created__gte=period).count()
+        return HitCount.objects.hits_in_last([self.pk], **kwargs)[self.pk]
+
+    def unique_visitors(self, start=None, end=None):
+        '''
+        Returns the estimated number of distinct visitors (users, or
+        sessions for anonymous hits) from the `start` date to the `end`
+        date, both included (UTC; all days by default).
+
+        The estimate is merged from daily HyperLogLog sketches which are
+        kept when `hitcount_cleanup` deletes the hits.  It is typically
+        within 2.3% of the exact count (see `hitcount.hll`).
+
+        For example: unique_visitors(start=datetime.date(2012, 1, 1)).
+        '''
+        return VisitorSketch.objects.unique_visitors([self.pk], start,
+                                                     end)[self.pk]
 
     def get_content_object_url(self):
         '''
@@ -142,6 +557,25 @@ class HitCount(models.Model):
         pass
 
 
+class UserAgent(models.Model):
+    '''
+    A distinct User Agent string.  Hits refer to their User Agent instead
+    of repeating the string in every row.
+    '''
+    user_agent      = models.CharField(max_length=255, unique=True,
+                                       editable=False)
+
+    objects = UserAgentManager()
+
+    class Meta:
+        db_table = "hitcount_user_agent"
+        verbose_name = "User Agent"
+        verbose_name_plural = "User Agents"
+
+    def __unicode__(self):
+        return u'%s' % self.user_agent
+
+
 class Hit(models.Model):
     '''
     Model captures a single Hit by a visitor.
@@ -151,6 +585,12 @@ class Hit(models.Model):
     IP addresses and User Agents. Blacklisting simply causes those hits 
     to not be counted or recorded any more.
 
+    To keep the table small, the IP address is stored packed in 16 bytes,
+    the session key as a 64 bit hash (see `hitcount.utils.hash_session`)
+    and the User Agent as a reference to a UserAgent.  `user_agent` reads
+    and sets the User Agent string; a new string is looked up when the hit
+    is saved.
+
     Depending on how long you set the HITCOUNT_KEEP_HIT_ACTIVE , and how long
     you want to be able to use `HitCount.hits_in_last(days=30)` you should
     probably also occasionally clean out this database using a cron job.
@@ -158,9 +598,9 @@ class Hit(models.Model):
     It could get rather large.
     '''
     created         = models.DateTimeField(editable=False)
-    ip              = models.CharField(max_length=40, editable=False)
-    session         = models.CharField(max_length=40, editable=False)
-    user_agent      = models.CharField(max_length=255, editable=False)
+    ip              = PackedIPAddressField(null=True, editable=False)
+    session_hash    = models.BigIntegerField(editable=False)
+    agent           = models.ForeignKey(UserAgent, editable=False)
     user            = models.ForeignKey(User,null=True, editable=False)
     hitcount        = models.ForeignKey(HitCount, editable=False)
 
@@ -171,19 +611,47 @@ class Hit(models.Model):
     def __unicode__(self):
         return u'Hit: %s' % self.pk 
 
+    def _get_user_agent(self):
+        user_agent = getattr(self, '_user_agent', None)
+        if user_agent is None and self.agent_id is not None:
+            user_agent = self._user_agent = self.agent.user_agent
+        return user_agent
+
+    def _set_user_agent(self, value):
+        self._user_agent = value
+        self.agent_id = None
+        if hasattr(self, '_agent_cache'):
+            del self._agent_cache
+
+    user_agent = property(_get_user_agent, _set_user_agent)
+
+    def visitor_key(self):
+        '''
+        Returns a string which tells the visitor apart: the user for
+        authenticated hits, otherwise the session.
+        '''
+        return visitor_key(self.user_id, self.session_hash)
+
     def save(self, *args, **kwargs):
         '''
         The first time the object is created and saved, we increment 
         the associated HitCount object by one.  The opposite applies
         if the Hit is deleted.
         '''
-        if not self.created:
+        created = not self.created
+        if created:
             self.hitcount.hits = F('hits') + 1
             self.hitcount.save()
             self.created = datetime.datetime.utcnow()
+        UserAgent.objects.intern_hits([self])
 
         super(Hit, self).save(*args, **kwargs)
 
+        if created:
+            hit_count_changed.send(sender=HitCount,
+                    deltas={self.hitcount_id: 1},
+                    times={self.hitcount_id: [self.created]})
+
     objects = HitManager()
 
     def delete(self, save_hitcount=False):
@@ -192,16 +660,108 @@ class Hit(models.Model):
         HitCount object's total.  However, under normal circumstances, a 
         delete() will trigger a subtraction from the HitCount object's total.
 
-        NOTE: This doesn't work at all during a queryset.delete().
+        NOTE: This doesn't work at all during a queryset.delete().  Use
+        Hit.objects.delete_hits(queryset) to delete many hits at once.
         '''
         delete_hit_count.send(sender=self, instance=self, 
                 save_hitcount=save_hitcount)
         super(Hit, self).delete()
 
 
+class HitRollup(models.Model):
+    '''
+    Abstract model for the number of hits a HitCount got during a time
+    bucket.  Rollups are filled in by `hitcount.rollups.rollup_hits`.
+    '''
+    hitcount        = models.ForeignKey(HitCount, editable=False)
+    bucket          = models.DateTimeField(editable=False)
+    hits            = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        abstract = True
+        ordering = ( '-bucket', )
+        unique_together = (("hitcount", "bucket"),)
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.bucket, self.hits)
+
+
+class HourlyHitCount(HitRollup):
+    '''
+    Hits of a HitCount per hour (UTC), keyed by the start of the hour.
+    '''
+
+    class Meta(HitRollup.Meta):
+        db_table = "hitcount_hourly_hit_count"
+        verbose_name = "Hourly Hit Count"
+        verbose_name_plural = "Hourly Hit Counts"
+
+
+class DailyHitCount(HitRollup):
+    '''
+    Hits of a HitCount per day (UTC), keyed by the start of the day.
+    '''
+
+    class Meta(HitRollup.Meta):
+        db_table = "hitcount_daily_hit_count"
+        verbose_name = "Daily Hit Count"
+        verbose_name_plural = "Daily Hit Counts"
+
+
+class VisitorSketch(models.Model):
+    '''
+    A HyperLogLog sketch of the distinct visitors of a HitCount during a
+    day (UTC).  Sketches are updated when the hits are rolled up (see
+    `hitcount.rollups`) and are not removed by `hitcount_cleanup`.
+    '''
+    hitcount        = models.ForeignKey(HitCount, editable=False)
+    day             = models.DateField(editable=False)
+    sketch          = models.TextField(editable=False)
+
+    objects = VisitorSketchManager()
+
+    class Meta:
+        ordering = ( '-day', )
+        unique_together = (("hitcount", "day"),)
+        db_table = "hitcount_visitor_sketch"
+        verbose_name = "Visitor Sketch"
+        verbose_name_plural = "Visitor Sketches"
+
+    def __unicode__(self):
+        return u'%s: ~%s' % (self.day,
+                HyperLogLog.loads(self.sketch).cardinality())
+
+
+class RollupWatermark(models.Model):
+    '''
+    Remembers the last Hit which was included in the rollups so that each
+    rollup run only needs to read the hits saved since.  The SEEN row holds
+    the highest Hit pk at the time of the previous run (`modified`), up to
+    which the next runs may roll up once HITCOUNT_ROLLUP_DELAY has passed.
+    '''
+    HITS = 'hits'
+    SEEN = 'hits:seen'
+
+    name            = models.CharField(max_length=50, unique=True)
+    last_hit_id     = models.PositiveIntegerField(default=0)
+    modified        = models.DateTimeField(default=datetime.datetime.utcnow)
+
+    objects = RollupWatermarkManager()
+
+    class Meta:
+        db_table = "hitcount_rollup_watermark"
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.name, self.last_hit_id)
+
+
 
 class BlacklistIP(models.Model):
-    ip = models.CharField(max_length=40, unique=True)
+    '''
+    A blacklisted IPv4 or IPv6 address or, in CIDR notation, a whole network
+    of addresses (eg, 10.1.2.0/24 or 2001:db8::/32).
+    '''
+    ip = models.CharField(max_length=50, unique=True)
 
     class Meta: 
         db_table = "hitcount_blacklist_ip"
@@ -211,6 +771,14 @@ class BlacklistIP(models.Model):
     def __unicode__(self):
         return u'%s' % self.ip
 
+    def clean(self):
+        try:
+            version, network, prefixlen = parse_network(self.ip)
+        except ValueError as e:
+            raise ValidationError(str(e))
+        # Store the network in its canonical form (host bits cleared)
+        self.ip = format_network(version, network, prefixlen)
+
 
 class BlacklistUserAgent(models.Model):
     user_agent = models.CharField(max_length=255, unique=True)
@@ -223,3 +791,24 @@ class BlacklistUserAgent(models.Model):
     def __unicode__(self):
         return u'%s' % self.user_agent
 
+
+def blacklist_changed_callback(sender, **kwargs):
+    '''
+    Makes all processes reload the blacklists after an entry was saved or
+    deleted.
+    '''
+    from hitcount import blacklist
+    blacklist.invalidate()
+
+for blacklist_model in (BlacklistIP, BlacklistUserAgent):
+    post_save.connect(blacklist_changed_callback, sender=blacklist_model)
+    post_delete.connect(blacklist_changed_callback, sender=blacklist_model)
+
+
+def hitcount_deleted_callback(sender, instance, **kwargs):
+    '''
+    Forgets the pk of a deleted HitCount.
+    '''
+    _hitcount_pks.pop((instance.content_type_id, instance.object_pk))
+
+post_delete.connect(hitcount_deleted_callback, sender=HitCount)
@@ -0,0 +1,165 @@
+'''
+Optional monthly partitioning of the hitcount_hit table (MySQL only).
+
+Deleting expired hits row by row is the most expensive part of
+`hitcount_cleanup`.  Once the table is partitioned by month with
+
+    python manage.py hitcount_partition --setup
+
+`hitcount_cleanup` drops the partitions which only hold expired hits in one
+quick statement and only deletes the rows of the partly expired month one by
+one.  Run `hitcount_partition` (without --setup) monthly, eg from the
+cleanup cronjob, to keep HITCOUNT_PARTITION_MONTHS_AHEAD (3 by default)
+partitions ready for new hits; hits beyond the last partition go to the
+catch-all `pmax` partition.
+
+MySQL requires the partitioning column in every unique key and does not
+support foreign keys on partitioned tables, so --setup replaces the primary
+key by (id, created) and drops the foreign key constraints of the table.
+The ids stay unique as they are still assigned by AUTO_INCREMENT.
+'''
+import datetime
+import re
+
+from django.conf import settings
+
+from hitcount.models import Hit
+
+PARTITION_RE = re.compile(r'^p(\d{4})(\d{2})$')
+
+
+def is_supported(connection):
+    return connection.vendor == 'mysql'
+
+
+def _next_month(month):
+    if month.month == 12:
+        return datetime.date(month.year + 1, 1, 1)
+    return datetime.date(month.year, month.month + 1, 1)
+
+
+def _partition(month):
+    return "PARTITION p%s VALUES LESS THAN (TO_DAYS('%s'))" % (
+        month.strftime('%Y%m'), _next_month(month).isoformat())
+
+
+def _months_until(first, last):
+    '''
+    Returns the first days of the months from `first` to `last`, included.
+    '''
+    months = []
+    month = datetime.date(first.year, first.month, 1)
+    while month <= last:
+        months.append(month)
+        month = _next_month(month)
+    return months
+
+
+def _last_month():
+    ahead = getattr(settings, 'HITCOUNT_PARTITION_MONTHS_AHEAD', 3)
+    month = datetime.datetime.utcnow().date().replace(day=1)
+    for i in xrange(ahead):
+        month = _next_month(month)
+    return month
+
+
+def get_partitions(connection):
+    '''
+    Returns the first days of the months which have a partition, in order,
+    or an empty list if the table is not partitioned.
+    '''
+    if not is_supported(connection):
+        return []
+    cursor = connection.cursor()
+    cursor.execute("SELECT PARTITION_NAME FROM information_schema.PARTITIONS "
+                   "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND "
+                   "PARTITION_NAME IS NOT NULL "
+                   "ORDER BY PARTITION_ORDINAL_POSITION",
+                   [Hit._meta.db_table])
+    months = []
+    for name, in cursor.fetchall():
+        match = PARTITION_RE.match(name)
+        if match:
+            months.append(datetime.date(int(match.group(1)),
+                                        int(match.group(2)), 1))
+    return months
+
+
+def partition_table(connection):
+    '''
+    Partitions the table by month, from the month of its oldest hit to
+    HITCOUNT_PARTITION_MONTHS_AHEAD months from now.  Rebuilds the table.
+    '''
+    from django.db.models import Min
+    qn = connection.ops.quote_name
+    table = qn(Hit._meta.db_table)
+    cursor = connection.cursor()
+    cursor.execute("SELECT CONSTRAINT_NAME FROM "
+                   "information_schema.KEY_COLUMN_USAGE WHERE "
+                   "TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND "
+                   "REFERENCED_TABLE_NAME IS NOT NULL",
+                   [Hit._meta.db_table])
+    for name, in cursor.fetchall():
+        cursor.execute("ALTER TABLE %s DROP FOREIGN KEY %s" % (table,
+                                                               qn(name)))
+    oldest = Hit.objects.aggregate(oldest=Min('created'))['oldest']
+    first = (oldest or datetime.datetime.utcnow()).date()
+    partitions = [_partition(month)
+                  for month in _months_until(first, _last_month())]
+    partitions.append("PARTITION pmax VALUES LESS THAN MAXVALUE")
+    cursor.execute("ALTER TABLE %s DROP PRIMARY KEY, "
+                   "ADD PRIMARY KEY (%s, %s) "
+                   "PARTITION BY RANGE (TO_DAYS(%s)) (%s)" % (
+                       table, qn(Hit._meta.pk.column), qn('created'),
+                       qn('created'), ', '.join(partitions)))
+
+
+def add_partitions(connection):
+    '''
+    Splits partitions for the months up to HITCOUNT_PARTITION_MONTHS_AHEAD
+    months from now off the catch-all partition.  Returns the number of
+    partitions added.
+    '''
+    existing = get_partitions(connection)
+    if not existing:
+        return 0
+    months = _months_until(_next_month(existing[-1]), _last_month())
+    if months:
+        partitions = [_partition(month) for month in months]
+        partitions.append("PARTITION pmax VALUES LESS THAN MAXVALUE")
+        connection.cursor().execute(
+            "ALTER TABLE %s REORGANIZE PARTITION pmax INTO (%s)" % (
+                connection.ops.quote_name(Hit._meta.db_table),
+                ', '.join(partitions)))
+    return len(months)
+
+
+def expired_partitions(connection, before):
+    '''
+    Returns the names of the partitions which only hold hits created
+    before the datetime `before`.
+    '''
+    return ['p%s' % month.strftime('%Y%m')
+            for month in get_partitions(connection)
+            if _next_month(month) <= before.date()]
+
+
+def partition_end(name):
+    '''
+    Returns the datetime before which the named partition, and so all the
+    partitions before it, holds the hits.
+    '''
+    match = PARTITION_RE.match(name)
+    end = _next_month(datetime.date(int(match.group(1)),
+                                    int(match.group(2)), 1))
+    return datetime.datetime(end.year, end.month, end.day)
+
+
+def drop_partitions(connection, names):
+    '''
+    Drops the named partitions with all their hits, without touching the
+    HitCount totals.
+    '''
+    if names:
+        connection.cursor().execute("ALTER TABLE %s DROP PARTITION %s" % (
+            connection.ops.quote_name(Hit._meta.db_table), ', '.join(names)))
@@ -0,0 +1,63 @@
+'''
+A binary radix tree (trie) for longest-prefix matching of IP networks.
+
+Networks are inserted bit by bit, starting with the most significant one,
+so looking up an address takes at most as many steps as an address has bits
+(32 for IPv4, 128 for IPv6), no matter how many networks the tree holds.
+'''
+
+
+class PrefixTree(object):
+    '''
+    Maps networks -- (integer network, prefix length) pairs -- of a fixed
+    address width to values.
+
+    >>> tree = PrefixTree(32)
+    >>> tree.insert(0x0A010200, 24, '10.1.2.0/24')
+    >>> tree.insert(0x0A010203, 32, '10.1.2.3')
+    >>> tree.longest_match(0x0A010203)
+    '10.1.2.3'
+    >>> tree.longest_match(0x0A010204)
+    '10.1.2.0/24'
+    >>> tree.longest_match(0x0A010304) is None
+    True
+    '''
+    # Each node is a list: [child for a 0 bit, child for a 1 bit, value]
+
+    def __init__(self, bits):
+        self.bits = bits
+        self.size = 0
+        self._root = [None, None, None]
+
+    def __len__(self):
+        return self.size
+
+    def insert(self, network, prefixlen, value):
+        node = self._root
+        shift = self.bits - 1
+        for _ in xrange(prefixlen):
+            bit = (network >> shift) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+            shift -= 1
+        if node[2] is None:
+            self.size += 1
+        node[2] = value
+
+    def longest_match(self, address):
+        '''
+        Returns the value of the most specific network containing the
+        address or None if no network contains it.
+        '''
+        node = self._root
+        match = node[2]
+        shift = self.bits - 1
+        while shift >= 0:
+            node = node[(address >> shift) & 1]
+            if node is None:
+                break
+            if node[2] is not None:
+                match = node[2]
+            shift -= 1
+        return match
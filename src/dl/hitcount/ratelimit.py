@@ -0,0 +1,120 @@
+'''
+Sliding-window hit counters held in the cache.
+
+HITCOUNT_HITS_PER_IP_LIMIT used to be enforced by counting the active Hit
+rows of the IP address on every hit.  Instead, every recorded hit bumps a
+counter in the cache and the window (HITCOUNT_KEEP_HIT_ACTIVE) is split into
+a fixed number of buckets, so checking an address reads the same number of
+cache keys no matter how many hits it made.
+
+The oldest bucket is only partly inside the window; its hits are weighted by
+the part which is, assuming they were evenly spread over the bucket.  The
+counts are as precise as the cache backend keeps them: counters are lost if
+the cache is flushed or evicts them.
+
+The counters need a cache shared by all processes (memcached, database, ...;
+see CACHES in local_settings.py).  With a per-process cache (LocMemCache, the
+default) every process would count only its own share of an address' hits,
+multiplying the effective limit by the number of processes, and DummyCache
+keeps no counts at all.  With either of them `get_ip_hits` falls back to
+counting the active hits of the address in the database on every check.
+'''
+import datetime
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+
+from hitcount.models import Hit
+from hitcount.utils import timedelta_seconds
+
+
+class SlidingWindowCounter(object):
+    '''
+    Counts events per key over the last `window` seconds using `buckets`
+    counters per key.
+    '''
+
+    def __init__(self, prefix, window, buckets=24):
+        self.prefix = prefix
+        self.buckets = buckets
+        self.bucket_size = max(window // buckets, 1)
+        self.window = self.bucket_size * buckets
+        # Keep a bucket until it has left the window completely
+        self.timeout = self.window + self.bucket_size
+
+    def _key(self, key, bucket):
+        return '%s:%s:%d' % (self.prefix, key, bucket)
+
+    def incr(self, key, now=None):
+        '''
+        Adds an event for the key.
+        '''
+        bucket = int(now or time.time()) // self.bucket_size
+        cache_key = self._key(key, bucket)
+        try:
+            cache.incr(cache_key)
+        except ValueError:
+            if not cache.add(cache_key, 1, self.timeout):
+                cache.incr(cache_key)
+
+    def count(self, key, now=None):
+        '''
+        Returns the (approximate) number of events for the key in the
+        window ending now.
+        '''
+        now = now or time.time()
+        current = int(now) // self.bucket_size
+        keys = [self._key(key, bucket)
+                for bucket in xrange(current - self.buckets, current + 1)]
+        counts = cache.get_many(keys)
+        total = sum(counts.values())
+        # The part of the oldest bucket which already left the window
+        elapsed = float(now - current * self.bucket_size) / self.bucket_size
+        total -= counts.get(keys[0], 0) * elapsed
+        return int(round(total))
+
+
+class ActiveHitCounter(object):
+    '''
+    Counts the active hits (see `HitManager.filter_active`) per IP address
+    in the database, with one query per check.
+    '''
+
+    def incr(self, key, now=None):
+        # The saved hit is counted already
+        pass
+
+    def count(self, key, now=None):
+        return Hit.objects.filter_active(ip__exact=key).count()
+
+
+def cache_is_shared():
+    '''
+    Returns False if the cache keeps a separate copy per process or nothing
+    at all.
+    '''
+    return not isinstance(cache, (LocMemCache, DummyCache))
+
+
+_ip_hits = None
+
+
+def get_ip_hits():
+    '''
+    Returns the counter of recorded hits per IP address over the
+    HITCOUNT_KEEP_HIT_ACTIVE window: a SlidingWindowCounter if the cache is
+    shared by all processes, an ActiveHitCounter otherwise.
+    '''
+    global _ip_hits
+    if _ip_hits is None and not cache_is_shared():
+        _ip_hits = ActiveHitCounter()
+    if _ip_hits is None:
+        grace = getattr(settings, 'HITCOUNT_KEEP_HIT_ACTIVE', {'days': 7})
+        window = timedelta_seconds(datetime.timedelta(**grace))
+        _ip_hits = SlidingWindowCounter(
+            'hitcount:iphits', window,
+            getattr(settings, 'HITCOUNT_HITS_PER_IP_BUCKETS', 24))
+    return _ip_hits
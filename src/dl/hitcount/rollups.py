@@ -0,0 +1,170 @@
+'''
+Incremental rollups of hits into hourly and daily hit counts.
+
+Every run reads only the hits saved since the previous run (tracked by the
+RollupWatermark) and adds them to the HourlyHitCount and DailyHitCount
+buckets and their visitors to the daily VisitorSketches.  `HitCount.hits_in_last` answers from the rollups, so run the
+`hitcount_rollup` command regularly (eg, from the same cronjob and before
+`hitcount_cleanup`).
+
+Primary keys are assigned when a hit is inserted, but a hit only becomes
+visible when its transaction commits, so a hit with a lower pk may still show
+up after the watermark passed it.  Each run therefore only rolls up to the
+highest pk which a previous run observed at least HITCOUNT_ROLLUP_DELAY ago.
+Hits are rolled up by insertion order, whatever their created time: buffered
+and ingested hits are often saved long after they were created.
+'''
+import datetime
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Max
+
+from hitcount.models import Hit, HourlyHitCount, DailyHitCount
+from hitcount.models import RollupWatermark, VisitorSketch, visitor_key
+from hitcount.utils import naive_utc
+
+
+def _pop_existing_buckets(model, counts):
+    '''
+    Removes the buckets of `counts`, a dict mapping (hitcount pk, bucket)
+    pairs to a number of hits, which already exist in the rollup `model`.
+    Returns their primary keys grouped by the number of hits.
+    '''
+    existing = model.objects.filter(
+        hitcount__in=set(hitcount_pk for hitcount_pk, _ in counts),
+        bucket__in=set(bucket for _, bucket in counts))
+    pks_by_count = defaultdict(list)
+    for pk, hitcount_pk, bucket in existing.values_list('pk', 'hitcount',
+                                                        'bucket'):
+        bucket = naive_utc(bucket)
+        if (hitcount_pk, bucket) in counts:
+            pks_by_count[counts.pop((hitcount_pk, bucket))].append(pk)
+    return pks_by_count
+
+
+def _add_to_buckets(model, counts):
+    '''
+    Adds the hit counts, a dict mapping (hitcount pk, bucket) pairs to the
+    number of hits, to the rollup `model`.
+    '''
+    # Buckets which get the same number of hits share an UPDATE.
+    for increment, pks in _pop_existing_buckets(model, counts).items():
+        model.objects.filter(pk__in=pks).update(hits=F('hits') + increment)
+    model.objects.bulk_create([
+        model(hitcount_id=hitcount_pk, bucket=bucket, hits=hits)
+        for (hitcount_pk, bucket), hits in counts.items()])
+
+
+@transaction.commit_on_success
+def _settled_hit_id(delay):
+    '''
+    Returns the highest Hit pk which was observed at least `delay` ago, so
+    that every hit with a lower pk is committed by now, or None if there is
+    no such observation yet.  Records the current highest pk for a later run.
+    '''
+    now = datetime.datetime.utcnow()
+    last_hit_id = Hit.objects.aggregate(last=Max('pk'))['last'] or 0
+    if not delay:
+        return last_hit_id
+    seen, created = RollupWatermark.objects.select_for_update(
+        ).get_or_create(name=RollupWatermark.SEEN,
+                        defaults={'last_hit_id': last_hit_id, 'modified': now})
+    if created or naive_utc(seen.modified) > now - delay:
+        return None
+    settled = seen.last_hit_id
+    seen.last_hit_id = last_hit_id
+    seen.modified = now
+    seen.save()
+    return settled
+
+
+@transaction.commit_on_success
+def _rollup_batch(batch_size, last_hit_id):
+    watermark, created = RollupWatermark.objects.select_for_update(
+        ).get_or_create(name=RollupWatermark.HITS)
+    hits = Hit.objects.filter(pk__gt=watermark.last_hit_id,
+                              pk__lte=last_hit_id).order_by('pk')
+    hourly = defaultdict(int)
+    daily = defaultdict(int)
+    visits = []
+    rolled_up = 0
+    for pk, hitcount_pk, hit_created, user_pk, session_hash in \
+            hits.values_list('pk', 'hitcount', 'created', 'user',
+                             'session_hash')[:batch_size]:
+        hour = naive_utc(hit_created).replace(minute=0, second=0,
+                                              microsecond=0)
+        hourly[(hitcount_pk, hour)] += 1
+        daily[(hitcount_pk, hour.replace(hour=0))] += 1
+        visits.append((hitcount_pk, hour.date(),
+                       visitor_key(user_pk, session_hash)))
+        watermark.last_hit_id = pk
+        rolled_up += 1
+    if rolled_up:
+        _add_to_buckets(HourlyHitCount, hourly)
+        _add_to_buckets(DailyHitCount, daily)
+        VisitorSketch.objects.add_visits(visits)
+        watermark.save()
+    return rolled_up
+
+
+def _subtract_from_buckets(model, counts):
+    '''
+    Subtracts the hit counts, a dict mapping (hitcount pk, bucket) pairs to
+    the number of hits, from the rollup `model`.
+    '''
+    for decrement, pks in _pop_existing_buckets(model, counts).items():
+        model.objects.filter(pk__in=pks).update(hits=F('hits') - decrement)
+
+
+def unroll_hits(queryset):
+    '''
+    Subtracts the hits of `queryset` which are already included in the
+    rollups from their hourly and daily buckets.  Call it right before
+    deleting the hits, in the same transaction: the watermark stays locked
+    until the end of the transaction, so no rollup run can add the hits in
+    between.
+
+    Returns the number of hits subtracted.
+    '''
+    watermarks = list(RollupWatermark.objects.select_for_update().filter(
+        name=RollupWatermark.HITS).values_list('last_hit_id', flat=True))
+    if not watermarks:
+        return 0
+    hourly = defaultdict(int)
+    daily = defaultdict(int)
+    unrolled = 0
+    for hitcount_pk, hit_created in queryset.filter(
+            pk__lte=watermarks[0]).order_by().values_list(
+            'hitcount', 'created').iterator():
+        hour = naive_utc(hit_created).replace(minute=0, second=0,
+                                              microsecond=0)
+        hourly[(hitcount_pk, hour)] += 1
+        daily[(hitcount_pk, hour.replace(hour=0))] += 1
+        unrolled += 1
+    if unrolled:
+        _subtract_from_buckets(HourlyHitCount, hourly)
+        _subtract_from_buckets(DailyHitCount, daily)
+    return unrolled
+
+
+def rollup_hits(batch_size=5000):
+    '''
+    Rolls up the hits newer than the watermark in batches of `batch_size`,
+    each in its own transaction.  Only the hits up to the highest pk seen by
+    a run at least HITCOUNT_ROLLUP_DELAY (a timedelta dict, one minute by
+    default) ago are rolled up; the rest are left for a later run.
+
+    Returns the number of hits rolled up.
+    '''
+    delay = getattr(settings, 'HITCOUNT_ROLLUP_DELAY', {'minutes': 1})
+    last_hit_id = _settled_hit_id(datetime.timedelta(**delay))
+    if last_hit_id is None:
+        return 0
+    total = 0
+    while True:
+        rolled_up = _rollup_batch(batch_size, last_hit_id)
+        total += rolled_up
+        if rolled_up < batch_size:
+            return total
@@ -0,0 +1,10 @@
+-- Composite indexes matching the lookups on the hit path.  syncdb creates
+-- them with the table; run the hitcount_create_indexes command to add them
+-- to an existing table.
+
+-- Is there an active hit of the anonymous visitor on the HitCount?
+CREATE INDEX hitcount_hit_hitcount_session ON hitcount_hit (hitcount_id, session_hash, created);
+-- Is there an active hit of the user on the HitCount?
+CREATE INDEX hitcount_hit_hitcount_user ON hitcount_hit (hitcount_id, user_id, created);
+-- Hits of an IP address (the admin's ?ip= filter, HitAdmin search)
+CREATE INDEX hitcount_hit_ip_created ON hitcount_hit (ip, created);
@@ -0,0 +1,80 @@
+'''
+Asynchronous hit recording.
+
+With HITCOUNT_USE_ASYNC = True the `update_hit_count_ajax` view only checks
+the blacklists and queues the facts of the hit (see
+`hitcount.buffer.hit_to_facts`) for the celery workers, so its latency does
+not depend on the database.  Anonymous visitors are told apart by the
+signed cookie of `hitcount.dedupe` rather than by their session, which would
+have to be written.  The workers apply the remaining checks and
+write the hits right away or, with HITCOUNT_BUFFER = 'cache', in batches
+through the buffer shared by all processes.  A 'local' buffer is refused:
+each pool process would fill its own, `flush_hits` would only flush the one
+of the process it happens to run in, nothing would flush them when the pool
+processes exit (through os._exit) and a visitor's repeat hits would only be
+caught within one process.
+
+With the 'cache' buffer, run `flush_hits` periodically so that the last hits
+of a quiet period don't wait in the buffer for the next hit, eg with
+celerybeat:
+
+    CELERYBEAT_SCHEDULE = {
+        'flush-hits': {
+            'task': 'hitcount.tasks.flush_hits',
+            'schedule': timedelta(seconds=HITCOUNT_BUFFER_FLUSH_INTERVAL),
+        },
+    }
+'''
+from celery import task
+from celery.signals import worker_init
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from hitcount.buffer import get_hit_buffer, hit_from_facts
+
+
+def _get_hit_buffer():
+    '''
+    Returns the shared hit buffer of the workers or None if they save the
+    hits right away.
+    '''
+    if getattr(settings, 'HITCOUNT_BUFFER', None) == 'local':
+        raise ImproperlyConfigured("HITCOUNT_USE_ASYNC needs a HITCOUNT_BUFFER "
+                                   "shared by the workers ('cache') or none.")
+    return get_hit_buffer()
+
+
+@worker_init.connect
+def check_hit_buffer(**kwargs):
+    """
+    Refuses to start a worker recording hits with a process-local hit
+    buffer.
+    """
+    if getattr(settings, 'HITCOUNT_USE_ASYNC', False):
+        _get_hit_buffer()
+
+
+@task(ignore_result=True)
+def record_hit(facts):
+    """
+    Records a hit queued by `update_hit_count_ajax` unless it is a repeat
+    hit or excluded by the hitcount settings.
+    """
+    from hitcount.models import HitCount
+    from hitcount.views import _is_countable, _save_hits
+
+    hit = hit_from_facts(facts)
+    if not HitCount.objects.filter(pk=hit.hitcount_id).exists():
+        return
+    if _is_countable(hit):
+        _save_hits([hit], _get_hit_buffer())
+
+
+@task(ignore_result=True)
+def flush_hits():
+    """
+    Writes the hits waiting in the shared buffer to the database.
+    """
+    hit_buffer = _get_hit_buffer()
+    if hit_buffer is not None:
+        hit_buffer.flush()
@@ -1,9 +1,13 @@
+import datetime
+
 from django import template
+from django.conf import settings
+from django.utils import simplejson
 from django.template import TemplateSyntaxError
 from django.contrib.contenttypes.models import ContentType
 from django.core.urlresolvers import reverse
 
-from hitcount.models import HitCount
+from hitcount.models import HitCount, VisitorSketch
 
 register = template.Library()
 
@@ -43,26 +47,35 @@ class GetHitCount(template.Node):
     def handle_token(cls, parser, token):
         args = token.contents.split()
 
+        # {% get_hit_count for [obj] unique ... %} takes the same arguments
+        unique = len(args) > 3 and args[3] == 'unique'
+        if unique:
+            del args[3]
+
         # {% get_hit_count for [obj] %}        
         if len(args) == 3 and args[1] == 'for':
-            return cls(object_expr = parser.compile_filter(args[2]))
+            return cls(object_expr = parser.compile_filter(args[2]),
+                        unique      = unique)
         
         # {% get_hit_count for [obj] as [var] %}
         elif len(args) == 5 and args[1] == 'for' and args[3] == 'as':
             return cls(object_expr = parser.compile_filter(args[2]),
-                        as_varname  = args[4],)
+                        as_varname  = args[4],
+                        unique      = unique)
 
         # {% get_hit_count for [obj] within ["days=1,minutes=30"] %}
         elif len(args) == 5 and args[1] == 'for' and args[3] == 'within':
             return cls(object_expr = parser.compile_filter(args[2]),
-                        period = return_period_from_string(args[4]))
+                        period      = return_period_from_string(args[4]),
+                        unique      = unique)
 
         # {% get_hit_count for [obj] within ["days=1,minutes=30"] as [var] %}
         elif len(args) == 7 and args [1] == 'for' and \
                 args[3] == 'within' and args[5] == 'as':
             return cls(object_expr = parser.compile_filter(args[2]),
                         as_varname  = args[6],
-                        period      = return_period_from_string(args[4]))
+                        period      = return_period_from_string(args[4]),
+                        unique      = unique)
 
         else: # TODO - should there be more troubleshooting prior to bailing?
             raise TemplateSyntaxError, \
@@ -73,25 +86,36 @@ class GetHitCount(template.Node):
     handle_token = classmethod(handle_token)
 
 
-    def __init__(self, object_expr, as_varname=None, period=None):
+    def __init__(self, object_expr, as_varname=None, period=None,
+                 unique=False):
         self.object_expr = object_expr
         self.as_varname = as_varname
         self.period = period
+        self.unique = unique
 
 
     def render(self, context):
         ctype, object_pk = get_target_ctype_pk(context, self.object_expr)
         
-        obj, created = HitCount.objects.get_or_create(content_type=ctype, 
-                                            object_pk=object_pk)
+        pk = HitCount.objects.get_pk_for_object(ctype, object_pk)
         
-        if self.period: # if user sets a time period, use it
+        if self.unique: # visitors are counted per day
+            start = None
+            if self.period:
+                start = (datetime.datetime.utcnow() -
+                         datetime.timedelta(**self.period)).date()
+            hits = VisitorSketch.objects.unique_visitors([pk], start)[pk]
+        elif self.period: # if user sets a time period, use it
             try:
-                hits = obj.hits_in_last(**self.period)
+                hits = HitCount.objects.hits_in_last([pk], **self.period)[pk]
             except:
                 hits = '[hitcount error w/time period]'
         else:
-            hits = obj.hits
+            try:
+                hits = HitCount.objects.filter(pk=pk).values_list('hits',
+                                                            flat=True)[0]
+            except IndexError: # deleted by another process
+                hits = HitCount.objects.get_for_object(ctype, object_pk).hits
         
         if self.as_varname: # if user gives us a variable to return
             context[self.as_varname] = str(hits) 
@@ -116,6 +140,11 @@ def get_hit_count(parser, token):
     - Get total hits for an object over a certain time period as a variable:
       {% get_hit_count for [object] within ["days=1,minutes=30"] as [var] %}
 
+    - Add `unique` to get the estimated number of distinct visitors instead
+      (see HitCount.unique_visitors); a time period then covers whole days,
+      starting with the day it begins on:
+      {% get_hit_count for [object] unique within ["days=7"] as [var] %}
+
     The time arguments need to follow datetime.timedelta's limitations:         
     Accepts days, seconds, microseconds, milliseconds, minutes, 
     hours, and weeks. 
@@ -125,6 +154,93 @@ def get_hit_count(parser, token):
 register.tag('get_hit_count', get_hit_count)
 
 
+class GetHitCounts(template.Node):
+
+    def handle_token(cls, parser, token):
+        args = token.contents.split()
+
+        # {% get_hit_counts for [objects] as [var] %}
+        if len(args) == 5 and args[1] == 'for' and args[3] == 'as':
+            return cls(objects_expr = parser.compile_filter(args[2]),
+                        as_varname  = args[4])
+
+        # {% get_hit_counts for [objects] within ["days=1,minutes=30"] as [var] %}
+        elif len(args) == 7 and args[1] == 'for' and \
+                args[3] == 'within' and args[5] == 'as':
+            return cls(objects_expr = parser.compile_filter(args[2]),
+                        as_varname  = args[6],
+                        period      = return_period_from_string(args[4]))
+
+        else:
+            raise TemplateSyntaxError, \
+                    "'get_hit_counts' requires " + \
+                    "'for [objects] within [timeframe] as [variable]' " + \
+                    "(got %r)" % args
+
+    handle_token = classmethod(handle_token)
+
+
+    def __init__(self, objects_expr, as_varname, period=None):
+        self.objects_expr = objects_expr
+        self.as_varname = as_varname
+        self.period = period or {}
+
+
+    def render(self, context):
+        try:
+            objects = self.objects_expr.resolve(context)
+        except template.VariableDoesNotExist:
+            objects = []
+
+        # one query (or one per model for mixed lists) for all the objects
+        pks_by_ctype = {}
+        for obj in objects:
+            ctype = ContentType.objects.get_for_model(obj)
+            pks_by_ctype.setdefault(ctype, {})[unicode(obj.pk)] = obj.pk
+
+        counts = {}
+        for ctype, pks in pks_by_ctype.items():
+            hits = HitCount.objects.hits_for_objects(ctype, pks.keys(),
+                                                     **self.period)
+            for object_pk, pk in pks.items():
+                counts[pk] = hits[object_pk]
+
+        context[self.as_varname] = counts
+        return ''
+
+
+def get_hit_counts(parser, token):
+    '''
+    Returns the hit counts of a list of objects as a dict keyed by the
+    objects' pks, using a constant number of queries.  Use the `hit_count`
+    filter to look up a single object's count.
+
+    - Get total hits for each object as a specified variable:
+      {% get_hit_counts for [objects] as [var] %}
+
+    - Get hits for each object over a certain time period as a variable:
+      {% get_hit_counts for [objects] within ["days=1,minutes=30"] as [var] %}
+
+    For example:
+
+    {% get_hit_counts for video_list as counts %}
+    {% for video in video_list %}
+        {{ video.name }}: {{ counts|hit_count:video.pk }}
+    {% endfor %}
+    '''
+    return GetHitCounts.handle_token(parser, token)
+
+register.tag('get_hit_counts', get_hit_counts)
+
+
+@register.filter
+def hit_count(counts, pk):
+    '''
+    Looks up an object's count in the dict made by `get_hit_counts`.
+    '''
+    return counts.get(pk, 0)
+
+
 class GetHitCountJavascript(template.Node):
 
 
@@ -150,11 +266,10 @@ class GetHitCountJavascript(template.Node):
     def render(self, context):
         ctype, object_pk = get_target_ctype_pk(context, self.object_expr)
         
-        obj, created = HitCount.objects.get_or_create(content_type=ctype, 
-                        object_pk=object_pk)
+        pk = HitCount.objects.get_pk_for_object(ctype, object_pk)
 
         js =    "$.post( '" + reverse('hitcount_update_ajax') + "',"   + \
-                "\n\t{ hitcount_pk : '" + str(obj.pk) + "' },\n"         + \
+                "\n\t{ hitcount_pk : '" + str(pk) + "' },\n"         + \
                 "\tfunction(data, status) {\n"                         + \
                 "\t\tif (data.status == 'error') {\n"                  + \
                 "\t\t\t// do something for error?\n"                   + \
@@ -181,3 +296,107 @@ def get_hit_count_javascript(parser, token):
 
 register.tag('get_hit_count_javascript', get_hit_count_javascript)
 
+
+
+
+class GetHitCountBeacon(template.Node):
+
+    def handle_token(cls, parser, token):
+        args = token.contents.split()
+
+        # {% get_hit_count_beacon for [objects] %}
+        if len(args) == 3 and args[1] == 'for':
+            return cls(objects_expr = parser.compile_filter(args[2]))
+
+        # {% get_hit_count_beacon for [objects] callback [function] %}
+        elif len(args) == 5 and args[1] == 'for' and args[3] == 'callback':
+            return cls(objects_expr = parser.compile_filter(args[2]),
+                        callback    = args[4])
+
+        else:
+            raise TemplateSyntaxError, \
+                    "'get_hit_count_beacon' requires " + \
+                    "'for [objects] callback [function]' " + \
+                    "(got %r)" % args
+
+    handle_token = classmethod(handle_token)
+
+
+    def __init__(self, objects_expr, callback=None):
+        self.objects_expr = objects_expr
+        self.callback = callback
+
+
+    def render(self, context):
+        try:
+            objects = self.objects_expr.resolve(context)
+        except template.VariableDoesNotExist:
+            objects = []
+
+        # the HitCounts of the objects are looked up and, if missing,
+        # created in bulk (per model for mixed lists)
+        objects = [(ContentType.objects.get_for_model(obj), unicode(obj.pk))
+                   for obj in objects]
+        pks_by_ctype = {}
+        for ctype, object_pk in objects:
+            pks_by_ctype.setdefault(ctype, set()).add(object_pk)
+        for ctype, object_pks in pks_by_ctype.items():
+            pks_by_ctype[ctype] = HitCount.objects.get_pks_for_objects(
+                ctype, object_pks)
+        pks = [pks_by_ctype[ctype][object_pk] for ctype, object_pk in objects]
+        if not pks:
+            return ''
+
+        js =    "(function () {\n"                                           + \
+                "\tvar url = '" + reverse('hitcount_update_beacon') + "',\n"  + \
+                "\t\tpks = " + simplejson.dumps(pks) + ",\n"                 + \
+                "\t\ttoken = document.cookie.match(/(?:^|;\\s*)"             + \
+                settings.CSRF_COOKIE_NAME + "=([^;]*)/);\n"                   + \
+                "\ttoken = token ? decodeURIComponent(token[1]) : '';\n"
+        if self.callback:
+            js +=   "\t$.ajax({ url: url, type: 'POST', dataType: 'json',\n"  + \
+                    "\t\ttraditional: true,\n"                              + \
+                    "\t\tdata: { hitcount_pk: pks, "                         + \
+                    "csrfmiddlewaretoken: token },\n"                        + \
+                    "\t\tsuccess: function(data) {\n"                       + \
+                    "\t\t\tif (data.hits) { " + self.callback              + \
+                    "(data.hits); }\n\t\t} });\n"
+        else:
+            js +=   "\tif (window.FormData && navigator.sendBeacon) {\n"     + \
+                    "\t\tvar data = new FormData();\n"                      + \
+                    "\t\tfor (var i = 0; i < pks.length; i++) {\n"          + \
+                    "\t\t\tdata.append('hitcount_pk', pks[i]);\n\t\t}\n"  + \
+                    "\t\tdata.append('csrfmiddlewaretoken', token);\n"      + \
+                    "\t\tif (navigator.sendBeacon(url, data)) { return; }\n" + \
+                    "\t}\n"                                                 + \
+                    "\t$.ajax({ url: url, type: 'POST', traditional: true,\n" + \
+                    "\t\tdata: { hitcount_pk: pks, "                         + \
+                    "csrfmiddlewaretoken: token } });\n"
+        js += "})();"
+
+        return js
+
+def get_hit_count_beacon(parser, token):
+    '''
+    Returns javascript which records a hit on each object of a list with a
+    single request to the `update_hit_counts_beacon` view.
+
+    - Send the hits with navigator.sendBeacon, which also works while the
+      page is being left, falling back to jQuery in older browsers:
+      {% get_hit_count_beacon for [objects] %}
+
+    - Send the hits with jQuery and call a javascript function with the
+      updated totals, an object mapping HitCount pks to their hits:
+      {% get_hit_count_beacon for [objects] callback [function] %}
+
+    For example:
+
+    <script type="text/javascript"><!--
+    $(document).ready(function() {
+        {% get_hit_count_beacon for video_list %}
+    });
+    --></script>
+    '''
+    return GetHitCountBeacon.handle_token(parser, token)
+
+register.tag('get_hit_count_beacon', get_hit_count_beacon)
@@ -0,0 +1,1087 @@
+"""
+Unit tests for the hitcount application.
+"""
+
+import datetime
+import doctest
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from StringIO import StringIO
+
+from django.db import IntegrityError, connection
+from django.template import Context, Template
+from django.utils import simplejson
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.contrib.auth.models import User
+from django.core.cache import cache, get_cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.sessions.models import Session
+from django.core.urlresolvers import reverse
+
+from hitcount import blacklist
+from hitcount import buffer as hitcount_buffer
+from hitcount import archive
+from hitcount import heavyhitters
+from hitcount import partitions
+from hitcount import ratelimit
+from hitcount import models
+from hitcount import rollups
+from hitcount import tasks
+from hitcount import utils
+from hitcount.buffer import hit_to_facts, CacheHitBuffer
+from hitcount.hll import HyperLogLog
+from hitcount.ratelimit import SlidingWindowCounter
+from hitcount.utils import naive_utc, pack_ip
+from hitcount.models import Hit, HitCount, VisitorSketch
+from hitcount.models import BlacklistIP, BlacklistUserAgent
+
+
+def suite():
+    """
+    Defines a custom TestSuite so that the doctests of hitcount.utils are
+    run along with the TestCases.
+    """
+    suite = unittest.TestLoader().loadTestsFromModule(
+        sys.modules[__name__])
+    suite.addTest(doctest.DocTestSuite(utils))
+    return suite
+
+
+class HitTestCase(TestCase):
+    def setUp(self):
+        # Cached pks don't survive the rollback of the previous test
+        models._hitcount_pks.clear()
+        models._user_agent_pks.clear()
+
+
+class BlacklistCacheTest(TestCase):
+    def setUp(self):
+        blacklist.invalidate()
+
+    def test_no_queries_in_steady_state(self):
+        """
+        Tests that once the blacklists are loaded, checking a hit against
+        them does not hit the database.
+        """
+        BlacklistIP.objects.create(ip='10.1.2.3')
+        BlacklistUserAgent.objects.create(user_agent='EvilBot/1.0')
+        # Warm up the process-local copy
+        blacklist.is_blacklisted('127.0.0.1', 'Mozilla/5.0')
+        with self.assertNumQueries(0):
+            self.assertTrue(blacklist.is_blacklisted('10.1.2.3',
+                                                     'Mozilla/5.0'))
+            self.assertTrue(blacklist.is_blacklisted('127.0.0.1',
+                                                     'EvilBot/1.0'))
+            self.assertFalse(blacklist.is_blacklisted('127.0.0.1',
+                                                      'Mozilla/5.0'))
+
+    def test_invalidated_on_save_and_delete(self):
+        """
+        Tests that saving or deleting a blacklist entry is picked up by the
+        process-local copy.
+        """
+        self.assertFalse(blacklist.is_blacklisted('10.1.2.3', ''))
+        ip = BlacklistIP.objects.create(ip='10.1.2.3')
+        self.assertTrue(blacklist.is_blacklisted('10.1.2.3', ''))
+        ip.delete()
+        self.assertFalse(blacklist.is_blacklisted('10.1.2.3', ''))
+
+    def test_network_entries(self):
+        """
+        Tests that IPv4 and IPv6 networks in CIDR notation blacklist all the
+        addresses they contain.
+        """
+        BlacklistIP.objects.create(ip='10.1.2.0/24')
+        BlacklistIP.objects.create(ip='2001:db8::/32')
+        self.assertTrue(blacklist.is_blacklisted('10.1.2.200', ''))
+        self.assertFalse(blacklist.is_blacklisted('10.1.3.1', ''))
+        self.assertTrue(blacklist.is_blacklisted('2001:db8:1::1', ''))
+        self.assertFalse(blacklist.is_blacklisted('2001:db9::1', ''))
+
+
+    def test_unshared_cache(self):
+        """
+        Tests that the blacklists are not reloaded on every hit when the
+        cache doesn't keep the generation.
+        """
+        blacklist.cache = get_cache(
+            'django.core.cache.backends.dummy.DummyCache')
+        try:
+            blacklist.is_blacklisted('10.1.2.3', '')
+            with self.assertNumQueries(0):
+                self.assertFalse(blacklist.is_blacklisted('10.1.2.3', ''))
+            BlacklistIP.objects.create(ip='10.1.2.3')
+            self.assertTrue(blacklist.is_blacklisted('10.1.2.3', ''))
+        finally:
+            blacklist.cache = cache
+
+    def test_reload_interval(self):
+        """
+        Tests that a change made by another process is picked up after
+        RELOAD_INTERVAL even if the generation didn't change, as with a
+        per-process cache.
+        """
+        self.assertFalse(blacklist.is_blacklisted('10.1.2.3', ''))
+        # saved without bumping the generation
+        BlacklistIP.objects.bulk_create([BlacklistIP(ip='10.1.2.3')])
+        self.assertFalse(blacklist.is_blacklisted('10.1.2.3', ''))
+        blacklist.blacklist.loaded_at -= blacklist.RELOAD_INTERVAL
+        self.assertTrue(blacklist.is_blacklisted('10.1.2.3', ''))
+
+
+class CacheHitBufferTest(HitTestCase):
+    def setUp(self):
+        super(CacheHitBufferTest, self).setUp()
+        cache.clear()
+        self.hitcount = HitCount.objects.create(
+            content_type=ContentType.objects.get_for_model(User),
+            object_pk='1')
+        self.buffer = CacheHitBuffer(max_size=100, flush_size=100,
+                                     flush_interval=3600)
+        # Sets the time of the last flush
+        self.buffer.flush()
+
+    def _hit(self, session_hash):
+        return Hit(hitcount=self.hitcount, ip='10.0.0.1',
+                   session_hash=session_hash, user_agent='ua')
+
+    def test_flush_between_claim_and_write(self):
+        """
+        Tests that a flush running after `add` claimed a slot but before it
+        wrote the hit leaves the slot for the next flush.
+        """
+        incr = self.buffer._incr
+        flushed = []
+
+        def incr_then_flush(name, delta=1):
+            value = incr(name, delta)
+            if name == 'head':
+                flushed.append(self.buffer.flush())
+            return value
+        self.buffer._incr = incr_then_flush
+        self.buffer.add(self._hit(1))
+        self.buffer.add(self._hit(2))
+        self.buffer._incr = incr
+        # The second flush wrote the first hit, not the unwritten second
+        self.assertEqual(flushed, [0, 1])
+        self.assertEqual(self.buffer.flush(), 1)
+        self.assertEqual(Hit.objects.count(), 2)
+        self.assertEqual(self.buffer.stats(),
+                         {'queued': 0, 'flushed': 2, 'dropped': 0})
+
+    def test_abandoned_slot(self):
+        """
+        Tests that a slot which stays empty is eventually skipped.
+        """
+        self.buffer._incr('head')
+        self.buffer.add(self._hit(1))
+        self.assertEqual(self.buffer.flush(), 0)
+        self.buffer.GAP_TIMEOUT = 0
+        self.assertEqual(self.buffer.flush(), 1)
+        self.assertEqual(self.buffer.stats(),
+                         {'queued': 0, 'flushed': 1, 'dropped': 1})
+
+
+@override_settings(HITCOUNT_ROLLUP_DELAY={})
+class HitRollupTest(HitTestCase):
+    def setUp(self):
+        super(HitRollupTest, self).setUp()
+        self.hitcount = HitCount.objects.create(
+            content_type=ContentType.objects.get_for_model(User),
+            object_pk='1')
+
+    def _hit(self, pk=None, **ago):
+        hit = Hit(pk=pk, hitcount=self.hitcount, ip='10.0.0.1',
+                  session_hash=1, user_agent='ua')
+        hit.save()
+        hit.created = (datetime.datetime.utcnow() -
+                       datetime.timedelta(**ago))
+        hit.save()
+        return hit
+
+    def test_hits_in_last_survives_cleanup(self):
+        """
+        Tests that windowed counts are answered from the rollups once the
+        raw hits are gone.
+        """
+        self._hit(days=3)
+        self._hit(days=3, hours=1)
+        self._hit(days=10)
+        self.assertEqual(self.hitcount.hits_in_last(days=7), 2)
+        self.assertEqual(rollups.rollup_hits(), 3)
+        # Nothing left to roll up
+        self.assertEqual(rollups.rollup_hits(), 0)
+        Hit.objects.all().delete()
+        self.assertEqual(self.hitcount.hits_in_last(days=7), 2)
+        self.assertEqual(self.hitcount.hits_in_last(days=30), 3)
+
+    def test_hits_in_last_includes_recent_hits(self):
+        """
+        Tests that hits which are not rolled up yet are counted too.
+        """
+        self._hit(days=2)
+        rollups.rollup_hits()
+        self._hit(seconds=1)
+        self.assertEqual(self.hitcount.hits_in_last(days=7), 2)
+
+    def test_rollup_waits_for_uncommitted_hits(self):
+        """
+        Tests that hits are only rolled up to the highest pk seen at least
+        HITCOUNT_ROLLUP_DELAY ago, so that a hit committed after a hit with
+        a higher pk is not skipped, however old it is.
+        """
+        def age_observation():
+            models.RollupWatermark.objects.filter(
+                name=models.RollupWatermark.SEEN).update(
+                modified=datetime.datetime.utcnow() -
+                datetime.timedelta(minutes=2))
+
+        with self.settings(HITCOUNT_ROLLUP_DELAY={'minutes': 1}):
+            first = self._hit(hours=1)
+            self._hit(pk=first.pk + 2, hours=1)
+            self.assertEqual(rollups.rollup_hits(), 0)
+            # Committed late, with a pk below the hits seen already
+            self._hit(pk=first.pk + 1, days=3)
+            self.assertEqual(rollups.rollup_hits(), 0)
+            age_observation()
+            self._hit(hours=1)
+            self.assertEqual(rollups.rollup_hits(), 3)
+            self.assertEqual(self.hitcount.hits_in_last(days=7), 4)
+            age_observation()
+            self.assertEqual(rollups.rollup_hits(), 1)
+            Hit.objects.all().delete()
+            self.assertEqual(self.hitcount.hits_in_last(days=7), 4)
+
+    def test_cleanup_keeps_hits_not_rolled_up(self):
+        """
+        Tests that hitcount_cleanup only deletes expired hits which are
+        rolled up already.
+        """
+        self._hit(days=60)
+        self._hit(days=60)
+        output = StringIO()
+        call_command('hitcount_cleanup', sleep=0, stdout=output)
+        self.assertEqual(Hit.objects.count(), 2)
+        self.assertIn('run hitcount_rollup first', output.getvalue())
+        rollups.rollup_hits()
+        call_command('hitcount_cleanup', sleep=0, stdout=StringIO())
+        self.assertEqual(Hit.objects.count(), 0)
+
+    def test_cleanup_dry_run_with_partitions(self):
+        """
+        Tests that a dry run doesn't count the hits of the expired
+        partitions again among the hits it would delete row by row.
+        """
+        old = self._hit(days=90)
+        self._hit(days=40)
+        rollups.rollup_hits()
+        month = naive_utc(old.created)
+        expired_partitions = partitions.expired_partitions
+        partitions.expired_partitions = lambda connection, before: [
+            'p%s' % month.strftime('%Y%m')]
+        try:
+            output = StringIO()
+            call_command('hitcount_cleanup', sleep=0, dry_run=True,
+                         stdout=output)
+        finally:
+            partitions.expired_partitions = expired_partitions
+        self.assertIn('Would drop partitions p%s.' % month.strftime('%Y%m'),
+                      output.getvalue())
+        self.assertIn('Would delete 1 hits', output.getvalue())
+        self.assertEqual(Hit.objects.count(), 2)
+
+
+@override_settings(HITCOUNT_ROLLUP_DELAY={})
+class HitDeletionTest(HitTestCase):
+    def setUp(self):
+        super(HitDeletionTest, self).setUp()
+        ctype = ContentType.objects.get_for_model(User)
+        self.hitcounts = [HitCount.objects.create(content_type=ctype,
+                                                  object_pk=str(pk))
+                          for pk in range(2)]
+        for i in range(5):
+            for hitcount in self.hitcounts:
+                Hit(hitcount=hitcount, ip='10.0.0.%d' % (i % 2),
+                    session_hash=i, user_agent='ua').save()
+
+    def _hits(self):
+        return [HitCount.objects.get(pk=hitcount.pk).hits
+                for hitcount in self.hitcounts]
+
+    def test_delete_hits(self):
+        """
+        Tests that bulk deleting hits subtracts them from the totals.
+        """
+        self.assertEqual(self._hits(), [5, 5])
+        deleted = Hit.objects.delete_hits(Hit.objects.filter(ip='10.0.0.0'),
+                                          batch_size=2)
+        self.assertEqual(deleted, 6)
+        self.assertEqual(self._hits(), [2, 2])
+        self.assertEqual(Hit.objects.count(), 4)
+
+    def test_delete_hits_save_hitcount(self):
+        """
+        Tests that the totals are preserved with save_hitcount=True.
+        """
+        Hit.objects.delete_hits(save_hitcount=True)
+        self.assertEqual(self._hits(), [5, 5])
+        self.assertEqual(Hit.objects.count(), 0)
+
+    def test_delete_rolled_up_hits(self):
+        """
+        Tests that deleting hits subtracts the rolled up ones from the
+        hourly and daily rollups, but not the ones which are kept for the
+        totals.
+        """
+        two_days_ago = datetime.datetime.utcnow() - datetime.timedelta(days=2)
+        Hit.objects.update(created=two_days_ago)
+        self.assertEqual(rollups.rollup_hits(), 10)
+        # A new hit which isn't rolled up yet
+        Hit(hitcount=self.hitcounts[0], ip='10.0.0.0', session_hash=5,
+            user_agent='ua').save()
+        Hit.objects.delete_hits(Hit.objects.filter(
+            ip='10.0.0.0', hitcount=self.hitcounts[0]))
+        self.assertEqual(self._hits(), [2, 5])
+        for model in (models.HourlyHitCount, models.DailyHitCount):
+            self.assertEqual(sorted(model.objects.values_list(
+                'hitcount', 'hits')), [(self.hitcounts[0].pk, 2),
+                                       (self.hitcounts[1].pk, 5)])
+        self.assertEqual(self.hitcounts[0].hits_in_last(days=7), 2)
+
+        Hit.objects.filter(hitcount=self.hitcounts[1])[0].delete()
+        Hit.objects.delete_hits(save_hitcount=True)
+        self.assertEqual(self.hitcounts[1].hits_in_last(days=7), 4)
+
+
+class PackedIPAddressFieldTest(HitTestCase):
+    ADDRESSES = ['10.0.0.1', '255.255.255.255', '::1', '2001:db8::1',
+                 # 16 characters, like a packed address
+                 '2001:db8:1:2::10',
+                 'fe80::1234:5678:9abc:def0',
+                 # packed, the 16 bytes spell out '2001:db8:1:2::10'
+                 '3230:3031:3a64:6238:3a31:3a32:3a3a:3130']
+
+    def setUp(self):
+        super(PackedIPAddressFieldTest, self).setUp()
+        self.hitcount = HitCount.objects.create(
+            content_type=ContentType.objects.get_for_model(User),
+            object_pk='1')
+
+    def test_round_trip(self):
+        """
+        Tests that IPv4 and IPv6 addresses read back as saved.
+        """
+        for session_hash, ip in enumerate(self.ADDRESSES):
+            Hit(hitcount=self.hitcount, ip=ip, session_hash=session_hash,
+                user_agent='ua').save()
+        Hit(hitcount=self.hitcount, ip='10.0.0', session_hash=-1,
+            user_agent='ua').save()
+        hits = Hit.objects.order_by('session_hash')
+        self.assertEqual([hit.ip for hit in hits],
+                         [None] + self.ADDRESSES)
+        ip_field = Hit._meta.get_field('ip')
+        self.assertEqual([ip_field.to_python(ip) for ip in
+                          hits.values_list('ip', flat=True)],
+                         [None] + self.ADDRESSES)
+        for ip in self.ADDRESSES:
+            self.assertEqual(Hit.objects.get(ip=ip).ip, ip)
+        self.assertEqual(Hit.objects.filter(ip__in=self.ADDRESSES).count(),
+                         len(self.ADDRESSES))
+        # IPv4-mapped addresses are stored as IPv4 addresses
+        self.assertEqual(Hit.objects.filter(ip='::ffff:10.0.0.1').count(), 1)
+
+    def test_to_python(self):
+        """
+        Tests that text is never mistaken for a packed address.
+        """
+        ip_field = Hit._meta.get_field('ip')
+        packed = pack_ip('2001:db8:1:2::10')
+        self.assertEqual(ip_field.to_python(bytearray(packed)),
+                         '2001:db8:1:2::10')
+        self.assertEqual(ip_field.to_python(buffer(packed)),
+                         '2001:db8:1:2::10')
+        self.assertEqual(ip_field.to_python('2001:db8:1:2::10'),
+                         '2001:db8:1:2::10')
+        self.assertEqual(ip_field.to_python(u'10.0.0.1'), u'10.0.0.1')
+
+
+class HitCountLookupTest(HitTestCase):
+    def setUp(self):
+        super(HitCountLookupTest, self).setUp()
+        self.ctype = ContentType.objects.get_for_model(User)
+        self.user = User.objects.create(username='viewer')
+
+    def test_unique_object(self):
+        """
+        Tests that the database refuses a second HitCount for an object.
+        """
+        HitCount.objects.create(content_type=self.ctype, object_pk='1')
+        self.assertRaises(IntegrityError, HitCount.objects.create,
+                          content_type=self.ctype, object_pk='1')
+
+    def test_pk_cache(self):
+        """
+        Tests that integer and string object pks share a cached HitCount pk
+        and that deleted HitCounts are forgotten.
+        """
+        pk = HitCount.objects.get_pk_for_object(self.ctype, self.user.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(HitCount.objects.get_pk_for_object(
+                self.ctype, str(self.user.pk)), pk)
+        HitCount.objects.get(pk=pk).delete()
+        new_pk = HitCount.objects.get_pk_for_object(self.ctype, self.user.pk)
+        self.assertEqual(HitCount.objects.get(pk=new_pk).object_pk,
+                         unicode(self.user.pk))
+
+    def test_pk_cache_timeout(self):
+        """
+        Tests that cached pks are looked up again once they are older than
+        HITCOUNT_PK_CACHE_TIMEOUT, so that a HitCount deleted by another
+        process is not used for long.
+        """
+        pk = HitCount.objects.get_pk_for_object(self.ctype, self.user.pk)
+        HitCount.objects.create(content_type=self.ctype, object_pk='1000')
+        HitCount.objects.get(pk=pk).delete()
+        # Still cached by the other processes
+        max_age = models._hitcount_pks.max_age
+        models._hitcount_pks.max_age = 0
+        try:
+            models._hitcount_pks[(self.ctype.pk, unicode(self.user.pk))] = pk
+            new_pk = HitCount.objects.get_pk_for_object(self.ctype,
+                                                        self.user.pk)
+        finally:
+            models._hitcount_pks.max_age = max_age
+        self.assertNotEqual(new_pk, pk)
+        self.assertTrue(HitCount.objects.filter(pk=new_pk).exists())
+
+    def test_javascript_tag_queries(self):
+        """
+        Tests that rendering the javascript tag for a known object does not
+        query the hitcount tables.
+        """
+        template = Template('{% load hitcount_tags %}'
+                            '{% get_hit_count_javascript for obj %}')
+        context = Context({'obj': self.user})
+        first = template.render(context)
+        with self.assertNumQueries(0):
+            self.assertEqual(template.render(context), first)
+
+    def test_hit_counts_tag(self):
+        """
+        Tests that the counts of a list of objects are looked up with a
+        constant number of queries.
+        """
+        users = [self.user] + [User.objects.create(username='user%d' % i)
+                               for i in range(3)]
+        for user in users[:2]:
+            hitcount = HitCount.objects.get_for_object(self.ctype, user.pk)
+            Hit(hitcount=hitcount, ip='10.0.0.1', session_hash=1,
+                user_agent='ua').save()
+        template = Template('{% load hitcount_tags %}'
+                            '{% get_hit_counts for users as counts %}'
+                            '{% get_hit_counts for users within "days=1" '
+                            'as recent %}'
+                            '{% for user in users %}'
+                            '{{ counts|hit_count:user.pk }}'
+                            '{{ recent|hit_count:user.pk }} '
+                            '{% endfor %}')
+        # one for the totals, one plus those of hits_in_last for the window
+        with self.assertNumQueries(1 + 6):
+            self.assertEqual(template.render(Context({'users': users})),
+                             '11 11 00 00 ')
+
+
+class SlidingWindowCounterTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_window(self):
+        """
+        Tests that events are counted for as long as they are in the window
+        and that the oldest bucket is weighted by its overlap.
+        """
+        counter = SlidingWindowCounter('test', 100, buckets=10)
+        for i in range(4):
+            counter.incr('10.0.0.1', now=1000)
+        counter.incr('10.0.0.2', now=1000)
+        self.assertEqual(counter.count('10.0.0.1', now=1005), 4)
+        self.assertEqual(counter.count('10.0.0.1', now=1095), 4)
+        self.assertEqual(counter.count('10.0.0.1', now=1105), 2)
+        self.assertEqual(counter.count('10.0.0.1', now=1110), 0)
+        self.assertEqual(counter.count('10.0.0.2', now=1005), 1)
+
+    def test_unshared_cache_fallback(self):
+        """
+        Tests that hits per IP address are counted in the database when the
+        cache is not shared by the processes.
+        """
+        self.assertFalse(ratelimit.cache_is_shared())
+        ratelimit._ip_hits = None
+        try:
+            ip_hits = ratelimit.get_ip_hits()
+        finally:
+            ratelimit._ip_hits = None
+        self.assertTrue(isinstance(ip_hits, ratelimit.ActiveHitCounter))
+        hitcount = HitCount.objects.create(
+            content_type=ContentType.objects.get_for_model(User),
+            object_pk='1')
+        for session_hash in (1, 2):
+            Hit(hitcount=hitcount, ip='10.0.0.1', session_hash=session_hash,
+                user_agent='ua').save()
+        self.assertEqual(ip_hits.count('10.0.0.1'), 2)
+        self.assertEqual(ip_hits.count('10.0.0.2'), 0)
+
+
+class AsyncHitTest(HitTestCase):
+    def _record_hits(self):
+        hitcount = HitCount.objects.create(
+            content_type=ContentType.objects.get_for_model(User),
+            object_pk='1')
+        for session_hash in (1, 1, 2):
+            tasks.record_hit(hit_to_facts(Hit(
+                hitcount=hitcount, ip='10.0.0.1', session_hash=session_hash,
+                user_agent='ua', created=datetime.datetime.utcnow())))
+        # a hit on a HitCount which does not exist is ignored
+        tasks.record_hit(hit_to_facts(Hit(
+            hitcount_id=hitcount.pk + 1, ip='10.0.0.1', session_hash=3,
+            user_agent='ua', created=datetime.datetime.utcnow())))
+        return hitcount
+
+    def test_record_hit(self):
+        """
+        Tests that queued hits are deduplicated and written by the worker.
+        """
+        hitcount = self._record_hits()
+        self.assertEqual(Hit.objects.count(), 2)
+        self.assertEqual(HitCount.objects.get(pk=hitcount.pk).hits, 2)
+
+    def test_record_hit_shared_buffer(self):
+        """
+        Tests that the queued hits are written through the 'cache' buffer
+        and that a 'local' buffer is refused.
+        """
+        hitcount_buffer._hit_buffer = None
+        try:
+            with self.settings(HITCOUNT_BUFFER='cache'):
+                hitcount = self._record_hits()
+                tasks.flush_hits()
+            hitcount_buffer._hit_buffer = None
+            with self.settings(HITCOUNT_BUFFER='local',
+                               HITCOUNT_USE_ASYNC=True):
+                self.assertRaises(ImproperlyConfigured, tasks.flush_hits)
+                self.assertRaises(ImproperlyConfigured,
+                                  tasks.check_hit_buffer)
+        finally:
+            hitcount_buffer._hit_buffer = None
+        self.assertEqual(Hit.objects.count(), 2)
+        self.assertEqual(HitCount.objects.get(pk=hitcount.pk).hits, 2)
+
+    def test_queue_hit_without_session(self):
+        """
+        Tests that anonymous visitors are told apart by the signed cookie
+        rather than by a session when hits are queued.
+        """
+        hitcount = HitCount.objects.create(
+            content_type=ContentType.objects.get_for_model(User),
+            object_pk='1')
+        queued = []
+        delay = tasks.record_hit.delay
+        tasks.record_hit.delay = queued.append
+        try:
+            with self.settings(HITCOUNT_USE_ASYNC=True):
+                for i in range(2):
+                    response = self.client.post(
+                        reverse('hitcount_update_ajax'),
+                        {'hitcount_pk': hitcount.pk},
+                        HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+                    self.assertIn(['queued', 'no hit recorded'][i],
+                                  response.content)
+        finally:
+            tasks.record_hit.delay = delay
+        self.assertEqual(len(queued), 1)
+        self.assertEqual(Session.objects.count(), 0)
+
+
+class CookieDedupeTest(HitTestCase):
+    def setUp(self):
+        super(CookieDedupeTest, self).setUp()
+        cache.clear()
+        self.hitcount = HitCount.objects.create(
+            content_type=ContentType.objects.get_for_model(User),
+            object_pk='1')
+
+    def _hit(self, client=None):
+        return (client or self.client).post(
+            reverse('hitcount_update_ajax'),
+            {'hitcount_pk': self.hitcount.pk},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+
+    def test_cookie(self):
+        """
+        Tests that anonymous repeat hits are recognized by the cookie
+        without creating sessions.
+        """
+        with self.settings(HITCOUNT_DEDUPE='cookie'):
+            self.assertIn('success', self._hit().content)
+            self.assertIn('no hit recorded', self._hit().content)
+            # a new visitor
+            self.client.cookies.clear()
+            self.assertIn('success', self._hit().content)
+        self.assertEqual(HitCount.objects.get(pk=self.hitcount.pk).hits, 2)
+        self.assertEqual(len(set(Hit.objects.values_list(
+            'session_hash', flat=True))), 2)
+        self.assertEqual(Session.objects.count(), 0)
+
+    def test_cache_seen_set(self):
+        """
+        Tests that clients dropping the cookie are recognized by the cache.
+        """
+        with self.settings(HITCOUNT_DEDUPE='cookie',
+                           HITCOUNT_DEDUPE_CACHE=True):
+            self.assertIn('success', self._hit().content)
+            self.client.cookies.clear()
+            self.assertIn('no hit recorded', self._hit().content)
+
+
+class HeavyHitterTest(HitTestCase):
+    def setUp(self):
+        super(HeavyHitterTest, self).setUp()
+        heavyhitters._heavy_hitters = None
+        self.hitcount = HitCount.objects.create(
+            content_type=ContentType.objects.get_for_model(User),
+            object_pk='1')
+
+    def tearDown(self):
+        heavyhitters._heavy_hitters = None
+
+    def test_space_saving(self):
+        """
+        Tests that frequent keys are tracked in bounded memory with correct
+        bounds on their counts.
+        """
+        tracker = heavyhitters.SpaceSaving(10)
+        for i in xrange(1000):
+            tracker.add('heavy' if i % 3 else 'other:%d' % i)
+            if i % 5 == 0:
+                tracker.add('medium')
+        self.assertEqual(len(tracker), 10)
+        for key, exact in (('heavy', 666), ('medium', 200)):
+            count, error = tracker.get(key)
+            self.assertTrue(count - error <= exact <= count)
+
+    def test_throttle(self):
+        """
+        Tests that clients above the limit are rejected within the window.
+        """
+        def hit(ip):
+            return self.client.post(reverse('hitcount_update_ajax'),
+                                    {'hitcount_pk': self.hitcount.pk},
+                                    HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+                                    REMOTE_ADDR=ip)
+        with self.settings(HITCOUNT_THROTTLE_IP_LIMIT=2,
+                           HITCOUNT_THROTTLE_WINDOW={'days': 1}):
+            for i in xrange(2):
+                self.assertEqual(hit('10.0.0.1').status_code, 200)
+            self.assertEqual(hit('10.0.0.1').status_code, 429)
+            self.assertEqual(hit('10.0.0.2').status_code, 200)
+        tracker = heavyhitters.get_heavy_hitters()
+        self.assertEqual(tracker.top('ip', 1), [('10.0.0.1', 3, 3)])
+        # the previous period fades out
+        window = tracker.window
+        later = (int(time.time()) // window + 1) * window + window / 2.0
+        self.assertEqual(tracker.top('ip', 1, now=later),
+                         [('10.0.0.1', 1, 1)])
+        self.assertEqual(tracker.top('ip', now=later + tracker.window), [])
+
+    def test_admin_view(self):
+        """
+        Tests that heavy hitters are listed and blacklisted from the admin.
+        """
+        heavyhitters.get_heavy_hitters().add('10.9.9.9', 'Scraper/1.0')
+        User.objects.create_superuser('admin', 'admin@example.com', 'pw')
+        self.client.login(username='admin', password='pw')
+        url = reverse('admin:hitcount_hit_heavy_hitters')
+        response = self.client.get(url)
+        self.assertContains(response, '10.9.9.9')
+        self.assertContains(response, 'Scraper/1.0')
+        self.client.post(url, {'ip': '10.9.9.9'})
+        self.client.post(url, {'user_agent': 'Scraper/1.0'})
+        self.assertTrue(blacklist.is_blacklisted('10.9.9.9', ''))
+        self.assertTrue(blacklist.is_blacklisted('', 'Scraper/1.0'))
+
+
+class HitIndexTest(HitTestCase):
+    def _plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+        return ' '.join(row[-1] for row in cursor.fetchall())
+
+    @unittest.skipUnless(connection.vendor == 'sqlite', "SQLite only")
+    def test_planner_uses_indexes(self):
+        """
+        Tests that the lookups of the hit path use the composite indexes.
+        """
+        active = Hit.objects.filter_active().order_by()
+        for queryset, index in (
+                (active.filter(session_hash=1, hitcount=1),
+                    'hitcount_hit_hitcount_session'),
+                (active.filter(user=1, hitcount=1),
+                    'hitcount_hit_hitcount_user'),
+                (active.filter(ip='10.0.0.1'), 'hitcount_hit_ip_created')):
+            plan = self._plan(queryset)
+            self.assertIn(index, plan)
+            self.assertNotIn('SCAN', plan)
+
+    def test_create_indexes(self):
+        """
+        Tests that existing indexes are skipped.
+        """
+        output = StringIO()
+        call_command('hitcount_create_indexes', stdout=output)
+        self.assertIn('Created 0 indexes.', output.getvalue())
+
+    def test_partition_clauses(self):
+        """
+        Tests the monthly partition bounds across the end of a year.
+        """
+        months = partitions._months_until(datetime.date(2012, 11, 15),
+                                          datetime.date(2013, 1, 1))
+        self.assertEqual([partitions._partition(month) for month in months], [
+            "PARTITION p201211 VALUES LESS THAN (TO_DAYS('2012-12-01'))",
+            "PARTITION p201212 VALUES LESS THAN (TO_DAYS('2013-01-01'))",
+            "PARTITION p201301 VALUES LESS THAN (TO_DAYS('2013-02-01'))"])
+        self.assertEqual(partitions.partition_end('p201212'),
+                         datetime.datetime(2013, 1, 1))
+
+
+class BeaconTest(HitTestCase):
+    def setUp(self):
+        super(BeaconTest, self).setUp()
+        ctype = ContentType.objects.get_for_model(User)
+        self.users = [User.objects.create(username='user%d' % i)
+                      for i in xrange(3)]
+        self.pks = [HitCount.objects.get_pk_for_object(ctype, user.pk)
+                    for user in self.users]
+
+    def _beacon(self, pks):
+        return simplejson.loads(self.client.post(
+            reverse('hitcount_update_beacon'), {'hitcount_pk': pks}).content)
+
+    def test_beacon(self):
+        """
+        Tests that a single request records hits on several HitCounts and
+        returns their totals.
+        """
+        data = self._beacon(self.pks[:2])
+        self.assertEqual(data['status'], 'success')
+        self.assertEqual(data['counted'], self.pks[:2])
+        self.assertEqual(data['hits'], {str(self.pks[0]): 1,
+                                        str(self.pks[1]): 1})
+        # repeat hits are not counted again
+        data = self._beacon(self.pks)
+        self.assertEqual(data['counted'], [self.pks[2]])
+        self.assertEqual(sorted(data['hits'].values()), [1, 1, 1])
+        self.assertEqual(Hit.objects.count(), 3)
+        self.assertEqual(self.client.post(reverse('hitcount_update_beacon'),
+            {'hitcount_pk': 'x'}).status_code, 400)
+
+    def test_beacon_ip_limit(self):
+        """
+        Tests that every hit of a beacon counts against
+        HITCOUNT_HITS_PER_IP_LIMIT.
+        """
+        cache.clear()
+        with self.settings(HITCOUNT_HITS_PER_IP_LIMIT=1):
+            self.assertEqual(self._beacon(self.pks)['counted'],
+                             self.pks[:2])
+            self.client.cookies.clear()
+            self.assertEqual(self._beacon(self.pks)['counted'], [])
+        self.assertEqual(Hit.objects.count(), 2)
+
+    def test_ajax_total(self):
+        """
+        Tests that the AJAX view returns the total including the new hit.
+        """
+        for status in ('success', 'no hit recorded'):
+            data = simplejson.loads(self.client.post(
+                reverse('hitcount_update_ajax'),
+                {'hitcount_pk': self.pks[0]},
+                HTTP_X_REQUESTED_WITH='XMLHttpRequest').content)
+            self.assertEqual(data, {'status': status, 'hits': 1})
+
+    def test_beacon_tag(self):
+        """
+        Tests that the tag posts the HitCounts of all the objects at once.
+        """
+        js = Template("{% load hitcount_tags %}"
+                      "{% get_hit_count_beacon for users %}").render(
+                          Context({'users': self.users}))
+        self.assertIn(reverse('hitcount_update_beacon'), js)
+        self.assertIn('pks = %s' % simplejson.dumps(self.pks), js)
+        self.assertIn('navigator.sendBeacon', js)
+        js = Template("{% load hitcount_tags %}"
+                      "{% get_hit_count_beacon for users callback show %}"
+                      ).render(Context({'users': self.users}))
+        self.assertIn('show(data.hits)', js)
+
+    def test_beacon_tag_queries(self):
+        """
+        Tests that the tag looks up and creates the HitCounts of the objects
+        with a constant number of queries.
+        """
+        users = self.users + [User.objects.create(username='new%d' % i)
+                              for i in xrange(3)]
+        models._hitcount_pks.clear()
+        template = Template("{% load hitcount_tags %}"
+                            "{% get_hit_count_beacon for users %}")
+        # look up, create the missing ones and fetch their pks
+        with self.assertNumQueries(3):
+            js = template.render(Context({'users': users}))
+        pks = [HitCount.objects.get(object_pk=unicode(user.pk)).pk
+               for user in users]
+        self.assertEqual(pks[:3], self.pks)
+        self.assertIn('pks = %s' % simplejson.dumps(pks), js)
+        with self.assertNumQueries(0):
+            template.render(Context({'users': users}))
+
+
+class LogIngestTest(HitTestCase):
+    LOG = [
+        '10.0.0.1 - - [10/Oct/2012:13:55:36 +0200] "GET /users/%(pk)s/ '
+            'HTTP/1.1" 200 512 "-" "Mozilla/5.0"',
+        # a repeat hit
+        '10.0.0.1 - - [10/Oct/2012:14:00:00 +0200] "GET /users/%(pk)s/?a=1 '
+            'HTTP/1.1" 200 512 "-" "Mozilla/5.0"',
+        '10.0.0.2 - - [10/Oct/2012:12:00:00 +0000] "GET /users/%(pk)s/ '
+            'HTTP/1.0" 304 0 "http://example.com/" "Mozilla/5.0"',
+        '10.0.0.3 - - [10/Oct/2012:12:00:00 +0000] "GET /users/%(pk)s/ '
+            'HTTP/1.1" 200 512 "-" "EvilBot/1.0"',
+        '10.0.0.4 - - [10/Oct/2012:12:00:00 +0000] "POST /users/%(pk)s/ '
+            'HTTP/1.1" 200 512 "-" "Mozilla/5.0"',
+        '10.0.0.4 - - [10/Oct/2012:12:00:00 +0000] "GET /users/%(pk)s/ '
+            'HTTP/1.1" 404 512 "-" "Mozilla/5.0"',
+        '10.0.0.4 - - [10/Oct/2012:12:00:00 +0000] "GET /users/1000/ '
+            'HTTP/1.1" 200 512 "-" "Mozilla/5.0"',
+        '10.0.0.4 - - [12/Oct/2012:12:00:00 +0000] "GET /users/%(pk)s/ '
+            'HTTP/1.1" 200 512 "-" "Mozilla/5.0"',
+        'garbage',
+    ]
+
+    def setUp(self):
+        super(LogIngestTest, self).setUp()
+        blacklist.invalidate()
+        BlacklistUserAgent.objects.create(user_agent='EvilBot/1.0')
+        self.user = User.objects.create(username='viewer')
+        self.path = tempfile.mkdtemp()
+        self.log = os.path.join(self.path, 'access.log.gz')
+        log = gzip.open(self.log, 'wb')
+        log.write('\n'.join(self.LOG) % {'pk': self.user.pk})
+        log.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_ingest(self):
+        """
+        Tests that the requests of the period become hits once.
+        """
+        for i in xrange(2):
+            call_command('hitcount_ingest_logs', self.log,
+                         since='2012-10-10', until='2012-10-11',
+                         model='auth.user',
+                         url_pattern=r'^/users/(?P<pk>\d+)/(\?|$)',
+                         processes=1, stdout=StringIO())
+            hitcount = HitCount.objects.get()
+            self.assertEqual(hitcount.object_pk, unicode(self.user.pk))
+            self.assertEqual(hitcount.hits, 2)
+        # stored like live hits, in naive UTC
+        self.assertEqual(sorted((hit.ip, naive_utc(hit.created))
+                                for hit in Hit.objects.all()), [
+            ('10.0.0.1', datetime.datetime(2012, 10, 10, 11, 55, 36)),
+            ('10.0.0.2', datetime.datetime(2012, 10, 10, 12, 0, 0))])
+
+    def test_shards(self):
+        """
+        Tests that the workers split the lines by client so that a repeat
+        hit in another file is recognized without the database.
+        """
+        from hitcount.management.commands.hitcount_ingest_logs import \
+            _ingest
+        paths = [os.path.join(self.path, name) for name in ('1.log', '2.log')]
+        for path, lines in zip(paths, (self.LOG[:1], self.LOG[1:])):
+            log = open(path, 'w')
+            log.write('\n'.join(lines) % {'pk': self.user.pk})
+            log.close()
+        options = {'model': 'auth.user',
+                   'url_pattern': r'^/users/(?P<pk>\d+)/(\?|$)',
+                   'since': datetime.datetime(2012, 10, 10),
+                   'until': datetime.datetime(2012, 10, 11),
+                   'dry_run': True, 'shards': 2}
+        totals = dict.fromkeys(['lines', 'repeated', 'recorded'], 0)
+        for shard in xrange(2):
+            for path, stats in _ingest((paths, dict(options, shard=shard))):
+                for key in totals:
+                    totals[key] += stats[key]
+        self.assertEqual(totals, {'lines': len(self.LOG), 'repeated': 1,
+                                  'recorded': 2})
+        self.assertEqual(Hit.objects.count(), 0)
+
+
+class HyperLogLogTest(TestCase):
+    def assertClose(self, estimate, exact):
+        # three standard errors at the default precision
+        self.assertTrue(abs(estimate - exact) <= 0.07 * exact,
+                        "estimated %d, exact %d" % (estimate, exact))
+
+    def test_error_bounds(self):
+        """
+        Tests the estimates against exact counts of synthetic visitors.
+        """
+        for n in (10, 500, 20000):
+            sketch = HyperLogLog()
+            for i in xrange(n):
+                sketch.add('visitor:%d' % i)
+                sketch.add('visitor:%d' % (i // 2))
+            self.assertClose(sketch.cardinality(), n)
+        self.assertEqual(HyperLogLog().cardinality(), 0)
+
+    def test_merge(self):
+        """
+        Tests that merged sketches estimate the union and survive storage.
+        """
+        first, second = HyperLogLog(), HyperLogLog()
+        for i in xrange(10000):
+            first.add('visitor:%d' % i)
+            second.add('visitor:%d' % (i + 5000))
+        first.update(HyperLogLog.loads(second.dumps()))
+        self.assertClose(first.cardinality(), 15000)
+        self.assertRaises(ValueError, first.update, HyperLogLog(10))
+
+
+@override_settings(HITCOUNT_ROLLUP_DELAY={})
+class UniqueVisitorTest(HitTestCase):
+    def setUp(self):
+        super(UniqueVisitorTest, self).setUp()
+        self.user = User.objects.create(username='viewer')
+        self.hitcount = HitCount.objects.get_for_object(
+            ContentType.objects.get_for_model(User), self.user.pk)
+        self.today = datetime.datetime.utcnow().replace(hour=12)
+        # visitors 0-299 on the first day, 200-599 on the second
+        hits = []
+        for day, visitors in ((2, xrange(300)), (1, xrange(200, 600))):
+            created = self.today - datetime.timedelta(days=day)
+            hits.extend(Hit(hitcount=self.hitcount, session_hash=visitor,
+                            created=created, user_agent='ua')
+                        for visitor in visitors)
+        Hit.objects.record_hits(hits)
+        Hit(hitcount=self.hitcount, session_hash=1, user=self.user,
+            user_agent='ua').save()
+
+    def assertClose(self, estimate, exact):
+        self.assertTrue(abs(estimate - exact) <= 0.07 * exact,
+                        "estimated %d, exact %d" % (estimate, exact))
+
+    def test_unique_visitors(self):
+        """
+        Tests that date ranges merge the daily sketches, which outlive the
+        hits.
+        """
+        today = self.today.date()
+        # Sketched when rolled up, answered from the hits until then
+        self.assertEqual(VisitorSketch.objects.count(), 0)
+        self.assertClose(self.hitcount.unique_visitors(), 601)
+        self.assertEqual(rollups.rollup_hits(), 701)
+        self.assertEqual(VisitorSketch.objects.count(), 3)
+        Hit.objects.filter(user=None).delete()
+        self.assertClose(self.hitcount.unique_visitors(), 601)
+        self.assertClose(self.hitcount.unique_visitors(
+            end=today - datetime.timedelta(days=1)), 600)
+        self.assertClose(self.hitcount.unique_visitors(
+            start=today - datetime.timedelta(days=1)), 401)
+        self.assertEqual(self.hitcount.unique_visitors(start=today), 1)
+
+    def test_unique_tag(self):
+        """
+        Tests the `unique` option of the get_hit_count tag.
+        """
+        rollups.rollup_hits()
+        output = Template("{% load hitcount_tags %}"
+                          "{% get_hit_count for user unique %}|"
+                          "{% get_hit_count for user unique within "
+                          "\"days=1\" as visitors %}{{ visitors }}"
+                          ).render(Context({'user': self.user}))
+        total, recent = map(int, output.split('|'))
+        self.assertClose(total, 601)
+        self.assertClose(recent, 401)
+
+
+@unittest.skipIf(archive.numpy is None, "NumPy is not installed")
+@override_settings(HITCOUNT_ROLLUP_DELAY={})
+class HitArchiveTest(HitTestCase):
+    def setUp(self):
+        super(HitArchiveTest, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.user = User.objects.create(username='viewer')
+        ctype = ContentType.objects.get_for_model(User)
+        self.hitcounts = [HitCount.objects.create(content_type=ctype,
+                                                  object_pk=str(pk))
+                          for pk in (self.user.pk, 1000)]
+        now = datetime.datetime.utcnow()
+        self.old = now - datetime.timedelta(days=90)
+        for i, (hitcount, ago) in enumerate([(0, 90), (0, 90), (1, 60),
+                                             (0, 1)]):
+            hit = Hit(hitcount=self.hitcounts[hitcount], ip='10.0.0.%d' % i,
+                      session_hash=i % 2, user_agent='ua%d' % (i % 2))
+            hit.save()
+            hit.created = now - datetime.timedelta(days=ago)
+            hit.save()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_archive(self):
+        """
+        Tests that expired hits are archived once and can be aggregated.
+        """
+        call_command('hitcount_archive', path=self.path, stdout=StringIO())
+        call_command('hitcount_archive', path=self.path, stdout=StringIO())
+        hits = archive.HitArchive(self.path)
+        self.assertEqual(len(hits.months()), 2)
+        self.assertEqual(hits.hits_per_hitcount(),
+                         {self.hitcounts[0].pk: 2, self.hitcounts[1].pk: 1})
+        self.assertEqual(hits.hits_per_object('auth.user'),
+                         {unicode(self.user.pk): 2, u'1000': 1})
+        self.assertEqual(hits.hits_per_hitcount(
+            start=self.old + datetime.timedelta(days=1)),
+            {self.hitcounts[1].pk: 1})
+        self.assertEqual(hits.hits_per_day([self.hitcounts[0].pk]),
+                         {self.old.date(): 2})
+        self.assertEqual(hits.unique_visitors(), 2)
+        self.assertEqual(hits.top_user_agents(1), [(u'ua0', 2)])
+        self.assertEqual(hits.top_ips(1)[0][1], 1)
+
+    def test_cleanup_keeps_unarchived_hits(self):
+        """
+        Tests that hitcount_cleanup doesn't delete expired hits which were
+        saved after a recent hit and so are not archived yet.
+        """
+        hit = Hit(hitcount=self.hitcounts[0], ip='10.0.0.9', session_hash=9,
+                  user_agent='ua')
+        hit.save()
+        hit.created = self.old
+        hit.save()
+        call_command('hitcount_archive', path=self.path, stdout=StringIO())
+        rollups.rollup_hits()
+        with self.settings(HITCOUNT_ARCHIVE_DIR=self.path):
+            call_command('hitcount_cleanup', sleep=0, stdout=StringIO())
+        self.assertEqual([hit.ip for hit in Hit.objects.order_by('pk')],
+                         ['10.0.0.3', '10.0.0.9'])
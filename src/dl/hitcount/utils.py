@@ -1,9 +1,20 @@
 from django.conf import settings
+from django.utils import timezone
 import re
+import socket
+import binascii
+import hashlib
+import struct
+import threading
+import time
+from collections import OrderedDict
 
 # this is not intended to be an all-knowing IP address regex
 IP_RE = re.compile('\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}')
 
+# the number of bits in an address of each IP version
+IP_BITS = {4: 32, 6: 128}
+
 def get_ip(request):
     """
     Retrieves the remote IP address from the request data.  If the user is
@@ -22,7 +33,9 @@ def get_ip(request):
                                   request.META.get('REMOTE_ADDR', '127.0.0.1'))
     if ip_address:
         # make sure we have one and only one IP
-        try:
+        ip_address = ip_address.split(',')[0].strip()
+        if parse_ip(ip_address) is None:
+            # IPv4 addresses might still be followed by some junk
             ip_address = IP_RE.match(ip_address)
             if ip_address:
                 ip_address = ip_address.group(0)
@@ -30,7 +43,203 @@ def get_ip(request):
                 # no IP, probably from some dirty proxy or other device
                 # throw in some bogus IP
                 ip_address = '10.0.0.1'
-        except IndexError:
-            pass
 
     return ip_address
+
+
+def parse_ip(ip_address):
+    """
+    Parses an IPv4 or IPv6 address.  Returns a (version, integer) tuple or
+    None if the string is not a valid IP address.
+
+    >>> parse_ip('10.0.0.1')
+    (4, 167772161L)
+    >>> parse_ip('::1')
+    (6, 1L)
+    >>> parse_ip('10.0.0') is None
+    True
+    """
+    for version, family in ((4, socket.AF_INET), (6, socket.AF_INET6)):
+        try:
+            packed = socket.inet_pton(family, ip_address)
+        except (socket.error, ValueError, TypeError):
+            continue
+        return version, long(binascii.hexlify(packed), 16)
+    return None
+
+
+def parse_network(network):
+    """
+    Parses an IPv4 or IPv6 network in CIDR notation (10.1.2.0/24).  A plain
+    IP address is treated as a network holding only that address.
+    Returns a (version, network, prefix length) tuple where the host bits
+    of the network are cleared.  Raises ValueError for invalid input.
+
+    >>> parse_network('10.1.2.3/24')
+    (4, 167838208L, 24)
+    >>> parse_network('2001:db8::/32')
+    (6, 42540766411282592856903984951653826560L, 32)
+    >>> parse_network('10.1.2.3')
+    (4, 167838211L, 32)
+    """
+    address, _, prefixlen = network.strip().partition('/')
+    parsed = parse_ip(address)
+    if parsed is None:
+        raise ValueError("Invalid IP address: %r" % address)
+    version, value = parsed
+    bits = IP_BITS[version]
+    if prefixlen:
+        if not prefixlen.isdigit() or int(prefixlen) > bits:
+            raise ValueError("Invalid prefix length: %r" % prefixlen)
+        prefixlen = int(prefixlen)
+    else:
+        prefixlen = bits
+    host_mask = (1 << (bits - prefixlen)) - 1
+    return version, value & ~host_mask, prefixlen
+
+
+def format_network(version, network, prefixlen):
+    """
+    The inverse of `parse_network`.  Single addresses are formatted without
+    the prefix length.
+
+    >>> format_network(4, 167838208L, 24)
+    '10.1.2.0/24'
+    >>> format_network(6, 1L, 128)
+    '::1'
+    """
+    bits = IP_BITS[version]
+    packed = binascii.unhexlify('%0*x' % (bits // 4, network))
+    family = socket.AF_INET if version == 4 else socket.AF_INET6
+    address = socket.inet_ntop(family, packed)
+    if prefixlen == bits:
+        return address
+    return '%s/%d' % (address, prefixlen)
+
+
+def pack_ip(ip_address):
+    """
+    Packs an IPv4 or IPv6 address into 16 bytes; IPv4 addresses are stored
+    as IPv4-mapped IPv6 addresses (::ffff:10.0.0.1).  Returns None if the
+    string is not a valid IP address.
+
+    >>> len(pack_ip('10.0.0.1')), len(pack_ip('2001:db8::1'))
+    (16, 16)
+    >>> pack_ip('10.0.0') is None
+    True
+    """
+    parsed = parse_ip(ip_address)
+    if parsed is None:
+        return None
+    version, address = parsed
+    if version == 4:
+        address |= 0xffff << 32
+    return binascii.unhexlify('%032x' % address)
+
+
+def unpack_ip(packed):
+    """
+    The inverse of `pack_ip`.
+
+    >>> unpack_ip(pack_ip('10.0.0.1'))
+    '10.0.0.1'
+    >>> unpack_ip(pack_ip('2001:db8::1'))
+    '2001:db8::1'
+    """
+    address = long(binascii.hexlify(packed), 16)
+    if address >> 32 == 0xffff:
+        return format_network(4, address & 0xffffffff, 32)
+    return format_network(6, address, 128)
+
+
+def hash_session(session_key):
+    """
+    Hashes a session key (or any other visitor id) to a signed 64 bit
+    integer which fits a BigIntegerField.
+    """
+    digest = hashlib.md5(session_key.encode('utf-8')).digest()
+    return struct.unpack('>q', digest[:8])[0]
+
+
+class LRUCache(object):
+    """
+    A thread-safe, size-bounded mapping which evicts the least recently used
+    entry once it is full.  With `max_age` (in seconds), entries which were
+    set longer ago than that are evicted too, when they are looked up.
+
+    >>> cache = LRUCache(2)
+    >>> cache['a'] = 1
+    >>> cache['b'] = 2
+    >>> cache.get('a')
+    1
+    >>> cache['c'] = 3
+    >>> cache.get('b') is None
+    True
+    >>> cache.get('a'), cache.get('c')
+    (1, 3)
+    >>> cache = LRUCache(2, max_age=0)
+    >>> cache['a'] = 1
+    >>> cache.get('a') is None
+    True
+    """
+
+    def __init__(self, max_size, max_age=None):
+        self.max_size = max_size
+        self.max_age = max_age
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._data.pop(key)
+            except KeyError:
+                return default
+            if expires is not None and expires <= time.time():
+                return default
+            # re-insert to mark it as the most recently used entry
+            self._data[key] = value, expires
+            return value
+
+    def __setitem__(self, key, value):
+        expires = None
+        if self.max_age is not None:
+            expires = time.time() + self.max_age
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value, expires
+            if len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            try:
+                return self._data.pop(key)[0]
+            except KeyError:
+                return default
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+def timedelta_seconds(delta):
+    '''
+    Returns the whole number of seconds in a timedelta.
+    '''
+    return delta.days * 24 * 60 * 60 + delta.seconds
+
+
+def naive_utc(value):
+    '''
+    Returns a datetime read from the database as the naive UTC datetime it
+    was saved as.  Hit times are saved naive (datetime.utcnow()); with
+    USE_TZ, Django interprets naive values in the default time zone when
+    saving and filtering, and returns aware values when reading.
+    '''
+    if value is not None and timezone.is_aware(value):
+        return timezone.make_naive(value, timezone.get_default_timezone())
+    return value
@@ -1,84 +1,226 @@
+import datetime
+
 from django.http import Http404, HttpResponse, HttpResponseBadRequest
 from django.utils import simplejson
 from django.conf import settings
+from django.contrib.auth.models import Group
 from django.contrib.contenttypes.models import ContentType
 
-from hitcount.utils import get_ip
-from hitcount.models import Hit, HitCount, BlacklistIP, BlacklistUserAgent
+from hitcount.utils import get_ip, hash_session
+from hitcount.models import Hit, HitCount
+from hitcount.buffer import get_hit_buffer, hit_to_facts
+from hitcount.blacklist import is_blacklisted
+from hitcount.ratelimit import get_ip_hits
+from hitcount.dedupe import ViewedCookie, seen_recently, use_cookie
+from hitcount.heavyhitters import is_throttled
+
 
-def _update_hit_count(request, hitcount):
+def _save_hit(hit, hit_buffer=None):
     '''
-    Evaluates a request's Hit and corresponding HitCount object and,
-    after a bit of clever logic, either ignores the request or registers
-    a new Hit.
+    Saves the hit right away or, if HITCOUNT_BUFFER is set (or another
+    buffer is passed in), queues it to be saved in bulk later on.
 
-    This is NOT a view!  But should be used within a view ...
+    Returns True if the hit was accepted.
+    '''
+    hit_buffer = hit_buffer or get_hit_buffer()
+    if hit_buffer is not None:
+        if not hit_buffer.add(hit):
+            return False
+    else:
+        hit.save()
+    if getattr(settings, 'HITCOUNT_HITS_PER_IP_LIMIT', 0):
+        get_ip_hits().incr(hit.ip)
+    return True
 
-    Returns True if the request was considered a Hit; returns False if not.
+def _save_hits(hits, hit_buffer=None):
     '''
-    user = request.user
+    Like `_save_hit` for several hits, saving them with a constant number
+    of queries when they are not buffered.
 
-    if not request.session.session_key:
-        request.session.save()
+    Returns the accepted hits.
+    '''
+    hit_buffer = hit_buffer or get_hit_buffer()
+    if hit_buffer is not None:
+        hits = [hit for hit in hits if hit_buffer.add(hit)]
+    else:
+        Hit.objects.record_hits(hits)
+    if getattr(settings, 'HITCOUNT_HITS_PER_IP_LIMIT', 0):
+        for hit in hits:
+            get_ip_hits().incr(hit.ip)
+    return hits
 
-    session_key = request.session.session_key
-    ip = get_ip(request)
-    user_agent = request.META.get('HTTP_USER_AGENT', '')[:255]
+def _countable_hits(hits):
+    '''
+    Checks unsaved hits of a single visitor (on different HitCounts)
+    against HITCOUNT_EXCLUDE_USER_GROUP and HITCOUNT_HITS_PER_IP_LIMIT and
+    makes sure the same user (or, for anonymous hits, the same session) has
+    no active hit on their HitCounts, with a constant number of queries.
+
+    Returns the hits which should be recorded.
+    '''
+    if not hits:
+        return []
+    visitor = hits[0]
     hits_per_ip_limit = getattr(settings, 'HITCOUNT_HITS_PER_IP_LIMIT', 0)
     exclude_user_group = getattr(settings,
                             'HITCOUNT_EXCLUDE_USER_GROUP', None)
 
-    # first, check our request against the blacklists before continuing
-    if BlacklistIP.objects.filter(ip__exact=ip) or \
-            BlacklistUserAgent.objects.filter(user_agent__exact=user_agent):
-        return False
+    # see if we are excluding a specific user group or not
+    if exclude_user_group and visitor.user_id is not None:
+        if Group.objects.filter(user=visitor.user_id,
+                                name__in=exclude_user_group):
+            return []
 
-    # second, see if we are excluding a specific user group or not
-    if exclude_user_group and user.is_authenticated():
-        if user.groups.filter(name__in=exclude_user_group):
-            return False
+    # check limit on hits from a unique ip address (HITCOUNT_HITS_PER_IP_LIMIT)
+    # over the HITCOUNT_KEEP_HIT_ACTIVE window (see hitcount.ratelimit)
+    if hits_per_ip_limit:
+        ip_hits = get_ip_hits().count(visitor.ip)
+        if ip_hits > hits_per_ip_limit:
+            return []
 
-    #start with a fresh active query set (HITCOUNT_KEEP_HIT_ACTIVE )
-    qs = Hit.objects.filter_active()
+    # use a user's authentication to see if they made an earlier hit,
+    # otherwise see if we have a repeat session (unless HITCOUNT_DEDUPE
+    # says anonymous hits were checked against the visitor's cookie)
+    if visitor.user_id is not None or not use_cookie():
+        #start with a fresh active query set (HITCOUNT_KEEP_HIT_ACTIVE )
+        qs = Hit.objects.filter_active(
+                hitcount__in=[hit.hitcount_id for hit in hits])
+        if visitor.user_id is not None:
+            qs = qs.filter(user=visitor.user_id)
+        else:
+            qs = qs.filter(session_hash=visitor.session_hash)
+        seen = set(qs.order_by().values_list('hitcount', flat=True))
+        hits = [hit for hit in hits if hit.hitcount_id not in seen]
 
-    # check limit on hits from a unique ip address (HITCOUNT_HITS_PER_IP_LIMIT)
+    # each accepted hit counts against the limit
     if hits_per_ip_limit:
-        if qs.filter(ip__exact=ip).count() > hits_per_ip_limit:
-            return False
+        hits = hits[:hits_per_ip_limit - ip_hits + 1]
+    return hits
+
+def _is_countable(hit):
+    '''
+    Checks an unsaved hit like `_countable_hits`.
+
+    Returns True if the hit should be recorded.
+    '''
+    return bool(_countable_hits([hit]))
+
+def _use_async():
+    return getattr(settings, 'HITCOUNT_USE_ASYNC', False)
+
+def _viewed_cookie(request):
+    '''
+    Returns the ViewedCookie which tells an anonymous visitor apart, or
+    None if they are told apart by their session.
+
+    The cookie is used with HITCOUNT_DEDUPE = 'cookie' and, so that queueing
+    a hit never writes the session, with HITCOUNT_USE_ASYNC.
+    '''
+    if request.user.is_authenticated():
+        return None
+    if use_cookie() or _use_async():
+        return ViewedCookie.from_request(request)
+    return None
 
-    # create a generic Hit object with request data
-    hit = Hit(  session=session_key,
-                hitcount=hitcount,
-                ip=get_ip(request),
-                user_agent=request.META.get('HTTP_USER_AGENT', '')[:255],)
+def _build_hit(request, hitcount_pk, viewed=None):
+    '''
+    Returns an unsaved Hit with the request data or None if the request is
+    blacklisted or, for anonymous visitors with a ViewedCookie, a repeat
+    hit.
+    '''
+    ip = get_ip(request)
+    user_agent = request.META.get('HTTP_USER_AGENT', '')[:255]
 
-    # first, use a user's authentication to see if they made an earlier hit
-    if user.is_authenticated():
-        if not qs.filter(user=user,hitcount=hitcount):
-            hit.user = user #associate this hit with a user
-            hit.save()
-            return True
+    # check our request against the blacklists before continuing
+    if is_blacklisted(ip, user_agent):
+        return None
 
-    # if not authenticated, see if we have a repeat session
+    if viewed is not None:
+        if viewed.seen(hitcount_pk) or \
+                seen_recently(ip, user_agent, hitcount_pk):
+            return None
+        session_key = viewed.visitor
     else:
-        if not qs.filter(session=session_key,hitcount=hitcount):
-            hit.save()
+        if not request.session.session_key:
+            request.session.save()
+        session_key = request.session.session_key
 
-            # forces a save on this anonymous users session
-            request.session.modified = True
+    hit = Hit(  session_hash=hash_session(session_key),
+                hitcount_id=hitcount_pk,
+                ip=ip,
+                user_agent=user_agent,)
 
-            return True
+    if request.user.is_authenticated():
+        hit.user = request.user #associate this hit with a user
+    return hit
 
-    return False
+def _hit_accepted(request, hit, viewed=None):
+    '''
+    Remembers an accepted anonymous hit in the visitor's cookie or session.
+    '''
+    if hit.user_id is not None:
+        return
+    if viewed is not None:
+        viewed.add(hit.hitcount_id)
+    else:
+        # forces a save on this anonymous users session
+        request.session.modified = True
+
+def _update_hit_count(request, hitcount, viewed=None):
+    '''
+    Evaluates a request's Hit and corresponding HitCount object and,
+    after a bit of clever logic, either ignores the request or registers
+    a new Hit.
+
+    This is NOT a view!  But should be used within a view ...
+
+    Anonymous visitors are told apart by their session unless a
+    ViewedCookie is passed in (HITCOUNT_DEDUPE = 'cookie'); the caller
+    then has to set the cookie on its response.
+
+    Returns True if the request was considered a Hit; returns False if not.
+    '''
+    hit = _build_hit(request, hitcount.pk, viewed)
+    if hit is None:
+        return False
+    hit.hitcount = hitcount
+    if not _is_countable(hit) or not _save_hit(hit):
+        return False
+
+    _hit_accepted(request, hit, viewed)
+    return True
+
+def _queue_hit(request, hitcount_pk, viewed=None):
+    '''
+    Hands a request's Hit over to the task queue (HITCOUNT_USE_ASYNC).
+    The worker decides whether it counts and saves it, so this only costs
+    the blacklist check and publishing the task.  Anonymous visitors are
+    told apart by their ViewedCookie (see `_viewed_cookie`), so the session
+    is left alone.
+
+    Returns True if the hit was queued.
+    '''
+    from hitcount.tasks import record_hit
+
+    hit = _build_hit(request, hitcount_pk, viewed)
+    if hit is None:
+        return False
+    hit.created = datetime.datetime.utcnow()
+    record_hit.delay(hit_to_facts(hit))
+
+    _hit_accepted(request, hit, viewed)
+    return True
 
 def json_error_response(error_message):
     return HttpResponse(simplejson.dumps(dict(success=False,
                                               error_message=error_message)))
 
+def _throttled_response():
+    return HttpResponse(simplejson.dumps({'status': 'throttled'}),
+                        mimetype="application/json", status=429)
+
 # TODO better status responses - consider model after django-voting,
-# right now the django handling isn't great.  should return the current
-# hit count so we could update it via javascript (since each view will
-# be one behind).
+# right now the django handling isn't great.
 def update_hit_count_ajax(request):
     '''
     Ajax call that can be used to update a hit count.
@@ -96,19 +238,114 @@ def update_hit_count_ajax(request):
     if request.method == "GET":
         return json_error_response("Hits counted via POST only.")
 
+    # reject clients which make too many requests (HITCOUNT_THROTTLE_*)
+    if is_throttled(get_ip(request),
+                    request.META.get('HTTP_USER_AGENT', '')[:255]):
+        return _throttled_response()
+
     hitcount_pk = request.POST.get('hitcount_pk')
 
+    # remember anonymous visitors in a cookie rather than in their session
+    viewed = _viewed_cookie(request)
+
+    data = {}
+    if _use_async():
+        # the worker checks that the HitCount exists
+        try:
+            hitcount_pk = int(hitcount_pk)
+        except (TypeError, ValueError):
+            return HttpResponseBadRequest("HitCount object_pk not working")
+
+        if _queue_hit(request, hitcount_pk, viewed):
+            status = "queued"
+        else:
+            status = "no hit recorded"
+
+    else:
+        try:
+            hitcount = HitCount.objects.get(pk=hitcount_pk)
+        except:
+            return HttpResponseBadRequest("HitCount object_pk not working")
+
+        hits = hitcount.hits
+        result = _update_hit_count(request, hitcount, viewed)
+
+        if result:
+            status = "success"
+        else:
+            status = "no hit recorded"
+
+        # the total including this hit (unless it waits in a hit buffer)
+        if result and get_hit_buffer() is None:
+            hits += 1
+        data['hits'] = hits
+
+    data['status'] = status
+    json = simplejson.dumps(data)
+    response = HttpResponse(json,mimetype="application/json")
+    if viewed is not None and viewed.modified:
+        viewed.set_on(response)
+    return response
+
+def update_hit_counts_beacon(request):
+    '''
+    Records a hit on each of several HitCounts at once and returns their
+    current totals.
+
+    The HitCount pks are POSTed as repeated `hitcount_pk` fields, at most
+    HITCOUNT_BEACON_MAX_HITS (100 by default).  Unlike
+    `update_hit_count_ajax`, it accepts requests which are not made by
+    XMLHttpRequest, so it can be called with `navigator.sendBeacon` (see
+    the `get_hit_count_beacon` template tag).  The response looks like
+
+        {"status": "success", "counted": [3, 5], "hits": {"3": 12, "5": 7}}
+
+    where `counted` lists the HitCounts which got a hit (or, with
+    HITCOUNT_USE_ASYNC, whose hits were queued) and `hits` holds the
+    totals.  Hits which wait in a hit buffer or the task queue are not
+    included in the totals yet.
+    '''
+    if request.method != "POST":
+        return json_error_response("Hits counted via POST only.")
+
     try:
-        hitcount = HitCount.objects.get(pk=hitcount_pk)
-    except:
+        hitcount_pks = sorted(set(int(pk) for pk in
+                                  request.POST.getlist('hitcount_pk')))
+    except ValueError:
         return HttpResponseBadRequest("HitCount object_pk not working")
+    if not hitcount_pks or len(hitcount_pks) > getattr(settings,
+            'HITCOUNT_BEACON_MAX_HITS', 100):
+        return HttpResponseBadRequest("Invalid number of HitCounts")
 
-    result = _update_hit_count(request, hitcount)
+    if is_throttled(get_ip(request),
+                    request.META.get('HTTP_USER_AGENT', '')[:255]):
+        return _throttled_response()
 
-    if result:
-        status = "success"
+    viewed = _viewed_cookie(request)
+
+    if _use_async():
+        counted = [pk for pk in hitcount_pks
+                   if _queue_hit(request, pk, viewed)]
+        status = "queued"
     else:
+        existing = HitCount.objects.filter(pk__in=hitcount_pks).values_list(
+                'pk', flat=True)
+        hits = filter(None, [_build_hit(request, pk, viewed)
+                             for pk in sorted(existing)])
+        hits = _save_hits(_countable_hits(hits))
+        for hit in hits:
+            _hit_accepted(request, hit, viewed)
+        counted = [hit.hitcount_id for hit in hits]
+        status = "success"
+    if not counted:
         status = "no hit recorded"
 
-    json = simplejson.dumps({'status': status})
-    return HttpResponse(json,mimetype="application/json")
+    totals = HitCount.objects.filter(pk__in=hitcount_pks).values_list(
+            'pk', 'hits')
+    json = simplejson.dumps({'status': status,
+                             'counted': counted,
+                             'hits': dict(totals)})
+    response = HttpResponse(json, mimetype="application/json")
+    if viewed is not None and viewed.modified:
+        viewed.set_on(response)
+    return response